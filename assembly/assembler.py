@@ -1,5 +1,12 @@
+import argparse
+import contextlib
+import logging
+import mmap
+import os
 import re
 import sys
+import time
+from array import array
 
 # INSTRUCTION
 INS_A = 1
@@ -25,10 +32,67 @@ TOK_JMP = 15
 
 EOF = None
 
+logger = logging.getLogger("assembler")
+
+# per-token tracing, checked before any message is built so it costs
+# nothing but a global lookup when off. set by set_verbosity
+TRACE = False
+
+
+# the logging level of a -v count, 0: warnings only, 1: info, 2: debug.
+# also sets up the root handler, for the set_verbosity of every tool
+def logging_level(verbosity) -> int:
+    level = logging.WARNING
+    if verbosity == 1:
+        level = logging.INFO
+    elif verbosity >= 2:
+        level = logging.DEBUG
+
+    logging.basicConfig(format="%(name)s: %(message)s", level=level)
+    return level
+
+
+# 0: warnings only, 1: info, 2: trace every token and instruction
+def set_verbosity(verbosity):
+    global TRACE
+
+    logger.setLevel(logging_level(verbosity))
+    TRACE = verbosity >= 2
+
+
+class PhaseTimer:
+    def __init__(self):
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - begin
+            self.phases[name] = self.phases.get(name, 0) + elapsed
+
+    def summary(self) -> str:
+        total = sum(self.phases.values())
+        lines = []
+        for name, elapsed in self.phases.items():
+            share = elapsed / total * 100 if total > 0 else 0
+            lines.append(f"{name:<10} {elapsed:9.4f}s {share:5.1f}%")
+        lines.append(f"{'total':<10} {total:9.4f}s")
+
+        return "\n".join(lines)
+
 
 class LexerError(Exception):
     def __init__(self, message, line, pos):
-        super().__init__(f"{message}. {line}:{pos}")
+        super().__init__(message, line, pos)
+        self.message = message
+        self.line = line
+        self.pos = pos
+
+    def __str__(self):
+        return f"{self.message}. {self.line}:{self.pos}"
 
 
 class SyntaxError(LexerError):
@@ -36,71 +100,140 @@ class SyntaxError(LexerError):
         super().__init__(f"syntax error, {message}", line, pos)
 
 
+PREDEFINED_SYMBOLS = {
+    "SP": 0,
+    "LCL": 1,
+    "ARG": 2,
+    "THIS": 3,
+    "THAT": 4,
+    "R0": 0,
+    "R1": 1,
+    "R2": 2,
+    "R3": 3,
+    "R4": 4,
+    "R5": 5,
+    "R6": 6,
+    "R7": 7,
+    "R8": 8,
+    "R9": 9,
+    "R10": 10,
+    "R11": 11,
+    "R12": 12,
+    "R13": 13,
+    "R14": 14,
+    "R15": 15,
+    "SCREEN": 0x4000,
+    "KBD": 0x6000,
+}
+
+# kinds of the symbol map
+SYM_PREDEFINED = "predefined"
+SYM_LABEL = "label"
+SYM_VARIABLE = "variable"
+
+
+# symbols are interned to integer ids in order of first appearance, an id
+# indexes the names and values lists. a symbol without a value after
+# lexing is a variable, resolve() gives all of them their registers in one
+# pass, in the order they first appear
 class SymbolTable:
     def __init__(self):
-        self._symbols = {
-            "SP": 0,
-            "LCL": 1,
-            "ARG": 2,
-            "THIS": 3,
-            "THAT": 4,
-            "R0": 0,
-            "R1": 1,
-            "R2": 2,
-            "R3": 3,
-            "R4": 4,
-            "R5": 5,
-            "R6": 6,
-            "R7": 7,
-            "R8": 8,
-            "R9": 9,
-            "R10": 10,
-            "R11": 11,
-            "R12": 12,
-            "R13": 13,
-            "R14": 14,
-            "R15": 15,
-            "SCREEN": 0x4000,
-            "KBD": 0x6000,
-        }
+        self._ids = {}
+        self._names = []
+        self._values = []
+        # ids of the variables, in allocation order
+        self._variables = []
+        for symbol, value in PREDEFINED_SYMBOLS.items():
+            self.put(symbol, value)
         self.register_count = 16
 
-    def put(self, symbol, value):
-        if value == None:
-            if self.has(symbol):
-                return
+    def intern(self, symbol) -> int:
+        id = self._ids.get(symbol)
+        if id == None:
+            id = len(self._names)
+            self._ids[symbol] = id
+            self._names.append(symbol)
+            self._values.append(None)
+        return id
 
-        self._symbols[symbol] = value
+    # a None value only interns the symbol
+    def put(self, symbol, value):
+        id = self.intern(symbol)
+        if value != None:
+            self._values[id] = value
 
     def get(self, symbol):
-        return self._symbols[symbol]
+        return self._values[self._ids[symbol]]
 
     def has(self, symbol):
-        return symbol in self._symbols
+        return symbol in self._ids
+
+    # has a value: predefined, a label or an allocated variable
+    def defined(self, symbol) -> bool:
+        id = self._ids.get(symbol)
+        return id != None and self._values[id] != None
 
+    # the address of one symbol, allocating its register when it is a
+    # variable that has none yet. the streaming assembler resolves this way
     def relocate(self, symbol):
-        if not self.has(symbol):
+        id = self._ids.get(symbol)
+        if id == None:
             raise Exception(f"symbol {symbol} notfound")
 
-        if self.get(symbol) == None:
-            # increase register number for variable by one
-            self._symbols[symbol] = self.register_count
-            self.register_count += 1
-
-        return self.get(symbol)
+        if self._values[id] == None:
+            self._allocate(id)
+
+        return self._values[id]
+
+    # allocates every variable, returns the values indexed by symbol id
+    def resolve(self) -> list:
+        values = self._values
+        for id in range(len(values)):
+            if values[id] == None:
+                self._allocate(id)
+
+        return values
+
+    def _allocate(self, id):
+        self._values[id] = self.register_count
+        self._variables.append(id)
+        self.register_count += 1
+
+    def items(self):
+        return zip(self._names, self._values)
+
+    # "address kind name" lines sorted by address, for debuggers
+    def write_map(self, outf):
+        kinds = [SYM_LABEL] * len(self._names)
+        for id in range(len(PREDEFINED_SYMBOLS)):
+            kinds[id] = SYM_PREDEFINED
+        for id in self._variables:
+            kinds[id] = SYM_VARIABLE
+        entries = sorted(
+            (value, kinds[id], name)
+            for id, (name, value) in enumerate(zip(self._names, self._values))
+            if value != None
+        )
+        for value, kind, name in entries:
+            outf.write(f"{value}\t{kind}\t{name}\n")
 
 
 class Instruction:
-    def __init__(self, line, tokens=[]):
+    __slots__ = ("line",)
+    type = None
+
+    def __init__(self, line):
         self.line = line
-        self.tokens = tokens
 
     def relocate(self, symbol_table: SymbolTable) -> None:
         raise Exception("not implemented")
 
-    def to_bin(self) -> str:
+    def to_int(self) -> int:
         raise Exception("not implemented")
 
+    def to_bin(self) -> str:
+        return format(self.to_int(), "016b")
+
     def __repr__(self) -> str:
         return "NULL: (0)"
 
@@ -135,19 +268,36 @@ _comp_codes = {
     "M-D": "1000111",
     "D&M": "1000000",
     "D|M": "1010101",
+    # commutative spellings, the vm translator emits e.g. M=M+D
+    "A+D": "0000010",
+    "A&D": "0000000",
+    "A|D": "0010101",
+    "M+D": "1000010",
+    "M&D": "1000000",
+    "M|D": "1010101",
 }
 _jump_codes = ["", "JGT", "JEQ", "JGE", "JLT", "JNE", "JLE", "JMP"]
 
-
-def bits(num):
-    return bin(int(num))[2:]
+# C-instruction fields already shifted into place: 111a cccc ccdd djjj
+_dest_bits = {dest: i << 3 for i, dest in enumerate(_dest_codes)}
+_dest_bits[None] = 0
+_comp_bits = {comp: int(code, 2) << 6 for comp, code in _comp_codes.items()}
+_jump_bits = {jump: i for i, jump in enumerate(_jump_codes)}
+_jump_bits[None] = 0
 
 
+# pos is where the symbol or number starts, for diagnostics
 class InstructionA(Instruction):
-    def __init__(self, line, tokens, symbol, address):
-        super().__init__(line, tokens)
+    __slots__ = ("pos", "symbol", "address", "id")
+    type = INS_A
+
+    def __init__(self, line, pos, symbol, address):
+        super().__init__(line)
+        self.pos = pos
         self.symbol = symbol
         self.address = address
+        # the symbol's id in the symbol table, set by Lexer.refer
+        self.id = None
 
     def relocate(self, symbol_table: SymbolTable):
         if self.address == None:
@@ -155,28 +305,31 @@ class InstructionA(Instruction):
                 raise LexerError(
                     f"relocate error. cannot find address of symbol {self.symbol}",
                     self.line,
-                    self.tokens[1].pos,
+                    self.pos,
                 )
 
             self.address = symbol_table.relocate(self.symbol)
 
-    def to_bin(self):
-        addr_bin = bits(int(self.address))
-        if len(addr_bin) > 15:
+    def to_int(self):
+        address = int(self.address)
+        if address > 0x7FFF:
             raise LexerError(
                 f"address out of range [0 : 2^16-1] {self.address}",
                 self.line,
-                self.tokens[1].pos,
+                self.pos,
             )
-        return "0" + addr_bin.zfill(15)
+        return address
 
     def __repr__(self):
         return f"@{self.address}: {self.to_bin()}"
 
 
 class InstructionC(Instruction):
-    def __init__(self, line, tokens, dest, comp, jump):
-        super().__init__(line, tokens)
+    __slots__ = ("dest", "comp", "jump")
+    type = INS_C
+
+    def __init__(self, line, dest, comp, jump):
+        super().__init__(line)
         self.dest = dest
         self.comp = comp
         self.jump = jump
@@ -184,35 +337,50 @@ class InstructionC(Instruction):
     def relocate(self, symbol_table: SymbolTable):
         pass
 
-    def to_bin(self):
-        b_ins = "111"
-
-        if self.comp == None or _comp_codes[self.comp] == None:
+    def to_int(self):
+        comp = _comp_bits.get(self.comp)
+        if comp == None:
             raise LexerError(f"unexpected comp '{self.comp}'", self.line, -1)
-        b_ins += _comp_codes[self.comp]
 
-        if self.dest != None:
-            b_ins += bits(_dest_codes.index(self.dest)).zfill(3)
-        else:
-            b_ins += "".zfill(3)
+        dest = _dest_bits.get(self.dest)
+        if dest == None:
+            raise LexerError(f"unexpected dest '{self.dest}'", self.line, -1)
 
-        if self.jump != None:
-            b_ins += bits(_jump_codes.index(self.jump)).zfill(3)
-        else:
-            b_ins += "".zfill(3)
+        jump = _jump_bits.get(self.jump)
+        if jump == None:
+            raise LexerError(f"unexpected jump '{self.jump}'", self.line, -1)
 
-        return b_ins
+        return 0xE000 | comp | dest | jump
 
     def __repr__(self):
         return f"{self.dest}={self.comp};{self.jump}: {self.to_bin()}"
 
 
+# a token only keeps its offsets into the input, value is sliced on demand
 class Token:
-    def __init__(self, type, value: str, pos, line):
+    __slots__ = ("type", "input", "pos", "end", "line")
+
+    def __init__(self, type, input: str, pos, end, line):
         self.type = type
+        self.input = input
         self.pos = pos
+        self.end = end
         self.line = line
-        self.value = value
+
+    @property
+    def value(self) -> str:
+        return self.input[self.pos : self.end]
+
+
+_repeat_res = {}
+
+
+# regex repeated zero or more times, compiled once
+def _repeat_re(regex):
+    pattern = _repeat_res.get(regex)
+    if pattern == None:
+        pattern = _repeat_res[regex] = re.compile(f"(?:{regex})*")
+    return pattern
 
 
 class Lexer:
@@ -226,6 +394,8 @@ class Lexer:
         self.lex_start = lex_start
         self.ins = []
         self.symbol_table = symbol_table
+        # indexes of the symbolic A-instructions in ins, patched by relocate
+        self.patches = []
 
     def peek(self):
         if self.pos >= self.input_len:
@@ -260,19 +430,22 @@ class Lexer:
             pass
         self.back()
 
-    # consumes next char if its match regex
+    # consumes the chars that match regex, a one char pattern, in a single
+    # match of the compiled repetition
     def accept_r(self, regex):
-        ch = self.next()
-        while ch and re.match(regex, ch):
-            ch = self.next()
-            pass
-        self.back()
+        end = _repeat_re(regex).match(self.input, self.pos).end()
+        self.line += self.input.count("\n", self.pos, end)
+        self.pos = end
 
-    # skip current line
+    # skip current line, a last line without '\n' ends the input
     def skip_line(self):
-        self.pos += self.input[self.pos :].index("\n") + 1
+        end = self.input.find("\n", self.pos)
+        if end < 0:
+            self.pos = self.input_len
+        else:
+            self.pos = end + 1
+            self.line += 1
         self.start = self.pos
-        self.line += 1
 
     def ignore(self, inc_line=False):
         if inc_line:
@@ -284,7 +457,7 @@ class Lexer:
             return self.tokens.pop(0)
 
     def _push_tok(self, type):
-        token = Token(type, self.input[self.start : self.pos], self.start, self.line)
+        token = Token(type, self.input, self.start, self.pos, self.line)
         self.tokens.append(token)
         self.start = self.pos
 
@@ -298,11 +471,197 @@ class Lexer:
         while lex_fn != None:
             lex_fn = lex_fn(self)
 
-    def assemble(self, outf):
+    # the last instruction refers to a symbol: intern it
+    def refer(self, ins):
+        ins.id = self.symbol_table.intern(ins.symbol)
+        self.patches.append(len(self.ins) - 1)
+
+    # allocates the variables, then patches the symbolic A-instructions
+    # from the values indexed by symbol id
+    def relocate(self):
+        values = self.symbol_table.resolve()
+        ins = self.ins
+        for index in self.patches:
+            a = ins[index]
+            a.address = values[a.id]
+
+    # encode every (relocated) instruction into one 16-bit word
+    def encode(self) -> array:
+        words = array("H")
         for ins in self.ins:
-            ins.relocate(self.symbol_table)
-            print(ins)
-            outf.write(ins.to_bin() + "\n")
+            words.append(ins.to_int())
+            if TRACE:
+                logger.debug(ins)
+
+        return words
+
+    def assemble(self, outf, format="text", byteorder="little"):
+        self.relocate()
+        words = self.encode()
+        if format == "binary":
+            write_rom(outf, words, byteorder)
+        else:
+            write_hack(outf, words)
+
+
+# encodes instruction records (kind, dest, comp, jump, symbol) without going
+# through assembly text, the vm translator's fused pipeline emits them:
+#   INS_A: symbol is the address, an int, or a symbol name
+#   INS_C: dest, comp and jump as written in assembly, dest and jump None
+#          when absent
+#   INS_L: symbol is the label
+# labels and variables are resolved as for a lexed program. errors carry the
+# ROM address as their line
+def encode_records(records, symbol_table: SymbolTable) -> array:
+    count = 0
+    for kind, dest, comp, jump, symbol in records:
+        if kind == INS_L:
+            if symbol_table.defined(symbol):
+                raise LexerError(f"duplicate label '{symbol}'", count, 0)
+            symbol_table.put(symbol, count)
+            continue
+        if kind == INS_A and isinstance(symbol, str):
+            symbol_table.intern(symbol)
+        count += 1
+    values = symbol_table.resolve()
+
+    words = array("H")
+    for kind, dest, comp, jump, symbol in records:
+        if kind == INS_A:
+            if isinstance(symbol, int):
+                address = symbol
+            else:
+                address = values[symbol_table.intern(symbol)]
+            if address > 0x7FFF:
+                raise LexerError(
+                    f"address out of range [0 : 2^16-1] {address}", len(words), 0
+                )
+            words.append(address)
+        elif kind == INS_C:
+            bits = _comp_bits.get(comp)
+            if bits == None:
+                raise LexerError(f"unexpected comp '{comp}'", len(words), 0)
+            if dest not in _dest_bits or jump not in _jump_bits:
+                raise LexerError(
+                    f"unexpected dest '{dest}' or jump '{jump}'", len(words), 0
+                )
+            words.append(0xE000 | bits | _dest_bits[dest] | _jump_bits[jump])
+
+    return words
+
+
+# the record of one assembly line, None for a blank or comment line. raises
+# LexerError for anything else the assembler would reject
+def line_record(line):
+    m = _line_re.fullmatch(line)
+    if m is None:
+        raise LexerError(f"cannot encode '{line}'", 0, 0)
+    label = m.group("label")
+    if label != None:
+        return (INS_L, None, None, None, sys.intern(label))
+    if m.start("at") >= 0:
+        number = m.group("number")
+        if number != None:
+            return (INS_A, None, None, None, int(number))
+        return (INS_A, None, None, None, sys.intern(m.group("symbol")))
+    comp = m.group("comp")
+    if comp != None:
+        dest = m.group("dest")
+        if dest != None:
+            dest = sys.intern(dest)
+        jump = m.group("jump") or None
+        return (INS_C, dest, sys.intern(comp), jump, None)
+
+    return None
+
+
+# text .hack output, one '0'/'1' line per word
+def write_hack(outf, words):
+    if len(words) > 0:
+        outf.write("\n".join(map(_word_bin, words)) + "\n")
+
+
+_word_bin = "{:016b}".format
+
+
+# binary ROM image, packed 16-bit words, outf must be opened in "wb" mode
+def write_rom(outf, words, byteorder="little"):
+    words = array("H", words)
+    if byteorder != sys.byteorder:
+        words.byteswap()
+    words.tofile(outf)
+
+
+# the vm translator's comments: the file of the commands that follow and
+# "//line: command" before each command's code
+_vm_file_re = re.compile(r"^\s*//file: (\S+)")
+_vm_command_re = re.compile(r"^\s*//(\d+): (.+?)\s*$")
+
+
+# the source map has one line per ROM address, tab separated:
+#   address, asm line, vm file, vm line, vm function, vm command
+# the vm fields are those of the closest vm translator comment above the
+# instruction, - for the code before the first one (the bootstrap) or for
+# hand written assembly
+def write_source_map(outf, ins, input):
+    # asm line -> vm fields
+    vm = [None]
+    file = None
+    current = ("-", "-", "-", "-")
+    function = "-"
+    for line in input.splitlines():
+        m = _vm_command_re.match(line)
+        if m != None and file != None:
+            command = m.group(2)
+            if command.startswith("function "):
+                function = command.split()[1]
+            current = (file, m.group(1), function, command)
+        else:
+            m = _vm_file_re.match(line)
+            if m != None:
+                file = m.group(1)
+                function = "-"
+                current = (file, "-", function, "-")
+        vm.append(current)
+
+    outf.write("# address\tasm line\tvm file\tvm line\tfunction\tcommand\n")
+    for address, instruction in enumerate(ins):
+        fields = (
+            vm[instruction.line] if instruction.line < len(vm) else ("-", "-", "-", "-")
+        )
+        outf.write(f"{address}\t{instruction.line}\t" + "\t".join(fields) + "\n")
+
+
+def read_hack(path) -> array:
+    inf = open(path, "r")
+    words = array("H", [int(line, 2) for line in inf if line.strip()])
+    inf.close()
+
+    return words
+
+
+# returns the words of a binary ROM image. in native byte order the image is
+# memory-mapped and the words are read straight from the mapping, otherwise
+# it is loaded and swapped into an array.
+def read_rom(path, byteorder="little"):
+    inf = open(path, "rb")
+    try:
+        size = os.fstat(inf.fileno()).st_size
+        if size % 2 != 0:
+            raise Exception(f"rom image {path} has odd size {size}")
+        if size == 0:
+            return array("H")
+
+        if byteorder != sys.byteorder:
+            words = array("H")
+            words.fromfile(inf, size // 2)
+            words.byteswap()
+            return words
+
+        rom = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(rom).cast("H")
+    finally:
+        inf.close()
 
 
 def is_alphanumeric(ch):
@@ -327,7 +686,8 @@ def lex_line(l: Lexer):
         l.skip_line()
         return lex_line
 
-    print(f"start with '{ch}' at {l.line}:{l.pos}")
+    if TRACE:
+        logger.debug(f"start with '{ch}' at {l.line}:{l.pos}")
 
     if ch == "(":
         # TODO lex_label
@@ -377,11 +737,12 @@ def lex_label(l: Lexer):
     if ch != ")":
         raise SyntaxError(f"unexpected label character '{ch}'", l.line, l.pos)
 
-    if l.symbol_table.has(label) and l.symbol_table.get(label) != None:
+    if l.symbol_table.defined(label):
         raise SyntaxError(f"duplicate label '{label}'", l.line, l.pos)
 
     l.symbol_table.put(label, len(l.ins))
-    print(f"(LABEL) {label}")
+    if TRACE:
+        logger.debug(f"(LABEL) {label}")
 
     return lex_end_line
 
@@ -402,13 +763,14 @@ def lex_a_ins(l: Lexer):
     if "0" <= ch and ch <= "9":
         l.accept_r(r"\d")
         token = l._push_tok(TOK_NUMBER)
-        l.ins.append(InstructionA(token.line, l.tokens, token.value, token.value))
+        l.ins.append(InstructionA(token.line, token.pos, None, int(token.value)))
 
         # trail and check end line
         # l.accept(" \t")
         # if l.next() != '\n':
         #     raise SyntaxError(f"A-instruction: unexpected number '{l.input[l.start:l.pos]}'", l.line, l.pos)
-        print(f"(A) @{token.value}")
+        if TRACE:
+            logger.debug(f"(A) @{token.value}")
         return lex_end_line
 
     # symbol
@@ -416,14 +778,16 @@ def lex_a_ins(l: Lexer):
         l.accept_r(r"[\w_.$:]")
         # l.accept_r(r"\w")
         token = l._push_tok(TOK_SYMBOL)
-        l.ins.append(InstructionA(token.line, l.tokens, token.value, None))
-        l.symbol_table.put(token.value, None)
+        symbol = sys.intern(token.value)
+        l.ins.append(InstructionA(token.line, token.pos, symbol, None))
+        l.refer(l.ins[-1])
 
         # trail and check end line
         # l.accept(" \t")
         # if l.next() != '\n':
         #     raise SyntaxError(f"A-instruction: unexpected symbol '{l.input[l.start:l.pos]}'", l.line, l.pos)
-        print(f"(A) @{token.value}")
+        if TRACE:
+            logger.debug(f"(A) @{token.value}")
         return lex_end_line
 
     raise SyntaxError(
@@ -442,7 +806,7 @@ def lex_c_ins(l: Lexer):
     # dest part
     if l.peek() == "=":
         token = l._push_tok(TOK_DEST)
-        dest = token.value
+        dest = sys.intern(token.value)
         l.next()
         l._push_tok(TOK_ASSIGN)
 
@@ -456,7 +820,7 @@ def lex_c_ins(l: Lexer):
             l.pos,
         )
     token = l._push_tok(TOK_COMP)
-    comp = token.value
+    comp = sys.intern(token.value)
 
     # check if has jmp part
     if l.peek() == ";":
@@ -464,40 +828,339 @@ def lex_c_ins(l: Lexer):
         l._push_tok(TOK_SEMICOLON)
         l.accept(r"[JGEQLTNMP]")
         token = l._push_tok(TOK_JMP)
-        jump = token.value
+        jump = sys.intern(token.value)
 
-    l.ins.append(InstructionC(l.line, l.tokens, dest, comp, jump))
+    l.ins.append(InstructionC(l.line, dest, comp, jump))
 
     # trail and check end line
     # l.accept(" \t")
     # if l.next() != '\n':
     #     raise SyntaxError(f"C-instruction: unexpected format '{l.input[l.start:l.pos]}'", l.line, l.pos)
-    print(f"(C) {dest}={comp};{jump}")
+    if TRACE:
+        logger.debug(f"(C) {dest}={comp};{jump}")
 
     return lex_end_line
 
 
+# one whole line (without its '\n') in a single match, the same grammar the
+# char lexer above accepts: blank, comment, label, A- or C-instruction.
+_line_re = re.compile(
+    r"[ \t]*(?:"
+    r"(?P<at>@)(?:(?P<number>[0-9]\d*)|(?P<symbol>[A-Za-z_][\w.$:]*))"
+    r"|\((?P<label>[A-Za-z_][\w.$:]*)\)"
+    r"|(?:(?P<dest>[AMD]*)(?P<assign>=))?(?P<comp>[AMD+\-&|!01]+)"
+    r"(?:(?P<semicolon>;)(?P<jump>[\[\]JGEQLTNMP]*))?"
+    r")?[ \t]*(?://.*)?"
+)
+
+
+def lex_line_table(l: Lexer):
+    if l.pos >= l.input_len:
+        return None
+
+    end = l.input.find("\n", l.pos)
+    if end < 0:
+        # last line without '\n', let the char lexer report it
+        return lex_line_char(l)
+
+    m = _line_re.fullmatch(l.input, l.pos, end)
+    if m is None:
+        # not a valid line, the char lexer gives the exact diagnostic
+        return lex_line_char(l)
+
+    label = m.group("label")
+    if label != None:
+        if l.symbol_table.defined(label):
+            return lex_line_char(l)
+        l.symbol_table.put(label, len(l.ins))
+        if TRACE:
+            logger.debug(f"(LABEL) {label}")
+    else:
+        ins = _match_ins(m, l.line)
+        if ins != None:
+            l.ins.append(ins)
+            if ins.type == INS_A and ins.address == None:
+                l.refer(ins)
+
+    l.pos = l.start = end + 1
+    l.line += 1
+
+    return lex_line_table
+
+
+# the instruction of a line matched by _line_re, None for a blank or label
+# line. offset is added to token positions when m matched a single line.
+def _match_ins(m, line, offset=0):
+    if m.start("at") >= 0:
+        number = m.group("number")
+        if number != None:
+            if TRACE:
+                logger.debug(f"(A) @{number}")
+            return InstructionA(line, offset + m.start("number"), None, int(number))
+
+        symbol = sys.intern(m.group("symbol"))
+        if TRACE:
+            logger.debug(f"(A) @{symbol}")
+        return InstructionA(line, offset + m.start("symbol"), symbol, None)
+
+    if m.start("comp") >= 0:
+        dest = m.group("dest")
+        if dest != None:
+            dest = sys.intern(dest)
+        comp = sys.intern(m.group("comp"))
+        jump = m.group("jump")
+        if jump != None:
+            jump = sys.intern(jump)
+        if TRACE:
+            logger.debug(f"(C) {dest}={comp};{jump}")
+        return InstructionC(line, dest, comp, jump)
+
+    return None
+
+
+# lex exactly one line with the char lexer, then continue table driven
+def lex_line_char(l: Lexer):
+    lex_fn = lex_line(l)
+    while lex_fn != None and lex_fn != lex_line:
+        lex_fn = lex_fn(l)
+
+    if lex_fn == None:
+        return None
+
+    return lex_line_table
+
+
+LEXERS = {
+    "table": lex_line_table,
+    "char": lex_line,
+}
+
+# words buffered by the streaming assembler before each write
+STREAM_CHUNK = 4096
+
+
+# streaming assembler, memory grows with the number of symbols instead of the
+# program length: pass one only records label addresses, pass two re-reads
+# the source and writes every word out as soon as it is encoded, see main.
+# pass one returns the number of instructions. it also interns the
+# symbols of the A-instructions, so the variables get their registers
+# before pass two
+def stream_labels(asm_file, symbol_table) -> int:
+    count = 0
+    for line, pos, raw, m in _stream_lines(asm_file, symbol_table):
+        label = m.group("label")
+        if label != None:
+            if symbol_table.defined(label):
+                _check_line(raw, line, pos, symbol_table)
+            symbol_table.put(label, count)
+            if TRACE:
+                logger.debug(f"(LABEL) {label}")
+        elif m.start("at") >= 0 or m.start("comp") >= 0:
+            if m.group("symbol") != None:
+                symbol_table.intern(sys.intern(m.group("symbol")))
+            count += 1
+    symbol_table.resolve()
+
+    return count
+
+
+# pass two, returns the number of words written
+def stream_encode(
+    asm_file, outf, symbol_table, format="text", byteorder="little"
+) -> int:
+    count = 0
+    words = array("H")
+    for line, pos, raw, m in _stream_lines(asm_file, symbol_table):
+        ins = _match_ins(m, line, pos)
+        if ins == None:
+            continue
+
+        ins.relocate(symbol_table)
+        words.append(ins.to_int())
+
+        if len(words) >= STREAM_CHUNK:
+            _write_words(outf, words, format, byteorder)
+            count += len(words)
+            words = array("H")
+
+    _write_words(outf, words, format, byteorder)
+
+    return count + len(words)
+
+
+def _write_words(outf, words, format, byteorder):
+    if format == "binary":
+        write_rom(outf, words, byteorder)
+    else:
+        write_hack(outf, words)
+
+
+# yields (line, pos, raw line, match) for every line of the file
+def _stream_lines(asm_file, symbol_table):
+    inf = open(asm_file, "r")
+    try:
+        line = 1
+        pos = 0
+        for raw in inf:
+            m = None
+            if raw.endswith("\n"):
+                m = _line_re.fullmatch(raw, 0, len(raw) - 1)
+
+            if m != None:
+                yield line, pos, raw, m
+            else:
+                _check_line(raw, line, pos, symbol_table)
+
+            line += 1
+            pos += len(raw)
+    finally:
+        inf.close()
+
+
+# char-lex one line the table regex rejected, raising its exact error with
+# line:pos of the whole file. a blank last line without '\n' passes.
+def _check_line(raw, line, pos, symbol_table):
+    l = Lexer(raw, lex_line, symbol_table)
+    try:
+        l.run()
+    except LexerError as e:
+        e.line += line - 1
+        e.pos += pos
+        raise
+
+
 def main():
-    asm_file = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Hack assembler")
+    parser.add_argument("asm_file")
+    parser.add_argument("-o", "--output", dest="hack_file")
+    parser.add_argument(
+        "--lexer",
+        choices=LEXERS.keys(),
+        default="table",
+        help="table: one regex match per line (default), char: char by char",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["text", "binary"],
+        default="text",
+        help="text: '0'/'1' lines (default), binary: packed 16-bit rom image",
+    )
+    parser.add_argument(
+        "--byteorder",
+        choices=["little", "big"],
+        default="little",
+        help="word byte order of the binary format",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help="-v: info, -vv: trace every token and instruction",
+    )
+    parser.add_argument(
+        "--timing",
+        action="store_true",
+        help="print time spent per phase to stderr",
+    )
+    parser.add_argument(
+        "--source-map",
+        nargs="?",
+        const="",
+        metavar="MAP_FILE",
+        help="write the ROM address -> asm line -> vm command map, "
+        "by default next to the output as .map",
+    )
+    parser.add_argument(
+        "--symbol-map",
+        metavar="SYM_FILE",
+        help="write every symbol with its address and kind "
+        "(predefined, label, variable)",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="read the source twice line by line instead of holding it in memory",
+    )
+    args = parser.parse_args()
+    set_verbosity(args.verbose)
+    timer = PhaseTimer()
+    if args.stream and args.source_map != None:
+        parser.error(
+            "--source-map needs the source in memory, it cannot be used with --stream"
+        )
 
+    asm_file = args.asm_file
     hack_file = (
         asm_file.replace(".asm", ".hack")
         if asm_file.endswith(".asm")
         else (asm_file + ".hack")
     )
-    if len(sys.argv) > 2:
-        hack_file = sys.argv[3]
-
-    inf = open(asm_file, "r")
-    input = inf.read()
-    inf.close()
-    symbol_table = SymbolTable()
-    l = Lexer(input, lex_line, symbol_table)
-    l.run()
-    print(symbol_table._symbols)
-    outf = open(hack_file, "w")
-    l.assemble(outf)
-    outf.close()
+    if args.hack_file:
+        hack_file = args.hack_file
+
+    logger.info(f"assembling {asm_file} -> {hack_file}")
+    if args.stream:
+        symbol_table = SymbolTable()
+        outf = open(hack_file, "wb" if args.format == "binary" else "w")
+        with timer.phase("labels"):
+            stream_labels(asm_file, symbol_table)
+        with timer.phase("encode"):
+            count = stream_encode(
+                asm_file, outf, symbol_table, args.format, args.byteorder
+            )
+        outf.close()
+        if args.symbol_map:
+            outf = open(args.symbol_map, "w")
+            symbol_table.write_map(outf)
+            outf.close()
+
+        logger.info(f"{count} instructions")
+        if args.timing:
+            print(timer.summary(), file=sys.stderr)
+        return
+
+    with timer.phase("lex"):
+        inf = open(asm_file, "r")
+        input = inf.read()
+        inf.close()
+        symbol_table = SymbolTable()
+        l = Lexer(input, LEXERS[args.lexer], symbol_table)
+        l.run()
+
+    with timer.phase("relocate"):
+        l.relocate()
+    if TRACE:
+        logger.debug(f"symbols {dict(symbol_table.items())}")
+
+    with timer.phase("encode"):
+        words = l.encode()
+
+    with timer.phase("write"):
+        if args.format == "binary":
+            outf = open(hack_file, "wb")
+            write_rom(outf, words, args.byteorder)
+        else:
+            outf = open(hack_file, "w")
+            write_hack(outf, words)
+        outf.close()
+
+    if args.symbol_map:
+        outf = open(args.symbol_map, "w")
+        symbol_table.write_map(outf)
+        outf.close()
+
+    if args.source_map != None:
+        map_file = args.source_map or os.path.splitext(hack_file)[0] + ".map"
+        with timer.phase("source map"):
+            outf = open(map_file, "w")
+            write_source_map(outf, l.ins, input)
+            outf.close()
+        logger.info(f"source map {map_file}")
+
+    logger.info(f"{len(words)} instructions")
+    if args.timing:
+        print(timer.summary(), file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,129 @@
+import argparse
+import time
+import tracemalloc
+
+import assembler
+
+# a slice of typical vm translator output: push/pop, compare, call
+_BLOCK = """\
+//{n}: push local 2
+@LCL
+D=M
+@2
+A=D+A
+D=M
+@SP
+A=M
+M=D
+@SP
+M=M+1
+A=M
+
+//{n}: eq
+@SP
+M=M-1
+A=M
+D=M
+@SP
+A=M-1
+D=M-D
+M=-1
+@EQ_END.CMP__{n}
+D;JEQ
+@SP
+A=M-1
+M=0
+(EQ_END.CMP__{n})
+
+//{n}: pop static 3
+@SP
+M=M-1
+A=M
+D=M
+@Bench.3
+M=D
+@LOOP.{n}
+0;JMP
+(LOOP.{n})
+"""
+
+
+def generate(lines):
+    chunks = []
+    n = 0
+    count = 0
+    block_lines = _BLOCK.count("\n")
+    while count < lines:
+        chunks.append(_BLOCK.format(n=n))
+        count += block_lines
+        n += 1
+
+    return "".join(chunks), count
+
+
+def lex(input, lex_start):
+    l = assembler.Lexer(input, lex_start, assembler.SymbolTable())
+    l.run()
+
+    return l
+
+
+def bench(input, lex_start, repeat):
+    best = None
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        lex(input, lex_start)
+        elapsed = time.perf_counter() - begin
+        if best == None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+# bytes held by the lexed program (instructions and symbols) per instruction
+def memory(input, lex_start):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    l = lex(input, lex_start)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return (after - before) / len(l.ins), len(l.ins)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="assembler lexer benchmark")
+    parser.add_argument("asm_file", nargs="?", help="benchmark this file instead")
+    parser.add_argument("--lines", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--memory", action="store_true", help="measure memory per instruction"
+    )
+    args = parser.parse_args()
+
+    if args.asm_file:
+        inf = open(args.asm_file, "r")
+        input = inf.read()
+        inf.close()
+        lines = input.count("\n")
+    else:
+        input, lines = generate(args.lines)
+
+    print(f"{lines} lines")
+    if args.memory:
+        for name, lex_start in assembler.LEXERS.items():
+            per_ins, count = memory(input, lex_start)
+            print(f"{name:>6}: {count} instructions {per_ins:8.1f} bytes/instruction")
+        return
+
+    results = {}
+    for name, lex_start in assembler.LEXERS.items():
+        elapsed = bench(input, lex_start, args.repeat)
+        results[name] = elapsed
+        print(f"{name:>6}: {elapsed:8.3f}s {lines / elapsed:12.0f} lines/sec")
+
+    print(f"speedup: {results['char'] / results['table']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+# usage: assembly/lexcheck.sh [file.asm ...]
+# assembles every .asm given, test.asm and test1.asm by default, with the
+# table lexer, the char lexer and --stream and checks that the three agree
+# on the words and on the symbol map
+set -e
+
+dir=$(dirname "$0")
+if [ $# = 0 ]; then
+    set -- "$dir/test.asm" "$dir/test1.asm"
+fi
+
+tmp=$(mktemp -d)
+trap 'rm -rf "$tmp"' EXIT
+
+status=0
+for asm in "$@"; do
+    name=$(basename "$asm" .asm)
+    python3 "$dir/assembler.py" "$asm" -o "$tmp/$name.table.hack" --lexer table --symbol-map "$tmp/$name.table.sym"
+    python3 "$dir/assembler.py" "$asm" -o "$tmp/$name.char.hack" --lexer char --symbol-map "$tmp/$name.char.sym"
+    python3 "$dir/assembler.py" "$asm" -o "$tmp/$name.stream.hack" --stream --symbol-map "$tmp/$name.stream.sym"
+    for lexer in char stream; do
+        for out in hack sym; do
+            if ! cmp -s "$tmp/$name.table.$out" "$tmp/$name.$lexer.$out"; then
+                echo "$asm: $lexer .$out differs from table" >&2
+                status=1
+            fi
+        done
+    done
+done
+
+exit $status
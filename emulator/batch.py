@@ -0,0 +1,219 @@
+import argparse
+import random
+import sys
+
+import numpy as np
+
+import emulator
+
+# larger than any ROM address, for lanes that take no part in a step
+_NO_PC = 1 << 30
+
+
+# runs one ROM over many lanes, each lane with its own A, D, pc and RAM.
+# a step executes the instruction at the lowest pc of the running lanes,
+# on every lane that is at that pc, so lanes that branched apart line up
+# again when their paths meet. a lane stops at the halt loop, when its pc
+# leaves the ROM or after max_cycles of its own instructions.
+# ram_size trims the RAM of every lane for programs that only use the low
+# addresses; an access above it raises IndexError
+class BatchCPU:
+    def __init__(self, rom, lanes, ram_size=emulator.MEM_SIZE):
+        self.rom = rom
+        self.code = emulator.decode(rom)
+        self.halts = frozenset(
+            pc + 1 for pc in range(len(rom)) if emulator.halt_address(rom, pc)
+        )
+        self.lanes = lanes
+        self.ram = np.zeros((lanes, ram_size), dtype=np.uint16)
+        self.reset()
+
+    def reset(self):
+        lanes = self.lanes
+        # signed and wider than 16 bits so the ALU expressions keep python's
+        # ~ and + semantics
+        self.a = np.zeros(lanes, dtype=np.int32)
+        self.d = np.zeros(lanes, dtype=np.int32)
+        self.pc = np.zeros(lanes, dtype=np.int32)
+        self.cycles = np.zeros(lanes, dtype=np.int64)
+        self.halted = np.zeros(lanes, dtype=bool)
+
+    # returns the number of steps, each of them ran one instruction on one
+    # or more lanes. the lane instruction total is cycles.sum()
+    def run(self, max_cycles=None, stop_at_halt=True) -> int:
+        code = self.code
+        size = len(code)
+        halts = self.halts if stop_at_halt else ()
+        ram = self.ram
+        a, d, pc, cycles, halted = self.a, self.d, self.pc, self.cycles, self.halted
+        limit = max_cycles if max_cycles != None else -1
+        all_lanes = np.arange(self.lanes)
+
+        steps = 0
+        while True:
+            running = ~halted & (pc < size)
+            if limit != -1:
+                running &= cycles < limit
+            current = np.where(running, pc, _NO_PC)
+            at = int(current.min())
+            if at == _NO_PC:
+                break
+            on = current == at
+            if on.all():
+                # registers as views, no gather and scatter
+                lanes = slice(None)
+                rows = all_lanes
+            else:
+                lanes = rows = np.flatnonzero(on)
+            steps += 1
+            cycles[lanes] += 1
+
+            fn, x, taken, uses_m = code[at]
+            if fn == None:
+                a[lanes] = x
+                pc[lanes] = at + 1
+                continue
+
+            a_on = a[lanes]
+            if x & emulator.DEST_A:
+                a_on = a_on.copy()
+            address = a_on & emulator.ADDR_MASK
+            m = ram[rows, address].astype(np.int32) if uses_m else 0
+            out = fn(a_on, d[lanes], m)
+            out = np.broadcast_to(out, a_on.shape)
+            if x & emulator.DEST_M:
+                ram[rows, address] = out
+            if x & emulator.DEST_D:
+                d[lanes] = out
+            if x & emulator.DEST_A:
+                a[lanes] = out
+
+            if taken == None:
+                pc[lanes] = at + 1
+                continue
+            if at in halts:
+                halted[lanes] = True
+                continue
+            zero, positive, negative = taken
+            jump = np.zeros(out.shape, dtype=bool)
+            if zero:
+                jump |= out == 0
+            if positive:
+                jump |= (out != 0) & (out < 0x8000)
+            if negative:
+                jump |= out >= 0x8000
+            # the jump goes to A as it was before this instruction
+            pc[lanes] = np.where(jump, a_on, at + 1)
+
+        return steps
+
+
+def parse_lane(line):
+    return [emulator.parse_poke(poke) for poke in line.split()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hack CPU emulator, many lanes at once")
+    parser.add_argument("rom_file", help=".hack text or binary rom image")
+    parser.add_argument(
+        "--format",
+        choices=["text", "binary"],
+        help="rom format, by default text for .hack files and binary otherwise",
+    )
+    parser.add_argument(
+        "--byteorder",
+        choices=["little", "big"],
+        default="little",
+        help="word byte order of the binary format",
+    )
+    parser.add_argument(
+        "--inputs",
+        help="one lane per line of ADDR=VALUE pairs set before running",
+    )
+    parser.add_argument(
+        "--lanes",
+        type=int,
+        help="number of lanes, by default one per --inputs line",
+    )
+    parser.add_argument(
+        "--random",
+        action="append",
+        default=[],
+        metavar="ADDR[:COUNT]",
+        help="fill RAM[ADDR..ADDR+COUNT) of every lane with random values",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--ram-size",
+        type=int,
+        default=emulator.MEM_SIZE,
+        help="RAM words per lane, lower it for many lanes of small programs",
+    )
+    parser.add_argument(
+        "-n",
+        "--cycles",
+        type=int,
+        help="stop each lane after this many instructions",
+    )
+    parser.add_argument(
+        "--no-halt",
+        action="store_true",
+        help="keep running in the final (END) @END 0;JMP loop",
+    )
+    parser.add_argument(
+        "--dump",
+        action="append",
+        default=[],
+        metavar="ADDR[:COUNT]",
+        help="print RAM[ADDR..ADDR+COUNT) of every lane after running",
+    )
+    parser.add_argument(
+        "--timing",
+        action="store_true",
+        help="print run time and lane instructions per second to stderr",
+    )
+    args = parser.parse_args()
+    timer = emulator.assembler.PhaseTimer()
+
+    inputs = []
+    if args.inputs:
+        inf = open(args.inputs, "r")
+        inputs = [parse_lane(line) for line in inf if line.strip()]
+        inf.close()
+    lanes = args.lanes if args.lanes != None else max(len(inputs), 1)
+
+    with timer.phase("load"):
+        rom = emulator.load_rom(args.rom_file, args.format, args.byteorder)
+        cpu = BatchCPU(rom, lanes, args.ram_size)
+    rnd = random.Random(args.seed)
+    for spec in args.random:
+        start, count = emulator.parse_range(spec)
+        for address in range(start, start + count):
+            cpu.ram[:, address] = [rnd.randrange(0x10000) for _ in range(lanes)]
+    for lane, pokes in enumerate(inputs[:lanes]):
+        for address, value in pokes:
+            cpu.ram[lane, address] = value
+
+    with timer.phase("run"):
+        steps = cpu.run(args.cycles, not args.no_halt)
+
+    for lane in range(lanes):
+        values = []
+        for dump in args.dump:
+            start, count = emulator.parse_range(dump)
+            for address in range(start, start + count):
+                values.append(f"RAM[{address}]={cpu.ram[lane, address]}")
+        if values:
+            print(f"{lane}: {' '.join(values)}")
+
+    if args.timing:
+        print(timer.summary(), file=sys.stderr)
+        total = int(cpu.cycles.sum())
+        elapsed = timer.phases["run"]
+        print(f"{lanes} lanes, {steps} steps, {total} lane instructions", file=sys.stderr)
+        if elapsed > 0:
+            print(f"{total / elapsed / 1e6:.2f} M lane instructions/sec", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
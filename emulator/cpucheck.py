@@ -0,0 +1,160 @@
+import argparse
+import random
+import sys
+from array import array
+
+import emulator
+
+# the budget of the chunked BlockCPU run, odd so the chunks end inside blocks
+CHUNK = 37
+
+
+# the state every engine has to leave the same
+def cpu_state(cpu) -> tuple:
+    return cpu.a, cpu.d, cpu.pc, cpu.cycles, cpu.halted
+
+
+# the state of one BatchCPU lane, in the form of cpu_state
+def lane_state(batch, lane) -> tuple:
+    return (
+        int(batch.a[lane]),
+        int(batch.d[lane]),
+        int(batch.pc[lane]),
+        int(batch.cycles[lane]),
+        bool(batch.halted[lane]),
+    )
+
+
+def first_difference(ram, other):
+    return next(i for i in range(emulator.MEM_SIZE) if ram[i] != other[i])
+
+
+# runs one lane's RAM on CPU, on BlockCPU in one run and in CHUNK cycle runs,
+# and returns the [message] of the engines that end in another state and
+# the CPU, for the BatchCPU lanes to be compared with
+def check_lane(rom, ram, max_cycles, stop_at_halt):
+    cpu = emulator.CPU(rom, array("H", ram))
+    cpu.run(max_cycles, stop_at_halt)
+
+    block = emulator.BlockCPU(rom, array("H", ram))
+    block.run(max_cycles, stop_at_halt)
+
+    chunked = emulator.BlockCPU(rom, array("H", ram))
+    while chunked.cycles < max_cycles and not chunked.halted:
+        if chunked.run(min(CHUNK, max_cycles - chunked.cycles), stop_at_halt) == 0:
+            break
+
+    errors = []
+    for name, other in (("BlockCPU", block), (f"BlockCPU by {CHUNK}", chunked)):
+        if cpu_state(other) != cpu_state(cpu):
+            errors.append(
+                f"{name} left (A, D, pc, cycles, halted)={cpu_state(other)}, CPU {cpu_state(cpu)}"
+            )
+        elif other.ram != cpu.ram:
+            address = first_difference(other.ram, cpu.ram)
+            errors.append(f"{name} left RAM[{address}]={other.ram[address]}, CPU {cpu.ram[address]}")
+
+    return errors, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="checks that BlockCPU and BatchCPU run a rom the way CPU does"
+    )
+    parser.add_argument("rom_files", nargs="+", help=".hack text or binary rom images")
+    parser.add_argument(
+        "--lanes",
+        type=int,
+        default=8,
+        help="RAM images per rom. lane 0 only has the --set values",
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="ADDR=VALUE",
+        help="set RAM[ADDR] of every lane before running, repeatable",
+    )
+    parser.add_argument(
+        "--random",
+        action="append",
+        default=[],
+        metavar="ADDR[:COUNT]",
+        help="fill RAM[ADDR..ADDR+COUNT) of the lanes after lane 0 with random values",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "-n",
+        "--cycles",
+        type=int,
+        default=100000,
+        help="stop each run after this many instructions",
+    )
+    parser.add_argument(
+        "--no-halt",
+        action="store_true",
+        help="keep running in the final (END) @END 0;JMP loop",
+    )
+    args = parser.parse_args()
+
+    try:
+        import batch
+    except ImportError:
+        batch = None
+        print("numpy is not installed, BatchCPU is not checked", file=sys.stderr)
+
+    rnd = random.Random(args.seed)
+    stop_at_halt = not args.no_halt
+    failed = False
+    for rom_file in args.rom_files:
+        rom = emulator.load_rom(rom_file)
+        rams = []
+        for lane in range(args.lanes):
+            ram = array("H", bytes(2 * emulator.MEM_SIZE))
+            for poke in args.set:
+                address, value = emulator.parse_poke(poke)
+                ram[address] = value
+            for spec in args.random if lane > 0 else ():
+                start, count = emulator.parse_range(spec)
+                for address in range(start, start + count):
+                    ram[address] = rnd.randrange(0x10000)
+            rams.append(ram)
+
+        errors = []
+        cpus = []
+        for lane, ram in enumerate(rams):
+            lane_errors, cpu = check_lane(rom, ram, args.cycles, stop_at_halt)
+            errors.extend(f"lane {lane}: {error}" for error in lane_errors)
+            cpus.append(cpu)
+
+        if batch != None:
+            lanes = batch.BatchCPU(rom, args.lanes)
+            for lane, ram in enumerate(rams):
+                lanes.ram[lane] = ram
+            lanes.run(args.cycles, stop_at_halt)
+            for lane, cpu in enumerate(cpus):
+                state = lane_state(lanes, lane)
+                if state != cpu_state(cpu):
+                    errors.append(
+                        f"lane {lane}: BatchCPU left (A, D, pc, cycles, halted)={state}, "
+                        f"CPU {cpu_state(cpu)}"
+                    )
+                elif list(lanes.ram[lane]) != list(cpu.ram):
+                    address = first_difference(lanes.ram[lane], cpu.ram)
+                    errors.append(
+                        f"lane {lane}: BatchCPU left RAM[{address}]={lanes.ram[lane, address]}, "
+                        f"CPU {cpu.ram[address]}"
+                    )
+
+        for error in errors:
+            print(f"{rom_file}: {error}", file=sys.stderr)
+        cycles = sum(cpu.cycles for cpu in cpus)
+        print(f"{rom_file}: {args.lanes} lanes, {cycles} instructions, {len(errors)} differences")
+        failed = failed or len(errors) > 0
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,828 @@
+import argparse
+import logging
+import os
+import struct
+import sys
+import zlib
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "assembly"))
+
+import assembler
+
+logger = logging.getLogger("emulator")
+
+# checked before any per-instruction message is built. set by set_verbosity
+TRACE = False
+
+# memory map
+MEM_SIZE = 32768
+SCREEN = 16384
+SCREEN_SIZE = 8192
+KBD = 24576
+
+# the screen is 256 rows of 32 words, the low bit of a word is its leftmost
+# pixel and 1 is black
+SCREEN_ROWS = 256
+SCREEN_COLS = 512
+ROW_WORDS = 32
+
+# the memory chip only sees the low 15 bits of A
+ADDR_MASK = 0x7FFF
+
+
+# 0: warnings only, 1: info, 2: trace
+def set_verbosity(verbosity):
+    global TRACE
+
+    logger.setLevel(assembler.logging_level(verbosity))
+    TRACE = verbosity >= 2
+
+
+class EmulatorError(Exception):
+    def __init__(self, message, pc):
+        super().__init__(message, pc)
+        self.message = message
+        self.pc = pc
+
+    def __str__(self):
+        return f"{self.message}. pc={self.pc}"
+
+
+# python expression of the ALU output for the given control bits zx nx zy ny
+# f no, with y being "a" or "m". exact for every bit pattern, including the
+# ones the assembler has no mnemonic for
+def _alu_expr(control, y):
+    zx, nx, zy, ny, f, no = [(control >> (5 - i)) & 1 for i in range(6)]
+    x = "0" if zx else "d"
+    if nx:
+        x = f"~{x}"
+    if zy:
+        y = "0"
+    if ny:
+        y = f"~{y}"
+    out = f"({x} + {y})" if f else f"({x} & {y})"
+    if no:
+        out = f"~{out}"
+
+    return out
+
+
+# a-bit and c1..c6 -> python expression of the 16-bit result in terms of the
+# a, d and m locals. the assembler's mnemonics give the readable form, the
+# rest falls back to the raw ALU expression
+COMP_EXPRS = {}
+for _comp, _code in assembler._comp_codes.items():
+    _bits = int(_code, 2)
+    if _bits not in COMP_EXPRS:
+        COMP_EXPRS[_bits] = f"({_comp.lower().replace('!', '~')}) & 0xFFFF"
+for _bits in range(128):
+    if _bits not in COMP_EXPRS:
+        _y = "m" if _bits & 0x40 else "a"
+        COMP_EXPRS[_bits] = f"({_alu_expr(_bits & 0x3F, _y)}) & 0xFFFF"
+
+_comp_fns = {
+    bits: eval(f"lambda a, d, m: {expr}") for bits, expr in COMP_EXPRS.items()
+}
+
+# jump bits -> taken for a zero, positive and negative result
+JUMP_TAKEN = [
+    None if j == 0 else (bool(j & 2), bool(j & 1), bool(j & 4)) for j in range(8)
+]
+
+# jump bits -> python condition on the 16-bit result out
+JUMP_CONDS = [
+    None,
+    "0 < out < 0x8000",
+    "out == 0",
+    "out < 0x8000",
+    "out >= 0x8000",
+    "out != 0",
+    "out == 0 or out >= 0x8000",
+    "True",
+]
+
+# dest bits
+DEST_M = 1
+DEST_D = 2
+DEST_A = 4
+
+
+# one entry per ROM word:
+#   A-instruction: (None, value, None, False)
+#   C-instruction: (comp_fn, dest, taken, uses_m)
+# taken is None when the instruction never jumps
+def decode(words) -> list:
+    code = []
+    for word in words:
+        if not word & 0x8000:
+            code.append((None, word, None, False))
+            continue
+        comp = (word >> 6) & 0x7F
+        code.append(
+            (_comp_fns[comp], (word >> 3) & 7, JUMP_TAKEN[word & 7], bool(comp & 0x40))
+        )
+
+    return code
+
+
+# the usual end of a Hack program, "(END) @END 0;JMP": an A-instruction
+# loading its own address followed by an unconditional jump
+def halt_address(words, pc):
+    return (
+        pc + 1 < len(words)
+        and words[pc] == pc
+        and words[pc + 1] & 0xE007 == 0xE007
+    )
+
+
+def load_rom(path, format=None, byteorder="little"):
+    if format == None:
+        format = "text" if path.endswith(".hack") else "binary"
+    if format == "text":
+        return assembler.read_hack(path)
+
+    return assembler.read_rom(path, byteorder)
+
+
+class CPU:
+    __slots__ = ("rom", "code", "halts", "ram", "a", "d", "pc", "cycles", "halted", "on_jump")
+
+    def __init__(self, rom, ram=None):
+        self.rom = rom
+        self.code = decode(rom)
+        # addresses of the jumps of halt loops
+        self.halts = frozenset(pc + 1 for pc in range(len(rom)) if halt_address(rom, pc))
+        self.ram = array("H", bytes(2 * MEM_SIZE)) if ram == None else ram
+        # CPU.run calls on_jump(pc, target, cycles) for every jump taken,
+        # except the halt loop's, cycles counting the jump. BlockCPU does
+        # not. see profiler.ProfileCPU
+        self.on_jump = None
+        self.reset()
+
+    def reset(self):
+        self.a = 0
+        self.d = 0
+        self.pc = 0
+        self.cycles = 0
+        self.halted = False
+
+    # runs at most max_cycles instructions (all of them when None), stops
+    # early at the halt loop when stop_at_halt is set or when the pc leaves
+    # the ROM. returns the number of instructions executed
+    def run(self, max_cycles=None, stop_at_halt=True) -> int:
+        code = self.code
+        ram = self.ram
+        size = len(code)
+        a, d, pc = self.a, self.d, self.pc
+        limit = max_cycles if max_cycles != None else -1
+        halts = self.halts if stop_at_halt else ()
+        on_jump = self.on_jump
+
+        n = 0
+        try:
+            while n != limit:
+                fn, x, taken, uses_m = code[pc]
+                n += 1
+                if fn == None:
+                    a = x
+                    pc += 1
+                    continue
+
+                out = fn(a, d, ram[a & ADDR_MASK] if uses_m else 0)
+                if x:
+                    if x & DEST_M:
+                        ram[a & ADDR_MASK] = out
+                    if x & DEST_D:
+                        d = out
+                if taken != None and taken[0 if out == 0 else (2 if out & 0x8000 else 1)]:
+                    if pc in halts:
+                        if x & DEST_A:
+                            a = out
+                        self.halted = True
+                        break
+                    if on_jump != None:
+                        on_jump(pc, a, self.cycles + n)
+                    # the jump goes to A as it was before this instruction
+                    pc = a
+                else:
+                    pc += 1
+                if x & DEST_A:
+                    a = out
+        except IndexError:
+            if pc < size:
+                raise
+        finally:
+            self.a, self.d, self.pc = a, d, pc
+            self.cycles += n
+
+        return n
+
+    def step(self) -> int:
+        return self.run(1, False)
+
+
+# runs the ROM as basic blocks compiled to python functions. a block starts
+# at any address the program reaches and ends with its first jumping
+# instruction or at the end of the ROM, see block_source. blocks are
+# compiled on first entry and cached by start address. with check set every
+# block is replayed on the interpreter and the state compared
+class BlockCPU(CPU):
+    __slots__ = ("blocks", "check", "shadow")
+
+    def __init__(self, rom, ram=None, check=False):
+        super().__init__(rom, ram)
+        # start address -> (function, length, end address, ends in halt jump)
+        self.blocks = [None] * len(rom)
+        self.check = check
+        self.shadow = None
+
+    def compile(self, start):
+        source, length, end = block_source(self.rom, start)
+        if TRACE:
+            logger.debug(f"block {start}..{end}:\n{source}")
+        namespace = {}
+        exec(compile(source, f"<block {start}>", "exec"), namespace)
+        block = (namespace[f"block_{start}"], length, end, end in self.halts)
+        self.blocks[start] = block
+
+        return block
+
+    def run(self, max_cycles=None, stop_at_halt=True) -> int:
+        blocks = self.blocks
+        ram = self.ram
+        size = len(blocks)
+        a, d, pc = self.a, self.d, self.pc
+        limit = max_cycles if max_cycles != None else -1
+        if self.check:
+            self.sync_shadow()
+
+        n = 0
+        halted = False
+        while pc < size:
+            block = blocks[pc]
+            if block == None:
+                block = self.compile(pc)
+            fn, length, end, halt = block
+            if limit != -1 and n + length > limit:
+                break
+
+            start = pc
+            if halt and stop_at_halt:
+                # once through, the jump is the end of the program
+                pc, a, d, cycles = fn(ram, a, d, length)
+                halted = True
+                pc = end
+            else:
+                budget = limit - n if limit != -1 else sys.maxsize
+                pc, a, d, cycles = fn(ram, a, d, budget)
+            n += cycles
+            if self.check:
+                self.check_block(start, cycles, a, d, pc, stop_at_halt)
+            if halted:
+                self.halted = True
+                break
+
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles += n
+        if limit != -1 and n < limit and pc < size and not halted:
+            # the rest of the budget is shorter than the next block
+            n += CPU.run(self, limit - n, stop_at_halt)
+            if self.check:
+                self.sync_shadow()
+
+        return n
+
+    def sync_shadow(self):
+        if self.shadow == None:
+            self.shadow = CPU(self.rom, array("H", self.ram))
+        shadow = self.shadow
+        shadow.ram[:] = self.ram
+        shadow.a, shadow.d, shadow.pc = self.a, self.d, self.pc
+        shadow.halted = self.halted
+
+    def check_block(self, start, cycles, a, d, pc, stop_at_halt):
+        shadow = self.shadow
+        n = shadow.run(cycles, stop_at_halt)
+        if n != cycles:
+            raise EmulatorError(f"block ran {cycles} cycles, interpreter {n}", start)
+        if (shadow.a, shadow.d, shadow.pc) != (a, d, pc):
+            raise EmulatorError(
+                f"block left A={a} D={d} pc={pc}, "
+                f"interpreter A={shadow.a} D={shadow.d} pc={shadow.pc}",
+                start,
+            )
+        if shadow.ram != self.ram:
+            address = next(i for i in range(MEM_SIZE) if shadow.ram[i] != self.ram[i])
+            raise EmulatorError(
+                f"block left RAM[{address}]={self.ram[address]}, "
+                f"interpreter {shadow.ram[address]}",
+                start,
+            )
+
+
+# python source of the block starting at start, its length and the address
+# of its last instruction. the function takes (ram, a, d, budget) and
+# returns (next pc, a, d, cycles). the address of M is folded into a
+# constant when A was loaded by an A-instruction earlier in the block. a
+# block jumping back to its own start runs as a while loop inside the
+# function, for as long as the cycle budget allows
+def block_source(rom, start):
+    body = []
+    exits = []
+    loop = False
+    known_a = None
+    pc = start
+    while True:
+        word = rom[pc]
+        if not word & 0x8000:
+            body.append(f"a = {word}")
+            known_a = word
+            if pc + 1 == len(rom):
+                exits.append(f"return {pc + 1}, a, d, n")
+                break
+            pc += 1
+            continue
+
+        comp = (word >> 6) & 0x7F
+        dest = (word >> 3) & 7
+        jump = word & 7
+        address = "a & 0x7FFF" if known_a == None else str(known_a & ADDR_MASK)
+        target = "a" if known_a == None else str(known_a)
+        expr = COMP_EXPRS[comp]
+        if comp & 0x40:
+            body.append(f"m = ram[{address}]")
+
+        if jump == 0 and dest in (DEST_D, DEST_A):
+            body.append(f"{'d' if dest == DEST_D else 'a'} = {expr}")
+        elif jump != 0 or dest != 0:
+            body.append(f"out = {expr}")
+            if dest & DEST_M:
+                body.append(f"ram[{address}] = out")
+            if dest & DEST_D:
+                body.append("d = out")
+            if jump != 0 and dest & DEST_A and known_a == None:
+                # the jump goes to A as it was before this instruction
+                body.append("target = a")
+                target = "target"
+            if dest & DEST_A:
+                body.append("a = out")
+        if dest & DEST_A:
+            known_a = None
+
+        if jump != 0:
+            loop = target == str(start)
+            taken = [f"return {target}, a, d, n"]
+            if loop:
+                taken = [
+                    f"if n + {pc - start + 1} > budget:",
+                    f"    return {target}, a, d, n",
+                    "continue",
+                ]
+            if jump == 7:
+                exits.extend(taken)
+            else:
+                exits.append(f"if {JUMP_CONDS[jump]}:")
+                exits.extend("    " + line for line in taken)
+                exits.append(f"return {pc + 1}, a, d, n")
+            break
+        if pc + 1 == len(rom):
+            exits.append(f"return {pc + 1}, a, d, n")
+            break
+        pc += 1
+
+    length = pc - start + 1
+    lines = [f"def block_{start}(ram, a, d, budget):"]
+    if loop:
+        lines.append("    n = 0")
+        lines.append("    while True:")
+        lines.append(f"        n += {length}")
+        lines.extend("        " + line for line in body + exits)
+    else:
+        lines.append(f"    n = {length}")
+        lines.extend("    " + line for line in body + exits)
+
+    return "\n".join(lines) + "\n", length, pc
+
+
+ENGINES = {
+    "interp": CPU,
+    "jit": BlockCPU,
+}
+
+
+# single steps through the program logging every instruction, for -vv
+def trace(cpu, max_cycles=None, stop_at_halt=True) -> int:
+    n = 0
+    while n != max_cycles and cpu.pc < len(cpu.code) and not cpu.halted:
+        pc = cpu.pc
+        word = cpu.rom[pc]
+        n += cpu.run(1, stop_at_halt)
+        logger.debug(f"{pc:5}: {word:016b} A={cpu.a} D={cpu.d} -> pc={cpu.pc}")
+
+    return n
+
+
+def parse_poke(text):
+    address, value = text.split("=")
+    return int(address, 0), int(value, 0) & 0xFFFF
+
+
+def parse_range(text):
+    if ":" in text:
+        start, count = text.split(":")
+        return int(start, 0), int(count, 0)
+
+    return int(text, 0), 1
+
+
+# the screen region of the RAM. view() and bitmap() share the RAM, the
+# emulator's writes show in them without copying. dirty_rows() compares
+# the rows with a snapshot taken at the previous call, which costs an 8K
+# word compare per frame instead of a check on every RAM write
+class Screen:
+    __slots__ = ("ram", "words", "last")
+
+    def __init__(self, ram):
+        self.ram = ram
+        self.words = memoryview(ram)[SCREEN : SCREEN + SCREEN_SIZE]
+        # no snapshot yet: every row is dirty
+        self.last = None
+
+    def view(self) -> memoryview:
+        return self.words
+
+    # the screen words as a (256, 32) uint16 NumPy array, no copy
+    def bitmap(self):
+        import numpy as np
+
+        return np.frombuffer(self.words, dtype=np.uint16).reshape(SCREEN_ROWS, ROW_WORDS)
+
+    # (256, 512) uint8 NumPy array of 0 and 1 pixels, a copy
+    def pixels(self):
+        import numpy as np
+
+        words = self.bitmap().astype("<u2")
+        return np.unpackbits(words.view(np.uint8), axis=1, bitorder="little")
+
+    # row bytes in little endian order, whatever the machine's
+    def row_bytes(self, row) -> bytes:
+        words = self.words[row * ROW_WORDS : (row + 1) * ROW_WORDS]
+        if sys.byteorder == "little":
+            return words.tobytes()
+        swapped = array("H", words)
+        swapped.byteswap()
+        return swapped.tobytes()
+
+    # rows changed since the previous call, all of them on the first call
+    def dirty_rows(self) -> list:
+        current = self.words.cast("B")
+        last = self.last
+        self.last = bytes(current)
+        if last == None:
+            return list(range(SCREEN_ROWS))
+        size = 2 * ROW_WORDS
+        return [
+            row for row in range(SCREEN_ROWS)
+            if current[row * size : (row + 1) * size] != last[row * size : (row + 1) * size]
+        ]
+
+
+# bits of every byte in reverse order, pixel 0 moves to the high bit where
+# PBM and PNG keep it
+_REVERSE = bytes(int(format(b, "08b")[::-1], 2) for b in range(256))
+# the same for PNG grayscale, where 1 is white
+_REVERSE_INVERT = bytes(b ^ 0xFF for b in _REVERSE)
+
+
+def _braille_table():
+    # the dot of the braille cell for pixel x (0, 1) of cell row y (0..3)
+    dots = [[0x01, 0x08], [0x02, 0x10], [0x04, 0x20], [0x40, 0x80]]
+    table = []
+    for y in range(4):
+        rows = []
+        for b in range(256):
+            cells = [0, 0, 0, 0]
+            for bit in range(8):
+                if b >> bit & 1:
+                    cells[bit // 2] |= dots[y][bit & 1]
+            rows.append(cells)
+        table.append(rows)
+    return table
+
+
+# row of a braille cell -> screen byte -> dots of its 4 cells
+_BRAILLE = _braille_table()
+
+
+# encodes frames of a Screen, caching the encoded rows so that a frame only
+# re-encodes the rows written since the previous one
+#   pbm:  binary P4 bitmap
+#   png:  1-bit grayscale, compressed again as a whole each frame
+#   term: braille cells, 2x4 pixels per character, returned as the escape
+#         sequences redrawing the changed lines only
+class FrameWriter:
+    __slots__ = ("screen", "format", "rows", "frames", "encoded")
+
+    def __init__(self, screen, format="pbm"):
+        if format not in FRAME_FORMATS:
+            raise ValueError(f"unknown frame format {format}")
+        self.screen = screen
+        self.format = format
+        self.rows = [None] * SCREEN_ROWS
+        self.frames = 0
+        # rows re-encoded over all frames
+        self.encoded = 0
+
+    def frame(self):
+        dirty = self.screen.dirty_rows()
+        self.frames += 1
+        self.encoded += len(dirty)
+        if TRACE:
+            logger.debug(f"frame {self.frames}: {len(dirty)} dirty rows")
+        if self.format == "term":
+            return self._term(dirty)
+
+        table = _REVERSE if self.format == "pbm" else _REVERSE_INVERT
+        for row in dirty:
+            self.rows[row] = self.screen.row_bytes(row).translate(table)
+        if self.format == "pbm":
+            return b"P4\n%d %d\n" % (SCREEN_COLS, SCREEN_ROWS) + b"".join(self.rows)
+        return _png(b"".join(b"\x00" + row for row in self.rows))
+
+    def _term(self, dirty) -> str:
+        lines = sorted(set(row // 4 for row in dirty))
+        out = ["\x1b[2J"] if self.frames == 1 else []
+        for line in lines:
+            cells = [0x2800] * (SCREEN_COLS // 2)
+            for y in range(4):
+                data = self.screen.row_bytes(line * 4 + y)
+                table = _BRAILLE[y]
+                for i, b in enumerate(data):
+                    if b:
+                        dots = table[b]
+                        base = 4 * i
+                        cells[base] |= dots[0]
+                        cells[base + 1] |= dots[1]
+                        cells[base + 2] |= dots[2]
+                        cells[base + 3] |= dots[3]
+            self.rows[line] = "".join(map(chr, cells))
+            out.append(f"\x1b[{line + 1};1H{self.rows[line]}")
+        out.append(f"\x1b[{SCREEN_ROWS // 4 + 1};1H")
+        return "".join(out)
+
+
+FRAME_FORMATS = ("pbm", "png", "term")
+
+
+def _png_chunk(kind, data) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def _png(scanlines) -> bytes:
+    header = struct.pack(">IIBBBBB", SCREEN_COLS, SCREEN_ROWS, 1, 0, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + _png_chunk(b"IHDR", header)
+        + _png_chunk(b"IDAT", zlib.compress(scanlines))
+        + _png_chunk(b"IEND", b"")
+    )
+
+
+# codes of the keys that are not characters
+KEY_CODES = {
+    "space": 32,
+    "newline": 128,
+    "enter": 128,
+    "backspace": 129,
+    "left": 130,
+    "up": 131,
+    "right": 132,
+    "down": 133,
+    "home": 134,
+    "end": 135,
+    "pageup": 136,
+    "pagedown": 137,
+    "insert": 138,
+    "delete": 139,
+    "esc": 140,
+}
+for _n in range(1, 13):
+    KEY_CODES[f"f{_n}"] = 140 + _n
+
+
+# a single character is its character code, a name from KEY_CODES its code,
+# anything else a number. 0 or "none" releases the key
+def parse_key(text) -> int:
+    if len(text) == 1 and not text.isdigit():
+        return ord(text)
+    lower = text.lower()
+    if lower == "none":
+        return 0
+    if lower in KEY_CODES:
+        return KEY_CODES[lower]
+    return int(text, 0) & 0xFFFF
+
+
+# a keyboard script has one "CYCLE KEY" line per change of the keyboard
+# register, CYCLE counting instructions from the start of the run. # starts
+# a comment. returns [(cycle, code)] sorted by cycle
+def read_keys(path) -> list:
+    events = []
+    inf = open(path, "r")
+    for number, line in enumerate(inf, 1):
+        line = line.split("#")[0].strip()
+        if not line:
+            continue
+        words = line.split()
+        if len(words) != 2:
+            inf.close()
+            raise ValueError(f"{path}:{number}: expected CYCLE KEY, got {line}")
+        events.append((int(words[0], 0), parse_key(words[1])))
+    inf.close()
+    events.sort(key=lambda event: event[0])
+
+    return events
+
+
+# cpu.run with I/O: sets the keyboard register at the cycles of keys and
+# calls frame(cpu) every frame_every instructions. the run stops at the
+# same points as cpu.run. returns the number of instructions executed
+def run_io(cpu, max_cycles=None, stop_at_halt=True, keys=(), frame_every=None, frame=None) -> int:
+    n = 0
+    i = 0
+    next_frame = frame_every
+    while True:
+        while i < len(keys) and keys[i][0] <= n:
+            cpu.ram[KBD] = keys[i][1]
+            i += 1
+        if next_frame != None and n >= next_frame:
+            frame(cpu)
+            next_frame += frame_every
+        stops = [max_cycles]
+        if i < len(keys):
+            stops.append(keys[i][0])
+        stops.append(next_frame)
+        stops = [stop for stop in stops if stop != None]
+        budget = min(stops) - n if stops else None
+        if budget == 0:
+            break
+        done = cpu.run(budget, stop_at_halt)
+        n += done
+        if budget == None or done < budget or cpu.halted:
+            break
+
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hack CPU emulator")
+    parser.add_argument("rom_file", help=".hack text or binary rom image")
+    parser.add_argument(
+        "--format",
+        choices=["text", "binary"],
+        help="rom format, by default text for .hack files and binary otherwise",
+    )
+    parser.add_argument(
+        "--byteorder",
+        choices=["little", "big"],
+        default="little",
+        help="word byte order of the binary format",
+    )
+    parser.add_argument(
+        "-n",
+        "--cycles",
+        type=int,
+        help="stop after this many instructions",
+    )
+    parser.add_argument(
+        "--no-halt",
+        action="store_true",
+        help="keep running in the final (END) @END 0;JMP loop",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES.keys(),
+        default="interp",
+        help="interp: one decoded instruction per step (default), "
+        "jit: basic blocks compiled to python functions",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="run the jit engine and replay every block on the interpreter",
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="ADDR=VALUE",
+        help="set RAM[ADDR] before running, repeatable",
+    )
+    parser.add_argument(
+        "--dump",
+        action="append",
+        default=[],
+        metavar="ADDR[:COUNT]",
+        help="print RAM[ADDR..ADDR+COUNT) after running, repeatable",
+    )
+    parser.add_argument(
+        "--keys",
+        metavar="FILE",
+        help="keyboard script of CYCLE KEY lines, KEY a character, a key name or a code",
+    )
+    parser.add_argument(
+        "--frames",
+        metavar="FILE",
+        help="write the screen to FILE after the run, and every --frame-every "
+        "instructions. {n} in FILE numbers the frames, - draws them on the terminal",
+    )
+    parser.add_argument(
+        "--frame-format",
+        choices=FRAME_FORMATS,
+        help="by default from the --frames extension, pbm otherwise",
+    )
+    parser.add_argument(
+        "--frame-every",
+        type=int,
+        metavar="N",
+        help="dump a frame every N instructions",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help="-v: info, -vv: trace",
+    )
+    parser.add_argument(
+        "--timing",
+        action="store_true",
+        help="print load and run time and instructions per second to stderr",
+    )
+    args = parser.parse_args()
+    set_verbosity(args.verbose)
+    timer = assembler.PhaseTimer()
+
+    with timer.phase("load"):
+        rom = load_rom(args.rom_file, args.format, args.byteorder)
+    with timer.phase("decode"):
+        if args.check:
+            cpu = BlockCPU(rom, check=True)
+        else:
+            cpu = ENGINES[args.engine](rom)
+    for poke in args.set:
+        address, value = parse_poke(poke)
+        cpu.ram[address] = value
+
+    keys = read_keys(args.keys) if args.keys else []
+    writer = None
+    if args.frames:
+        format = args.frame_format
+        if format == None:
+            format = "term" if args.frames == "-" else os.path.splitext(args.frames)[1][1:]
+            if format not in FRAME_FORMATS:
+                format = "pbm"
+        writer = FrameWriter(Screen(cpu.ram), format)
+
+    def frame(cpu):
+        data = writer.frame()
+        if args.frames == "-":
+            if format == "term":
+                sys.stdout.write(data)
+            else:
+                sys.stdout.buffer.write(data)
+            sys.stdout.flush()
+            return
+        outf = open(args.frames.format(n=writer.frames), "w" if format == "term" else "wb")
+        outf.write(data)
+        outf.close()
+
+    logger.info(f"running {args.rom_file}, {len(rom)} instructions")
+    with timer.phase("run"):
+        if TRACE:
+            n = trace(cpu, args.cycles, not args.no_halt)
+        elif keys or args.frame_every:
+            n = run_io(cpu, args.cycles, not args.no_halt, keys, args.frame_every if writer else None, frame)
+        else:
+            n = cpu.run(args.cycles, not args.no_halt)
+    if writer != None:
+        frame(cpu)
+        logger.info(f"{writer.frames} frames, {writer.encoded} of {writer.frames * SCREEN_ROWS} rows encoded")
+
+    state = "halted" if cpu.halted else "stopped"
+    logger.info(f"{state} at pc={cpu.pc} after {n} cycles, A={cpu.a} D={cpu.d}")
+    for dump in args.dump:
+        start, count = parse_range(dump)
+        for address in range(start, start + count):
+            print(f"RAM[{address}] = {cpu.ram[address]}")
+
+    if args.timing:
+        print(timer.summary(), file=sys.stderr)
+        elapsed = timer.phases["run"]
+        if elapsed > 0:
+            print(f"{n / elapsed / 1e6:.2f} M instructions/sec", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
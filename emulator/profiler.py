@@ -0,0 +1,288 @@
+import argparse
+import sys
+
+import emulator
+
+# the function of the code outside any vm function, the bootstrap
+NO_FUNCTION = "(bootstrap)"
+
+
+# one source map entry per ROM address, see assembler.write_source_map
+class MapEntry:
+    __slots__ = ("asm_line", "file", "line", "function", "command")
+
+    def __init__(self, asm_line, file, line, function, command):
+        self.asm_line = asm_line
+        self.file = file
+        self.line = line
+        self.function = function
+        self.command = command
+
+    # the command word, with the segment of push and pop
+    def kind(self) -> str:
+        if self.command == None:
+            return "(asm)"
+        words = self.command.split()
+        if words[0] in ("push", "pop") and len(words) > 1:
+            return f"{words[0]} {words[1]}"
+        return words[0]
+
+
+def read_source_map(path) -> list:
+    entries = []
+    inf = open(path, "r")
+    for line in inf:
+        if line.startswith("#") or not line.strip():
+            continue
+        fields = [None if field == "-" else field for field in line.rstrip("\n").split("\t")]
+        address, asm_line, file, vm_line, function, command = fields
+        if int(address) != len(entries):
+            inf.close()
+            raise ValueError(f"{path}: address {address} out of order")
+        entries.append(MapEntry(int(asm_line), file, vm_line and int(vm_line), function, command))
+    inf.close()
+
+    return entries
+
+
+# the interpreter counting the cycles of every ROM address. between two
+# jumps the code runs straight, so the jumps the CPU reports through
+# on_jump give the runs of addresses executed, which are added to the
+# counts when run returns. jumps into the first instruction of a vm
+# function push a frame on a shadow call stack and jumps out of a return
+# command pop it, which gives the calls and the cycles spent under each
+# caller -> callee edge
+class ProfileCPU(emulator.CPU):
+    __slots__ = ("counts", "entries", "returns", "stack", "edges", "inclusive", "runs", "start", "start_cycle")
+
+    def __init__(self, rom, source_map, ram=None):
+        super().__init__(rom, ram)
+        self.counts = [0] * len(rom)
+        # entry address -> function. a function starts at its first
+        # address, even when the function command itself left no code
+        self.entries = {}
+        self.returns = set()
+        seen = set()
+        for address, entry in enumerate(source_map[: len(rom)]):
+            if entry.function != None and entry.function not in seen:
+                seen.add(entry.function)
+                self.entries[address] = entry.function
+            if entry.command == "return":
+                self.returns.add(address)
+        # [(function, caller, cycle of the call)]
+        self.stack = []
+        # (caller, callee) -> [calls, cycles]
+        self.edges = {}
+        # function -> cycles spent in it and in what it called
+        self.inclusive = {}
+        # (first address, length) -> times run, not yet in counts
+        self.runs = {}
+        # the straight run going on, from the address and cycle it began
+        self.start = self.pc
+        self.start_cycle = self.cycles
+        self.on_jump = self.jump
+
+    def run(self, max_cycles=None, stop_at_halt=True) -> int:
+        try:
+            return super().run(max_cycles, stop_at_halt)
+        finally:
+            self.straight(self.pc, self.cycles)
+            counts = self.counts
+            for (start, length), times in self.runs.items():
+                for address in range(start, start + length):
+                    counts[address] += times
+            self.runs.clear()
+
+    def jump(self, pc, target, now):
+        self.straight(target, now)
+        if pc in self.returns:
+            self.leave(now)
+        if target in self.entries:
+            self.enter(self.entries[target], now)
+
+    # ends the straight run at cycle now, the next one starts at address
+    def straight(self, address, now):
+        key = (self.start, now - self.start_cycle)
+        self.runs[key] = self.runs.get(key, 0) + 1
+        self.start = address
+        self.start_cycle = now
+
+    def enter(self, function, now):
+        caller = self.stack[-1][0] if self.stack else NO_FUNCTION
+        self.stack.append((function, caller, now))
+
+    def leave(self, now):
+        if not self.stack:
+            return
+        function, caller, start = self.stack.pop()
+        elapsed = now - start
+        edge = self.edges.setdefault((caller, function), [0, 0])
+        edge[0] += 1
+        edge[1] += elapsed
+        # a recursive call is already counted by its outermost frame
+        if all(frame[0] != function for frame in self.stack):
+            self.inclusive[function] = self.inclusive.get(function, 0) + elapsed
+
+    # closes the frames of the functions still running, Sys.init never
+    # returns
+    def finish(self):
+        while self.stack:
+            self.leave(self.cycles)
+
+
+class Profile:
+    def __init__(self, cpu, source_map):
+        self.total = cpu.cycles
+        self.functions = {}
+        self.kinds = {}
+        self.lines = {}
+        for address, count in enumerate(cpu.counts):
+            if count == 0:
+                continue
+            entry = source_map[address] if address < len(source_map) else MapEntry(0, None, None, None, None)
+            function = entry.function or NO_FUNCTION
+            self.functions[function] = self.functions.get(function, 0) + count
+            kind = entry.kind()
+            self.kinds[kind] = self.kinds.get(kind, 0) + count
+            where = (entry.file, entry.line, entry.command) if entry.file != None else (None, entry.asm_line, None)
+            self.lines[where] = self.lines.get(where, 0) + count
+        self.inclusive = cpu.inclusive
+        self.edges = cpu.edges
+        self.calls = {}
+        for (caller, callee), (calls, cycles) in self.edges.items():
+            self.calls[callee] = self.calls.get(callee, 0) + calls
+
+    def percent(self, cycles) -> str:
+        return f"{cycles / self.total * 100:6.2f}%" if self.total > 0 else "   -  %"
+
+    def flat(self, outf, top):
+        outf.write(f"flat profile, {self.total} cycles\n")
+        outf.write("    self          inclusive        calls  function\n")
+        for function, cycles in sorted(self.functions.items(), key=lambda item: -item[1])[:top]:
+            inclusive = self.inclusive.get(function, cycles)
+            outf.write(
+                f"{cycles:10} {self.percent(cycles)} {inclusive:10} {self.percent(inclusive)}"
+                f" {self.calls.get(function, 0):8}  {function}\n"
+            )
+
+        outf.write("\ncycles per vm command\n")
+        for kind, cycles in sorted(self.kinds.items(), key=lambda item: -item[1])[:top]:
+            outf.write(f"{cycles:10} {self.percent(cycles)}  {kind}\n")
+
+        outf.write("\nhottest vm lines\n")
+        for (file, line, command), cycles in sorted(self.lines.items(), key=lambda item: -item[1])[:top]:
+            where = f"{file}:{line}  {command}" if file != None else f"asm line {line}"
+            outf.write(f"{cycles:10} {self.percent(cycles)}  {where}\n")
+
+    # gprof style: every function with its callers above and callees below
+    def graph(self, outf, top):
+        outf.write("\ncall graph\n")
+        order = sorted(self.inclusive.items(), key=lambda item: -item[1])[:top]
+        for function, inclusive in order:
+            outf.write("\n")
+            for (caller, callee), (calls, cycles) in sorted(self.edges.items()):
+                if callee == function:
+                    outf.write(f"    {calls:8} calls {cycles:10}  from {caller}\n")
+            outf.write(
+                f"{inclusive:10} {self.percent(inclusive)}  {function}, "
+                f"{self.functions.get(function, 0)} self\n"
+            )
+            for (caller, callee), (calls, cycles) in sorted(self.edges.items(), key=lambda item: -item[1][1]):
+                if caller == function:
+                    outf.write(f"    {calls:8} calls {cycles:10}  to {callee}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hack CPU emulator profiler, cycles per vm function and command")
+    parser.add_argument("rom_file", help=".hack text or binary rom image")
+    parser.add_argument(
+        "--map",
+        dest="map_file",
+        help="source map written by assembler.py --source-map, by default the rom's name with .map",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["text", "binary"],
+        help="rom format, by default text for .hack files and binary otherwise",
+    )
+    parser.add_argument(
+        "--byteorder",
+        choices=["little", "big"],
+        default="little",
+        help="word byte order of the binary format",
+    )
+    parser.add_argument(
+        "-n",
+        "--cycles",
+        type=int,
+        help="stop after this many instructions",
+    )
+    parser.add_argument(
+        "--no-halt",
+        action="store_true",
+        help="keep running in the final (END) @END 0;JMP loop",
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="ADDR=VALUE",
+        help="set RAM[ADDR] before running, repeatable",
+    )
+    parser.add_argument(
+        "--keys",
+        metavar="FILE",
+        help="keyboard script of CYCLE KEY lines, see emulator.py",
+    )
+    parser.add_argument(
+        "--report",
+        choices=["flat", "graph", "all"],
+        default="all",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=20,
+        help="entries per table",
+    )
+    parser.add_argument(
+        "--timing",
+        action="store_true",
+        help="print load and run time to stderr",
+    )
+    args = parser.parse_args()
+    timer = emulator.assembler.PhaseTimer()
+
+    map_file = args.map_file
+    if map_file == None:
+        map_file = args.rom_file.rsplit(".", 1)[0] + ".map"
+    with timer.phase("load"):
+        rom = emulator.load_rom(args.rom_file, args.format, args.byteorder)
+        source_map = read_source_map(map_file)
+        if len(source_map) != len(rom):
+            print(
+                f"warning: {map_file} has {len(source_map)} addresses, the rom {len(rom)}",
+                file=sys.stderr,
+            )
+        cpu = ProfileCPU(rom, source_map)
+    for poke in args.set:
+        address, value = emulator.parse_poke(poke)
+        cpu.ram[address] = value
+
+    keys = emulator.read_keys(args.keys) if args.keys else []
+    with timer.phase("run"):
+        emulator.run_io(cpu, args.cycles, not args.no_halt, keys)
+    cpu.finish()
+
+    profile = Profile(cpu, source_map)
+    if args.report in ("flat", "all"):
+        profile.flat(sys.stdout, args.top)
+    if args.report in ("graph", "all"):
+        profile.graph(sys.stdout, args.top)
+
+    if args.timing:
+        print(timer.summary(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
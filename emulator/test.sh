@@ -0,0 +1,25 @@
+# usage: emulator/test.sh
+# runs assembly/test.hack and the roms of the vmtranslator samples with
+# cpucheck.py: BlockCPU and BatchCPU have to leave every lane's RAM and
+# registers as CPU does, from zeroed and from random RAM
+set -e
+
+dir=$(dirname "$0")
+vm="$dir/../vmtranslator"
+
+tmp=$(mktemp -d)
+trap 'rm -rf "$tmp"' EXIT
+
+python3 "$vm/vmtranslator.py" "$vm/samples/Arith.vm" --hack "$tmp/Arith.hack" 2> /dev/null
+python3 "$vm/vmtranslator.py" "$vm/samples/Fib" --hack "$tmp/Fib.hack" 2> /dev/null
+
+status=0
+# Fill, random keyboard words
+python3 "$dir/cpucheck.py" "$dir/../assembly/test.hack" --random 24576 --cycles 20000 || status=1
+# random segment pointers and stack after lane 0's
+python3 "$dir/cpucheck.py" "$tmp/Arith.hack" \
+    --set 0=256 --set 1=300 --set 2=400 --set 3=3000 --set 4=3010 \
+    --random 0:5 --random 256:16 || status=1
+python3 "$dir/cpucheck.py" "$tmp/Fib.hack" --random 256:16 || status=1
+
+exit $status
@@ -0,0 +1,1381 @@
+import argparse
+import glob
+import logging
+import os
+import re
+import sys
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "assembly"))
+
+import assembler
+
+logger = logging.getLogger("hdl")
+
+# directories searched for chips that are not next to the test script
+CPU_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cpu")
+
+# wires 0 and 1 are the constants false and true
+FALSE = 0
+TRUE = 1
+
+# gate ops of a compiled netlist
+OP_NAND = 1
+OP_NOT = 2
+OP_DEVICE = 3
+
+# generated lines per compiled function, keeps compile time and memory
+# reasonable for big netlists
+CHUNK = 4000
+
+# iterations of a script while loop before giving up on it
+WHILE_LIMIT = 100000
+
+TOK_IDENT = 1
+TOK_NUMBER = 2
+TOK_SYMBOL = 3
+
+
+# 0: warnings only, 1: info, 2: debug
+def set_verbosity(verbosity):
+    logger.setLevel(assembler.logging_level(verbosity))
+
+
+class HDLError(Exception):
+    def __init__(self, message, file=None, line=None):
+        super().__init__(message, file, line)
+        self.message = message
+        self.file = file
+        self.line = line
+
+    def __str__(self):
+        if self.file == None:
+            return self.message
+        if self.line == None:
+            return f"{self.message}. {self.file}"
+        return f"{self.message}. {self.file}:{self.line}"
+
+
+class Token:
+    __slots__ = ("type", "value", "line")
+
+    def __init__(self, type, value, line):
+        self.type = type
+        self.value = value
+        self.line = line
+
+    def __repr__(self) -> str:
+        return f"({self.type}, {self.value!r}, {self.line})"
+
+
+_token_re = re.compile(
+    r"""
+    (?P<space>\s+)
+    |(?P<comment>//[^\n]*|/\*.*?\*/)
+    |(?P<number>\d+)
+    |(?P<ident>[A-Za-z_][A-Za-z0-9_]*)
+    |(?P<symbol>\.\.|[{}()\[\],;:=])
+    """,
+    re.S | re.X,
+)
+
+
+def tokenize(input, file):
+    tokens = []
+    pos = 0
+    line = 1
+    while pos < len(input):
+        m = _token_re.match(input, pos)
+        if m == None:
+            raise HDLError(f"unexpected character {input[pos]!r}", file, line)
+        kind = m.lastgroup
+        if kind == "number":
+            tokens.append(Token(TOK_NUMBER, int(m.group()), line))
+        elif kind == "ident":
+            tokens.append(Token(TOK_IDENT, m.group(), line))
+        elif kind == "symbol":
+            tokens.append(Token(TOK_SYMBOL, m.group(), line))
+        line += m.group().count("\n")
+        pos = m.end()
+
+    return tokens
+
+
+class ChipDef:
+    __slots__ = ("name", "inputs", "outputs", "parts", "builtin", "clocked", "file")
+
+    def __init__(self, name, file):
+        self.name = name
+        self.file = file
+        # [(pin, width)]
+        self.inputs = []
+        self.outputs = []
+        self.parts = []
+        self.builtin = None
+        self.clocked = []
+
+    def pins(self) -> dict:
+        return dict(self.inputs + self.outputs)
+
+
+# pin[range]=signal[range] inside a part, ranges are (lo, hi) or None
+class Connection:
+    __slots__ = ("pin", "pin_range", "signal", "signal_range")
+
+    def __init__(self, pin, pin_range, signal, signal_range):
+        self.pin = pin
+        self.pin_range = pin_range
+        self.signal = signal
+        self.signal_range = signal_range
+
+
+class Part:
+    __slots__ = ("name", "connections", "line")
+
+    def __init__(self, name, connections, line):
+        self.name = name
+        self.connections = connections
+        self.line = line
+
+
+class Parser:
+    def __init__(self, input, file):
+        self.file = file
+        self.tokens = tokenize(input, file)
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def next(self):
+        tok = self.peek()
+        if tok == None:
+            line = self.tokens[-1].line if self.tokens else 1
+            raise HDLError("unexpected end of file", self.file, line)
+        self.pos += 1
+        return tok
+
+    def expect(self, type, value=None):
+        tok = self.next()
+        if tok.type != type or (value != None and tok.value != value):
+            want = repr(value) if value != None else "identifier" if type == TOK_IDENT else "number"
+            raise HDLError(f"expected {want}, got {tok.value!r}", self.file, tok.line)
+        return tok
+
+    def accept(self, value):
+        tok = self.peek()
+        if tok != None and tok.type != TOK_NUMBER and tok.value == value:
+            self.pos += 1
+            return True
+        return False
+
+    def chip(self) -> ChipDef:
+        self.expect(TOK_IDENT, "CHIP")
+        chip = ChipDef(self.expect(TOK_IDENT).value, self.file)
+        self.expect(TOK_SYMBOL, "{")
+        while True:
+            if self.accept("IN"):
+                chip.inputs.extend(self.pin_list())
+            elif self.accept("OUT"):
+                chip.outputs.extend(self.pin_list())
+            elif self.accept("PARTS"):
+                self.expect(TOK_SYMBOL, ":")
+            elif self.accept("BUILTIN"):
+                chip.builtin = self.expect(TOK_IDENT).value
+                self.expect(TOK_SYMBOL, ";")
+            elif self.accept("CLOCKED"):
+                chip.clocked.extend(name for name, _ in self.pin_list())
+            elif self.accept("}"):
+                break
+            else:
+                chip.parts.append(self.part())
+
+        return chip
+
+    def pin_list(self):
+        pins = []
+        while True:
+            name = self.expect(TOK_IDENT).value
+            width = 1
+            if self.accept("["):
+                width = self.expect(TOK_NUMBER).value
+                self.expect(TOK_SYMBOL, "]")
+            pins.append((name, width))
+            if self.accept(";"):
+                return pins
+            self.expect(TOK_SYMBOL, ",")
+
+    def part(self) -> Part:
+        tok = self.expect(TOK_IDENT)
+        self.expect(TOK_SYMBOL, "(")
+        connections = []
+        while True:
+            pin, pin_range = self.signal()
+            self.expect(TOK_SYMBOL, "=")
+            signal, signal_range = self.signal()
+            connections.append(Connection(pin, pin_range, signal, signal_range))
+            if self.accept(")"):
+                break
+            self.expect(TOK_SYMBOL, ",")
+        self.expect(TOK_SYMBOL, ";")
+
+        return Part(tok.value, connections, tok.line)
+
+    def signal(self):
+        name = self.expect(TOK_IDENT).value
+        if not self.accept("["):
+            return name, None
+        lo = self.expect(TOK_NUMBER).value
+        hi = lo
+        if self.accept(".."):
+            hi = self.expect(TOK_NUMBER).value
+        self.expect(TOK_SYMBOL, "]")
+
+        return name, (lo, hi)
+
+
+def parse(input, file) -> ChipDef:
+    return Parser(input, file).chip()
+
+
+# chips with no HDL of their own. Nand and DFF are the primitives of the
+# netlist, the memory devices are simulated behind their pins, and the CPU's
+# A and D registers are plain Registers
+BUILTIN_HDL = {
+    "Nand": "CHIP Nand { IN a, b; OUT out; BUILTIN Nand; }",
+    "DFF": "CHIP DFF { IN in; OUT out; BUILTIN DFF; CLOCKED in; }",
+    "ARegister": """CHIP ARegister { IN in[16], load; OUT out[16];
+        PARTS: Register(in=in, load=load, out=out); }""",
+    "DRegister": """CHIP DRegister { IN in[16], load; OUT out[16];
+        PARTS: Register(in=in, load=load, out=out); }""",
+    "ROM32K": "CHIP ROM32K { IN address[15]; OUT out[16]; BUILTIN ROM32K; }",
+    "Screen": """CHIP Screen { IN in[16], load, address[13]; OUT out[16];
+        BUILTIN Screen; CLOCKED in, load; }""",
+    "Keyboard": "CHIP Keyboard { OUT out[16]; BUILTIN Keyboard; }",
+}
+
+
+# the memory chips a part can be replaced with, unless the gate-level
+# version is asked for
+MODEL_HDL = {
+    "Register": """CHIP Register { IN in[16], load; OUT out[16];
+        BUILTIN Register; CLOCKED in, load; }""",
+    "ARegister": """CHIP ARegister { IN in[16], load; OUT out[16];
+        BUILTIN Register; CLOCKED in, load; }""",
+    "DRegister": """CHIP DRegister { IN in[16], load; OUT out[16];
+        BUILTIN Register; CLOCKED in, load; }""",
+    "PC": """CHIP PC { IN in[16], load, inc, reset; OUT out[16];
+        BUILTIN PC; CLOCKED in, load, inc, reset; }""",
+}
+for _bits, _name in [(3, "RAM8"), (6, "RAM64"), (9, "RAM512"), (12, "RAM4K"), (14, "RAM16K")]:
+    MODEL_HDL[_name] = f"""CHIP {_name} {{ IN in[16], load, address[{_bits}]; OUT out[16];
+        BUILTIN {_name}; CLOCKED in, load; }}"""
+
+# chips too large to simulate from their HDL: a gate-level RAM4K takes
+# 0.9 GB and a minute, RAM16K four times that
+GATE_LEVEL_LIMIT = ("RAM16K",)
+
+
+# finds chips by name along a list of directories, then among the builtins.
+# parsed chips are cached. with models set, parts that are one of the
+# MODEL_HDL chips are simulated by their model instead of their HDL
+class ChipLoader:
+    def __init__(self, path, models=True):
+        self.path = path
+        self.chips = {}
+        self.models = {} if models else None
+
+    def part(self, name, file=None, line=None) -> ChipDef:
+        if self.models == None or name not in MODEL_HDL:
+            return self.get(name, file, line)
+        model = self.models.get(name)
+        if model != None:
+            return model
+
+        model = parse(MODEL_HDL[name], f"<model {name}>")
+        try:
+            chip = self.get(name, file, line)
+        except HDLError:
+            chip = None
+        if chip != None and (chip.inputs, chip.outputs) != (model.inputs, model.outputs):
+            logger.warning(f"{chip.file} does not have the pins of {name}, not using its model")
+            model = chip
+        self.models[name] = model
+
+        return model
+
+    def get(self, name, file=None, line=None) -> ChipDef:
+        chip = self.chips.get(name)
+        if chip != None:
+            return chip
+        if self.models == None and name in GATE_LEVEL_LIMIT:
+            raise HDLError(f"{name} is too large to simulate gate level, it needs its model", file, line)
+
+        for dir in self.path:
+            hdl_file = os.path.join(dir, f"{name}.hdl")
+            if os.path.exists(hdl_file):
+                inf = open(hdl_file, "r")
+                input = inf.read()
+                inf.close()
+                chip = parse(input, hdl_file)
+                break
+        else:
+            if name not in BUILTIN_HDL:
+                raise HDLError(f"chip {name} not found", file, line)
+            chip = parse(BUILTIN_HDL[name], f"<builtin {name}>")
+
+        if chip.name != name:
+            raise HDLError(f"chip {name} is defined as {chip.name}", chip.file, 1)
+        logger.debug(f"loaded {name} from {chip.file}")
+        self.chips[name] = chip
+
+        return chip
+
+
+# the chip's directory, then every directory of the cpu/ projects
+def default_path(dir) -> list:
+    path = [dir]
+    for hdl_file in sorted(glob.glob(os.path.join(CPU_DIR, "**", "*.hdl"), recursive=True)):
+        hdl_dir = os.path.dirname(hdl_file)
+        if hdl_dir not in path and os.path.abspath(hdl_dir) != os.path.abspath(dir):
+            path.append(hdl_dir)
+
+    return path
+
+
+def _read_bus(v, nets) -> int:
+    value = 0
+    for i, net in enumerate(nets):
+        value |= (v[net] & 1) << i
+    return value
+
+
+def _write_bus(v, nets, value, mask):
+    for i, net in enumerate(nets):
+        v[net] = mask if (value >> i) & 1 else 0
+
+
+# a chip simulated behind its pins. eval computes the outputs from the
+# inputs listed in comb, tick samples the clocked inputs and tock commits
+# them. devices read and write lane 0
+class Device:
+    comb = ()
+
+    def __init__(self, name, pins):
+        self.name = name
+        # pin -> wires, nets after bind
+        self.pins = pins
+        self.mask = 1
+
+    def bind(self, resolve, mask):
+        self.pins = {pin: [resolve(w) for w in wires] for pin, wires in self.pins.items()}
+        self.mask = mask
+
+    def inputs(self) -> list:
+        return [net for pin in self.comb for net in self.pins[pin]]
+
+    def outputs(self) -> list:
+        return self.pins["out"]
+
+    def eval(self, v):
+        pass
+
+    def tick(self, v):
+        pass
+
+    def tock(self):
+        pass
+
+    # script access to Name[] and Name[index]
+    def get(self, index):
+        raise HDLError(f"{self.name}[{'' if index == None else index}] is not readable")
+
+    def set(self, index, value):
+        raise HDLError(f"{self.name}[{'' if index == None else index}] is not writable")
+
+
+class MemoryDevice(Device):
+    comb = ("address",)
+
+    def __init__(self, name, pins, size):
+        super().__init__(name, pins)
+        self.mem = array("H", bytes(2 * size))
+        self.pending = None
+
+    def eval(self, v):
+        _write_bus(v, self.pins["out"], self.mem[_read_bus(v, self.pins["address"])], self.mask)
+
+    def tick(self, v):
+        pins = self.pins
+        self.pending = None
+        if v[pins["load"][0]] & 1:
+            self.pending = (_read_bus(v, pins["address"]), _read_bus(v, pins["in"]))
+
+    def tock(self):
+        if self.pending != None:
+            address, value = self.pending
+            self.mem[address] = value
+            self.pending = None
+
+    # like the builtin memories, including a write loaded at the last tick
+    def get(self, index):
+        index = index if index != None else 0
+        if self.pending != None and self.pending[0] == index:
+            return self.pending[1]
+        return self.mem[index]
+
+    def set(self, index, value):
+        self.mem[index if index != None else 0] = value & 0xFFFF
+
+
+class ROMDevice(MemoryDevice):
+    def tick(self, v):
+        pass
+
+    def load(self, path):
+        words = assembler.read_hack(path)
+        self.mem[:] = array("H", bytes(len(self.mem) * 2))
+        self.mem[: len(words)] = words
+
+
+class KeyboardDevice(Device):
+    def __init__(self, name, pins):
+        super().__init__(name, pins)
+        self.key = 0
+
+    def eval(self, v):
+        _write_bus(v, self.pins["out"], self.key, self.mask)
+
+    def get(self, index):
+        return self.key
+
+    def set(self, index, value):
+        self.key = value & 0xFFFF
+
+
+class RegisterDevice(Device):
+    def __init__(self, name, pins):
+        super().__init__(name, pins)
+        self.value = 0
+        self.pending = None
+
+    def eval(self, v):
+        _write_bus(v, self.pins["out"], self.value, self.mask)
+
+    def tick(self, v):
+        self.pending = None
+        if v[self.pins["load"][0]] & 1:
+            self.pending = _read_bus(v, self.pins["in"])
+
+    def tock(self):
+        if self.pending != None:
+            self.value = self.pending
+            self.pending = None
+
+    # like the builtin registers, the value loaded at the last tick
+    def get(self, index):
+        return self.pending if self.pending != None else self.value
+
+    def set(self, index, value):
+        self.value = value & 0xFFFF
+        self.pending = None
+
+
+class PCDevice(RegisterDevice):
+    def tick(self, v):
+        pins = self.pins
+        if v[pins["reset"][0]] & 1:
+            self.pending = 0
+        elif v[pins["load"][0]] & 1:
+            self.pending = _read_bus(v, pins["in"])
+        elif v[pins["inc"][0]] & 1:
+            self.pending = (self.value + 1) & 0xFFFF
+        else:
+            self.pending = None
+
+
+DEVICES = {
+    "ROM32K": lambda name, pins: ROMDevice(name, pins, 32768),
+    "Screen": lambda name, pins: MemoryDevice(name, pins, 8192),
+    "Keyboard": KeyboardDevice,
+    "Register": RegisterDevice,
+    "PC": PCDevice,
+    "RAM8": lambda name, pins: MemoryDevice(name, pins, 8),
+    "RAM64": lambda name, pins: MemoryDevice(name, pins, 64),
+    "RAM512": lambda name, pins: MemoryDevice(name, pins, 512),
+    "RAM4K": lambda name, pins: MemoryDevice(name, pins, 4096),
+    "RAM16K": lambda name, pins: MemoryDevice(name, pins, 16384),
+}
+
+
+# a chip flattened down to Nand gates, DFFs and devices over single-bit
+# wires. connected wires are merged into nets with union-find
+class Netlist:
+    def __init__(self, loader, name):
+        self.loader = loader
+        self.name = name
+        self.parent = [FALSE, TRUE]
+        self.names = {}
+        # (a, b, out) and (in, out) wires
+        self.nands = []
+        self.dffs = []
+        self.devices = []
+        # chip name -> pins of its first part, for Name[] in scripts
+        self.parts = {}
+        # chips being instantiated, to report a chip that contains itself
+        self.stack = []
+
+        chip = loader.get(name)
+        self.chip = chip
+        self.pins = {}
+        for pin, width in chip.inputs + chip.outputs:
+            self.pins[pin] = self.wires(width, f"{name}.{pin}")
+        self.instantiate(chip, self.pins)
+
+    def wire(self) -> int:
+        self.parent.append(len(self.parent))
+        return len(self.parent) - 1
+
+    def wires(self, width, name=None) -> list:
+        wires = [self.wire() for _ in range(width)]
+        if name != None:
+            for i, w in enumerate(wires):
+                self.names[w] = f"{name}[{i}]" if width > 1 else name
+        return wires
+
+    def find(self, w) -> int:
+        parent = self.parent
+        while parent[w] != w:
+            parent[w] = parent[parent[w]]
+            w = parent[w]
+        return w
+
+    # the lower wire stays the root so the constants are always roots
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return
+        if b < a:
+            a, b = b, a
+        self.parent[b] = a
+        if a not in self.names and b in self.names:
+            self.names[a] = self.names[b]
+
+    def instantiate(self, chip, pins):
+        if chip.builtin == "Nand":
+            self.nands.append((pins["a"][0], pins["b"][0], pins["out"][0]))
+            return
+        if chip.builtin == "DFF":
+            self.dffs.append((pins["in"][0], pins["out"][0]))
+            return
+        if chip.builtin != None:
+            if chip.builtin not in DEVICES:
+                raise HDLError(f"unknown builtin {chip.builtin}", chip.file, 1)
+            self.devices.append(DEVICES[chip.builtin](chip.name, pins))
+            return
+
+        signals = {}
+        self.stack.append(chip.name)
+        for part in chip.parts:
+            part_chip = self.loader.part(part.name, chip.file, part.line)
+            if part_chip.name in self.stack:
+                cycle = " -> ".join(self.stack + [part_chip.name])
+                raise HDLError(f"{part.name} contains itself: {cycle}", chip.file, part.line)
+            widths = part_chip.pins()
+            part_pins = {pin: self.wires(width) for pin, width in widths.items()}
+            outputs = dict(part_chip.outputs)
+            for conn in part.connections:
+                if conn.pin not in part_pins:
+                    raise HDLError(f"{part.name} has no pin {conn.pin}", chip.file, part.line)
+                if conn.pin in outputs and conn.signal in ("true", "false"):
+                    # an output tied to a constant is left unconnected
+                    continue
+                bits = self.slice(part_pins[conn.pin], conn.pin_range, chip, part)
+                self.connect(bits, conn, pins, signals, chip, part)
+            self.instantiate(part_chip, part_pins)
+            self.parts.setdefault(part.name, part_pins)
+        self.stack.pop()
+
+    def slice(self, wires, range, chip, part) -> list:
+        if range == None:
+            return wires
+        lo, hi = range
+        if lo > hi or hi >= len(wires):
+            raise HDLError(f"bad sub-bus [{lo}..{hi}] of a {len(wires)} bit pin", chip.file, part.line)
+        return wires[lo : hi + 1]
+
+    def connect(self, bits, conn, pins, signals, chip, part):
+        if conn.signal in ("true", "false"):
+            constant = TRUE if conn.signal == "true" else FALSE
+            for w in bits:
+                self.union(w, constant)
+            return
+
+        if conn.signal in pins:
+            wires = self.slice(pins[conn.signal], conn.signal_range, chip, part)
+        else:
+            # internal signals take the width of what they connect to
+            wires = signals.get(conn.signal)
+            if wires == None:
+                wires = signals[conn.signal] = self.wires(0)
+            need = len(bits) if conn.signal_range == None else conn.signal_range[1] + 1
+            while len(wires) < need:
+                w = self.wire()
+                self.names[w] = f"{chip.name}.{conn.signal}"
+                wires.append(w)
+            if conn.signal_range == None:
+                wires = wires[: len(bits)]
+            else:
+                wires = self.slice(wires, conn.signal_range, chip, part)
+
+        if len(wires) != len(bits):
+            raise HDLError(
+                f"width mismatch, {conn.pin} is {len(bits)} bits, {conn.signal} is {len(wires)}",
+                chip.file,
+                part.line,
+            )
+        for a, b in zip(bits, wires):
+            self.union(a, b)
+
+
+# a netlist compiled to python functions over a list of net values. every
+# value holds one bit per lane, so up to lanes test vectors are evaluated
+# by the same integer ops at once. gates whose result is never needed are
+# dropped, gates with a constant input are folded
+class Simulator:
+    def __init__(self, netlist, lanes=1):
+        self.netlist = netlist
+        self.lanes = lanes
+        self.mask = mask = (1 << lanes) - 1
+
+        index = {FALSE: FALSE, TRUE: TRUE}
+
+        def resolve(w):
+            root = netlist.find(w)
+            net = index.get(root)
+            if net == None:
+                net = index[root] = len(index)
+            return net
+
+        self.resolve = resolve
+        self.pins = {pin: [resolve(w) for w in wires] for pin, wires in netlist.pins.items()}
+        self.inputs = {pin: self.pins[pin] for pin, _ in netlist.chip.inputs}
+        self.outputs = {pin: self.pins[pin] for pin, _ in netlist.chip.outputs}
+        self.parts = {}
+        for name, pins in netlist.parts.items():
+            self.parts[name] = {pin: [resolve(w) for w in wires] for pin, wires in pins.items()}
+        self.dff_in = [resolve(d) for d, _ in netlist.dffs]
+        self.dff_out = [resolve(q) for _, q in netlist.dffs]
+        self.nands = [(resolve(a), resolve(b), resolve(o)) for a, b, o in netlist.nands]
+        self.devices = netlist.devices
+        for dev in self.devices:
+            dev.bind(resolve, mask)
+
+        drivers = {}
+        for net in [net for nets in self.inputs.values() for net in nets] + self.dff_out:
+            self.drive(drivers, net, None)
+        for gate in self.nands:
+            self.drive(drivers, gate[2], gate)
+        for dev in self.devices:
+            for net in dev.outputs():
+                self.drive(drivers, net, dev)
+
+        self.v = [0] * len(index)
+        self.v[TRUE] = mask
+        self.ops, self.constants = self.schedule(drivers)
+        for net, value in self.constants.items():
+            self.v[net] = value
+        self.functions = self.compile(self.ops)
+        self.latched = [0] * len(self.dff_in)
+        self.dff_index = None
+
+    def drive(self, drivers, net, driver):
+        if net in drivers or net in (FALSE, TRUE):
+            raise HDLError(f"{self.name_of(net)} has more than one driver")
+        drivers[net] = driver
+
+    def name_of(self, net) -> str:
+        netlist = self.netlist
+        for w in range(len(netlist.parent)):
+            if self.resolve(w) == net and netlist.find(w) in netlist.names:
+                return netlist.names[netlist.find(w)]
+        return f"net {net}"
+
+    # gates in dependency order, from the outputs, the DFF inputs, the
+    # device inputs and the parts' out pins backwards
+    def schedule(self, drivers):
+        mask = self.mask
+        constants = {FALSE: 0, TRUE: mask}
+        needed = [net for nets in self.outputs.values() for net in nets]
+        needed += self.dff_in
+        for dev in self.devices:
+            needed += [net for nets in dev.pins.values() for net in nets]
+        for pins in self.parts.values():
+            needed += pins.get("out", [])
+
+        ops = []
+        done = set(constants)
+        done.update(net for nets in self.inputs.values() for net in nets)
+        done.update(self.dff_out)
+        emitted = set()
+        visiting = set()
+        for root in needed:
+            stack = [root]
+            while stack:
+                net = stack[-1]
+                if net in done:
+                    stack.pop()
+                    continue
+                driver = drivers.get(net)
+                if driver == None:
+                    # nothing drives it, reads as false
+                    constants[net] = 0
+                    done.add(net)
+                    stack.pop()
+                    continue
+                deps = driver[:2] if type(driver) == tuple else driver.inputs()
+                pending = [d for d in deps if d not in done]
+                if pending:
+                    if net in visiting:
+                        raise HDLError(f"combinational loop through {self.name_of(net)}")
+                    visiting.add(net)
+                    stack.extend(pending)
+                    continue
+                visiting.discard(net)
+                stack.pop()
+                done.add(net)
+                if type(driver) != tuple:
+                    if id(driver) not in emitted:
+                        emitted.add(id(driver))
+                        ops.append((OP_DEVICE, driver))
+                    continue
+
+                a, b, out = driver
+                ca = constants.get(a)
+                cb = constants.get(b)
+                if ca == 0 or cb == 0:
+                    constants[out] = mask
+                elif ca == mask and cb == mask:
+                    constants[out] = 0
+                elif ca == mask:
+                    ops.append((OP_NOT, b, out))
+                elif cb == mask or a == b:
+                    ops.append((OP_NOT, a, out))
+                else:
+                    ops.append((OP_NAND, a, b, out))
+
+        return ops, constants
+
+    def compile(self, ops) -> list:
+        namespace = {"M": self.mask}
+        functions = []
+        for start in range(0, len(ops), CHUNK):
+            lines = [f"def chunk_{start}(v):"]
+            for op in ops[start : start + CHUNK]:
+                if op[0] == OP_NAND:
+                    lines.append(f"    v[{op[3]}] = M ^ (v[{op[1]}] & v[{op[2]}])")
+                elif op[0] == OP_NOT:
+                    lines.append(f"    v[{op[2]}] = M ^ v[{op[1]}]")
+                else:
+                    name = f"dev_{len(namespace)}"
+                    namespace[name] = op[1]
+                    lines.append(f"    {name}.eval(v)")
+            source = "\n".join(lines) + "\n"
+            exec(compile(source, f"<netlist {self.netlist.name}>", "exec"), namespace)
+            functions.append(namespace[f"chunk_{start}"])
+
+        return functions
+
+    def gates(self) -> int:
+        return sum(1 for op in self.ops if op[0] != OP_DEVICE)
+
+    def eval(self):
+        v = self.v
+        for fn in self.functions:
+            fn(v)
+
+    def tick(self):
+        self.eval()
+        v = self.v
+        self.latched = [v[net] for net in self.dff_in]
+        for dev in self.devices:
+            dev.tick(v)
+
+    def tock(self):
+        v = self.v
+        for net, value in zip(self.dff_out, self.latched):
+            v[net] = value
+        for dev in self.devices:
+            dev.tock()
+        self.eval()
+
+    def get(self, pin) -> int:
+        return _read_bus(self.v, self.pins[pin])
+
+    def set(self, pin, value):
+        if pin not in self.inputs:
+            raise HDLError(f"{pin} is not an input pin of {self.netlist.name}")
+        _write_bus(self.v, self.inputs[pin], value, self.mask)
+
+    def device(self, name):
+        for dev in self.devices:
+            if dev.name == name:
+                return dev
+        return None
+
+    # Name[] or Name[index] of a part: a device's contents, or the out pins
+    # of a gate-level part. when they come straight from DFFs, the value the
+    # DFFs latched at the last tick, as the builtin registers show it
+    def get_part(self, name, index):
+        dev = self.device(name)
+        if dev != None:
+            return dev.get(index)
+        out = self.part_out(name, index)
+        latched = self.latched_bits(out)
+        if latched == None:
+            return _read_bus(self.v, out)
+        value = 0
+        for i, k in enumerate(latched):
+            value |= (self.latched[k] & 1) << i
+        return value
+
+    def set_part(self, name, index, value):
+        dev = self.device(name)
+        if dev != None:
+            dev.set(index, value)
+            return
+        out = self.part_out(name, index)
+        latched = self.latched_bits(out)
+        if latched == None:
+            raise HDLError(f"{name}[] is not a register")
+        _write_bus(self.v, out, value, self.mask)
+        for i, k in enumerate(latched):
+            self.latched[k] = self.v[out[i]]
+
+    def part_out(self, name, index) -> list:
+        pins = self.parts.get(name)
+        if pins == None or "out" not in pins:
+            raise HDLError(f"no part {name} in {self.netlist.name}")
+        if index != None:
+            raise HDLError(f"{name}[{index}] needs the builtin model of {name}")
+        return pins["out"]
+
+    # the DFF of every net, None unless all of them come from DFFs
+    def latched_bits(self, nets):
+        if self.dff_index == None:
+            self.dff_index = {net: k for k, net in enumerate(self.dff_out)}
+        latched = [self.dff_index.get(net) for net in nets]
+        if None in latched:
+            return None
+        return latched
+
+
+def build(loader, name, lanes=1) -> Simulator:
+    return Simulator(Netlist(loader, name), lanes)
+
+
+_script_token_re = re.compile(r'"[^"]*"|[{},;!]|[^\s{},;!"]+')
+_script_comment_re = re.compile(r"//[^\n]*|/\*.*?\*/", re.S)
+
+# name%Fl.w.r
+_column_re = re.compile(r"^(.+?)%([BDXS])(\d+)\.(\d+)\.(\d+)$")
+_part_re = re.compile(r"^(\w+)\[(\d*)\]$")
+
+
+def parse_script(input, file) -> list:
+    input = _script_comment_re.sub(" ", input)
+    tokens = _script_token_re.findall(input)
+    commands, pos = _script_block(tokens, 0, file, False)
+    return commands
+
+
+# commands are lists of words ended by , ; or !. repeat and while take a
+# braced block
+def _script_block(tokens, pos, file, nested):
+    commands = []
+    words = []
+    while pos < len(tokens):
+        tok = tokens[pos]
+        pos += 1
+        if tok in (",", ";", "!"):
+            if words:
+                commands.append(words)
+                words = []
+        elif tok == "{":
+            body, pos = _script_block(tokens, pos, file, True)
+            commands.append((words, body))
+            words = []
+        elif tok == "}":
+            if not nested:
+                raise HDLError("unbalanced }", file)
+            if words:
+                commands.append(words)
+            return commands, pos
+        else:
+            words.append(tok)
+    if nested:
+        raise HDLError("missing }", file)
+    if words:
+        commands.append(words)
+
+    return commands, pos
+
+
+def parse_value(text) -> int:
+    if text.startswith("%B"):
+        return int(text[2:], 2)
+    if text.startswith("%X"):
+        return int(text[2:], 16)
+    if text.startswith("%D"):
+        return int(text[2:])
+    return int(text)
+
+
+class Column:
+    __slots__ = ("name", "format", "left", "width", "right")
+
+    def __init__(self, spec):
+        m = _column_re.match(spec)
+        if m == None:
+            raise HDLError(f"bad output-list entry {spec}")
+        self.name = m.group(1)
+        self.format = m.group(2)
+        self.left = int(m.group(3))
+        self.width = int(m.group(4))
+        self.right = int(m.group(5))
+
+    def header(self) -> str:
+        total = self.left + self.width + self.right
+        name = self.name[:total]
+        left = (total - len(name)) // 2
+        return " " * left + name + " " * (total - left - len(name))
+
+    def cell(self, value, bits) -> str:
+        width = self.width
+        if self.format == "S":
+            text = str(value).ljust(width)[:width]
+        elif self.format == "B":
+            text = format(value & ((1 << width) - 1), f"0{width}b")
+        elif self.format == "X":
+            text = format(value & ((1 << (4 * width)) - 1), f"0{width}X")
+        else:
+            if bits == 16 and value & 0x8000:
+                value -= 0x10000
+            text = str(value).rjust(width)
+        return " " * self.left + text + " " * self.right
+
+
+# a comparison line matches when every character is equal or * in the
+# compare file
+def matches(line, expected) -> bool:
+    line = line.rstrip()
+    expected = expected.rstrip()
+    if len(line) != len(expected):
+        return False
+    return all(e == "*" or c == e for c, e in zip(line, expected))
+
+
+class ScriptResult:
+    __slots__ = ("script", "passed", "lines", "message", "output")
+
+    def __init__(self, script, passed, lines, message, output):
+        self.script = script
+        self.passed = passed
+        self.lines = lines
+        self.message = message
+        self.output = output
+
+
+# runs a .tst script against its chip and its .cmp file
+class TestScript:
+    def __init__(self, tst_file, path=None, sliced=True, models=True, keys=()):
+        self.file = tst_file
+        self.dir = os.path.dirname(tst_file) or "."
+        self.path = path if path != None else default_path(self.dir)
+        inf = open(tst_file, "r")
+        self.commands = parse_script(inf.read(), tst_file)
+        inf.close()
+        self.sim = None
+        self.loader = None
+        # files the script read besides its chips, see dependencies
+        self.files = [tst_file]
+        self.columns = []
+        self.output = []
+        self.expected = None
+        self.output_file = None
+        self.time = 0
+        self.half = False
+        self.failed = None
+        self.sliced = sliced
+        self.models = models
+        # held down on the Keyboard, one per while loop, for the scripts
+        # that wait for someone to press a key
+        self.keys = list(keys)
+
+    def run(self) -> ScriptResult:
+        try:
+            if not (self.sliced and self.run_sliced()):
+                self.execute(self.commands)
+        except CompareError:
+            pass
+        return ScriptResult(self.file, self.failed == None, len(self.output), self.failed, self.output)
+
+    def execute(self, commands):
+        for command in commands:
+            if type(command) == tuple:
+                words, body = command
+                self.block(words, body)
+            else:
+                self.command(command)
+
+    def block(self, words, body):
+        if words[0] == "repeat":
+            count = int(words[1]) if len(words) > 1 else None
+            n = 0
+            while count == None or n < count:
+                self.execute(body)
+                n += 1
+        elif words[0] == "while":
+            keyboard = self.sim.device("Keyboard")
+            if keyboard != None and self.keys:
+                keyboard.set(None, self.keys.pop(0))
+            n = 0
+            while self.condition(words[1:]):
+                if n == WHILE_LIMIT:
+                    raise HDLError(f"while {' '.join(words[1:])} still true after {n} loops", self.file)
+                self.execute(body)
+                n += 1
+        else:
+            raise HDLError(f"unknown block {words[0]}", self.file)
+
+    def condition(self, words) -> bool:
+        name, op, text = words
+        value = self.value(name)
+        if value & 0x8000:
+            value -= 0x10000
+        other = parse_value(text)
+        return {
+            "=": value == other,
+            "<>": value != other,
+            "<": value < other,
+            ">": value > other,
+            "<=": value <= other,
+            ">=": value >= other,
+        }[op]
+
+    def command(self, words):
+        name = words[0]
+        if name == "load":
+            self.load(words[1])
+        elif name == "output-file":
+            self.output_file = os.path.join(self.dir, words[1])
+        elif name == "compare-to":
+            self.files.append(os.path.join(self.dir, words[1]))
+            inf = open(os.path.join(self.dir, words[1]), "r")
+            self.expected = inf.read().splitlines()
+            inf.close()
+        elif name == "output-list":
+            self.columns = [Column(spec) for spec in words[1:]]
+            self.emit("|" + "|".join(column.header() for column in self.columns) + "|")
+        elif name == "set":
+            self.set(words[1], parse_value(words[2]))
+        elif name == "eval":
+            self.sim.eval()
+        elif name == "tick":
+            self.sim.tick()
+            self.half = True
+        elif name == "tock":
+            self.sim.tock()
+            self.time += 1
+            self.half = False
+        elif name == "ticktock":
+            self.command(["tick"])
+            self.command(["tock"])
+        elif name == "output":
+            cells = []
+            for column in self.columns:
+                value, bits = self.column_value(column.name)
+                cells.append(column.cell(value, bits))
+            self.emit("|" + "|".join(cells) + "|")
+        elif name in ("echo", "clear-echo"):
+            pass
+        elif len(words) == 3 and words[1] == "load":
+            dev = self.sim.device(name)
+            if dev == None or not hasattr(dev, "load"):
+                raise HDLError(f"no {name} to load {words[2]} into", self.file)
+            self.files.append(os.path.join(self.dir, words[2]))
+            dev.load(os.path.join(self.dir, words[2]))
+        else:
+            raise HDLError(f"unknown command {' '.join(words)}", self.file)
+
+    def load(self, name):
+        if not name.endswith(".hdl"):
+            raise HDLError(f"{name} is not a chip, only HDL scripts are supported", self.file)
+        self.loader = ChipLoader(self.path, self.models)
+        self.sim = build(self.loader, name[: -len(".hdl")])
+        logger.info(f"{name}: {self.sim.gates()} gates, {len(self.sim.dff_in)} DFFs")
+        self.sim.eval()
+
+    # a script that only sets the inputs of a combinational chip, evals and
+    # outputs runs as one eval: the inputs of every eval are packed into
+    # the bit lanes of the net values, one lane per eval. returns False,
+    # before any output, when the script or the chip does not allow it
+    def run_sliced(self) -> bool:
+        commands = _unroll(self.commands)
+        if commands == None or len(commands) == 0 or commands[0][0] != "load":
+            return False
+        name = commands[0][1]
+        if not name.endswith(".hdl"):
+            return False
+        self.loader = ChipLoader(self.path, self.models)
+        netlist = Netlist(self.loader, name[: -len(".hdl")])
+        if netlist.dffs or netlist.devices:
+            return False
+
+        chip = netlist.chip
+        widths = chip.pins()
+        inputs = {pin: 0 for pin, _ in chip.inputs}
+        # loading evaluates the chip once
+        lanes = [dict(inputs)]
+        lines = []
+        for words in commands[1:]:
+            command = words[0]
+            if command == "set":
+                pin, index = _split_pin(words[1])
+                if pin not in inputs:
+                    return False
+                value = parse_value(words[2])
+                if index != None:
+                    bit = 1 << index
+                    value = (inputs[pin] & ~bit) | (bit if value & 1 else 0)
+                inputs[pin] = value & ((1 << widths[pin]) - 1)
+            elif command == "eval":
+                lanes.append(dict(inputs))
+            elif command == "output-list":
+                columns = [Column(spec) for spec in words[1:]]
+                for column in columns:
+                    if column.name != "time" and _split_pin(column.name)[0] not in widths:
+                        return False
+                lines.append(("|" + "|".join(column.header() for column in columns) + "|", None, None))
+            elif command == "output":
+                lines.append((columns, dict(inputs), len(lanes) - 1))
+            elif command in ("output-file", "compare-to", "echo", "clear-echo"):
+                lines.append((words, None, None))
+            else:
+                return False
+
+        sim = Simulator(netlist, len(lanes))
+        v = sim.v
+        for pin, nets in sim.inputs.items():
+            for i, net in enumerate(nets):
+                word = 0
+                for lane, vector in enumerate(lanes):
+                    word |= ((vector[pin] >> i) & 1) << lane
+                v[net] = word
+        sim.eval()
+        logger.info(f"{name}: {sim.gates()} gates, {len(lanes)} vectors in one eval")
+
+        self.sim = sim
+        for entry, vector, lane in lines:
+            if type(entry) == str:
+                self.emit(entry)
+            elif vector == None:
+                self.command(entry)
+            else:
+                cells = []
+                for column in entry:
+                    pin, index = _split_pin(column.name)
+                    if column.name == "time":
+                        value = 0
+                    elif pin in inputs:
+                        value = vector[pin]
+                    else:
+                        value = 0
+                        for i, net in enumerate(sim.pins[pin]):
+                            value |= ((v[net] >> lane) & 1) << i
+                    bits = widths.get(pin, 0)
+                    if index != None:
+                        value = (value >> index) & 1
+                        bits = 1
+                    cells.append(column.cell(value, bits))
+                self.emit("|" + "|".join(cells) + "|")
+
+        return True
+
+    # every file the run read: the script, its compare file, loaded ROMs and
+    # the .hdl of each chip it used
+    def dependencies(self) -> list:
+        files = set(self.files)
+        if self.loader != None:
+            for chip in self.loader.chips.values():
+                if chip.file != None and os.path.exists(chip.file):
+                    files.add(chip.file)
+        return sorted(files)
+
+    def column_value(self, name):
+        if name == "time":
+            return f"{self.time}{'+' if self.half else ''}", 0
+        m = _part_re.match(name)
+        if m != None and m.group(1) not in self.sim.pins:
+            return self.value(name), 16
+        return self.value(name), len(self.sim.pins.get(name.split("[")[0], ()))
+
+    def value(self, name) -> int:
+        sim = self.sim
+        if name in sim.pins:
+            return sim.get(name)
+        m = _part_re.match(name)
+        if m == None:
+            raise HDLError(f"unknown pin {name}", self.file)
+        pin, index = m.group(1), m.group(2)
+        if pin in sim.pins:
+            return (sim.get(pin) >> int(index)) & 1
+        return sim.get_part(pin, int(index) if index else None)
+
+    def set(self, name, value):
+        sim = self.sim
+        if name in sim.pins:
+            sim.set(name, value)
+            return
+        m = _part_re.match(name)
+        if m == None:
+            raise HDLError(f"unknown pin {name}", self.file)
+        pin, index = m.group(1), m.group(2)
+        if pin in sim.pins:
+            bit = 1 << int(index)
+            sim.set(pin, (sim.get(pin) & ~bit) | (bit if value & 1 else 0))
+            return
+        sim.set_part(pin, int(index) if index else None, value)
+
+    def emit(self, line):
+        n = len(self.output)
+        self.output.append(line)
+        if self.expected == None:
+            return
+        if n >= len(self.expected):
+            self.failed = f"line {n + 1}: more output than in the compare file"
+            raise CompareError()
+        if not matches(line, self.expected[n]):
+            self.failed = f"line {n + 1}:\n  expected {self.expected[n]}\n  got      {line}"
+            raise CompareError()
+
+
+class CompareError(Exception):
+    pass
+
+
+# the script's commands with counted repeats expanded, None if it has other
+# blocks
+def _unroll(commands):
+    flat = []
+    for command in commands:
+        if type(command) != tuple:
+            flat.append(command)
+            continue
+        words, body = command
+        if words[0] != "repeat" or len(words) != 2:
+            return None
+        inner = _unroll(body)
+        if inner == None:
+            return None
+        flat.extend(inner * int(words[1]))
+
+    return flat
+
+
+def _split_pin(name):
+    m = _part_re.match(name)
+    if m == None or m.group(2) == "":
+        return name, None
+    return m.group(1), int(m.group(2))
+
+
+# a single character is its character code, anything else a number
+def parse_key(text) -> int:
+    if len(text) == 1 and not text.isdigit():
+        return ord(text)
+    return parse_value(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HDL simulator, runs .tst scripts")
+    parser.add_argument("tst_files", nargs="+", metavar="tst_file")
+    parser.add_argument(
+        "-I",
+        "--include",
+        action="append",
+        default=[],
+        metavar="DIR",
+        help="search DIR for chips before the cpu/ projects, repeatable",
+    )
+    parser.add_argument(
+        "--no-slice",
+        action="store_true",
+        help="run combinational scripts step by step instead of all vectors at once",
+    )
+    parser.add_argument(
+        "--gate-level",
+        action="store_true",
+        help="simulate Register, PC and the RAMs up to RAM4K from their HDL, not their models",
+    )
+    parser.add_argument(
+        "--keys",
+        default="",
+        help="comma separated keys to hold down for the script's while loops, e.g. K,Y",
+    )
+    parser.add_argument(
+        "--write-out",
+        action="store_true",
+        help="write the script's output-file",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help="-v: info, -vv: debug",
+    )
+    parser.add_argument(
+        "--timing",
+        action="store_true",
+        help="print time spent per script to stderr",
+    )
+    args = parser.parse_args()
+    set_verbosity(args.verbose)
+    timer = assembler.PhaseTimer()
+
+    keys = [parse_key(key) for key in args.keys.split(",") if key]
+    failed = 0
+    for tst_file in args.tst_files:
+        dir = os.path.dirname(tst_file) or "."
+        path = args.include + default_path(dir)
+        try:
+            with timer.phase(os.path.basename(tst_file)):
+                script = TestScript(tst_file, path, not args.no_slice, not args.gate_level, keys)
+                result = script.run()
+        except HDLError as e:
+            print(f"{tst_file}: error: {e}")
+            failed += 1
+            continue
+
+        if args.write_out and script.output_file != None:
+            outf = open(script.output_file, "w")
+            outf.write("\n".join(result.output) + "\n")
+            outf.close()
+        if result.passed:
+            print(f"{tst_file}: pass ({result.lines} lines)")
+        else:
+            print(f"{tst_file}: fail, {result.message}")
+            failed += 1
+
+    if args.timing:
+        print(timer.summary(), file=sys.stderr)
+    if failed > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
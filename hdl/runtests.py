@@ -0,0 +1,311 @@
+import argparse
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "emulator"))
+
+import hdl
+import emulator
+
+assembler = hdl.assembler
+logger = hdl.logger
+
+# where --changed keeps the dependencies and results of the last run,
+# relative to the tested directory
+STATE_FILE = ".tst-state.json"
+
+PASS = "pass"
+FAIL = "fail"
+ERROR = "error"
+SKIP = "skip"
+
+
+# the registers and RAM of the CPU emulator, in the shape of a Simulator
+# for TestScript. a tick runs one instruction
+class EmulatorSim:
+    __slots__ = ("cpu", "pins")
+
+    def __init__(self, rom):
+        self.cpu = emulator.CPU(rom)
+        self.pins = {"PC": [None] * 15, "A": [None] * 16, "D": [None] * 16}
+
+    def eval(self):
+        pass
+
+    def tick(self):
+        self.cpu.run(1, False)
+
+    def tock(self):
+        pass
+
+    def device(self, name):
+        return None
+
+    def get(self, name) -> int:
+        cpu = self.cpu
+        if name == "PC":
+            return cpu.pc
+        return (cpu.a if name == "A" else cpu.d) & 0xFFFF
+
+    def set(self, name, value):
+        cpu = self.cpu
+        if name == "PC":
+            cpu.pc = value & emulator.ADDR_MASK
+        elif name == "A":
+            cpu.a = value & 0xFFFF
+        else:
+            cpu.d = value & 0xFFFF
+
+    def get_part(self, name, index) -> int:
+        if name != "RAM" or index == None:
+            raise hdl.HDLError(f"unknown pin {name}")
+        return self.cpu.ram[index]
+
+    def set_part(self, name, index, value):
+        if name != "RAM" or index == None:
+            raise hdl.HDLError(f"unknown pin {name}")
+        self.cpu.ram[index] = value & 0xFFFF
+
+
+# a TestScript that also runs the CPU emulator scripts, the ones that load
+# a .asm or .hack program instead of a chip
+class EmulatorScript(hdl.TestScript):
+    def load(self, name):
+        if name.endswith(".hdl"):
+            super().load(name)
+            return
+
+        file = os.path.join(self.dir, name)
+        self.files.append(file)
+        if name.endswith(".asm"):
+            inf = open(file, "r")
+            l = assembler.Lexer(inf.read(), assembler.LEXERS["table"], assembler.SymbolTable())
+            inf.close()
+            l.run()
+            l.relocate()
+            rom = l.encode()
+        elif name.endswith(".hack"):
+            rom = assembler.read_hack(file)
+        else:
+            raise hdl.HDLError(f"cannot load {name}", self.file)
+        self.sim = EmulatorSim(rom)
+        logger.info(f"{name}: {len(rom)} instructions")
+
+    def block(self, words, body):
+        # repeat N { ticktock; } is a run of N instructions
+        if isinstance(self.sim, EmulatorSim) and len(words) == 2 and words[0] == "repeat" and body == [["ticktock"]]:
+            count = int(words[1])
+            self.sim.cpu.run(count, False)
+            self.time += count
+            return
+        super().block(words, body)
+
+
+# scripts below root, sorted
+def discover(root) -> list:
+    return sorted(glob.glob(os.path.join(root, "**", "*.tst"), recursive=True))
+
+
+def _compares(commands) -> bool:
+    return any(type(command) == list and command[0] == "compare-to" for command in commands)
+
+
+# runs one script in a worker process. returns (tst_file, status, detail,
+# seconds, {dependency: digest})
+def run_test(tst_file, include, sliced, models, keys):
+    begin = time.perf_counter()
+    deps = [tst_file]
+    try:
+        path = include + hdl.default_path(os.path.dirname(tst_file) or ".")
+        script = EmulatorScript(tst_file, path, sliced, models, keys)
+        if not _compares(script.commands):
+            status, detail = SKIP, "no compare-to"
+        else:
+            result = script.run()
+            if result.passed:
+                status, detail = PASS, f"{result.lines} lines"
+            else:
+                status, detail = FAIL, result.message
+        deps = script.dependencies()
+    except (hdl.HDLError, emulator.EmulatorError, assembler.LexerError, OSError) as e:
+        status, detail = ERROR, str(e)
+    elapsed = time.perf_counter() - begin
+
+    return tst_file, status, detail, elapsed, {dep: digest(dep) for dep in deps}
+
+
+def digest(file):
+    try:
+        inf = open(file, "rb")
+    except OSError:
+        return None
+    value = hashlib.sha256(inf.read()).hexdigest()
+    inf.close()
+
+    return value
+
+
+def load_state(state_file) -> dict:
+    if not os.path.exists(state_file):
+        return {}
+    inf = open(state_file, "r")
+    try:
+        state = json.load(inf)
+    except ValueError:
+        logger.warning(f"{state_file} is not valid, running every test")
+        state = {}
+    inf.close()
+
+    return state
+
+
+def save_state(state_file, state):
+    outf = open(state_file + ".tmp", "w")
+    json.dump(state, outf, indent=1, sort_keys=True)
+    outf.close()
+    os.replace(state_file + ".tmp", state_file)
+
+
+# a test needs to run again when it did not pass last time or any file it
+# read then, the script, its .cmp or the .hdl of one of its chips, changed.
+# the state's paths are relative to its directory, so that runs from
+# anywhere share it
+def changed(tst_file, state, state_dir) -> bool:
+    entry = state.get(os.path.relpath(tst_file, state_dir))
+    if entry == None or entry["status"] not in (PASS, SKIP):
+        return True
+    return any(digest(os.path.join(state_dir, dep)) != value for dep, value in entry["deps"].items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="runs the .tst scripts of a tree and compares them with their .cmp files")
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        help="scripts or directories to search for them, by default cpu/",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="worker processes, by default one per cpu",
+    )
+    parser.add_argument(
+        "--changed",
+        action="store_true",
+        help="only run scripts that did not pass or whose files changed since the last run",
+    )
+    parser.add_argument(
+        "--state",
+        help=f"state file of --changed, by default {STATE_FILE} in the first directory",
+    )
+    parser.add_argument(
+        "-I",
+        "--include",
+        action="append",
+        default=[],
+        metavar="DIR",
+        help="search DIR for chips before the cpu/ projects, repeatable",
+    )
+    parser.add_argument(
+        "--no-slice",
+        action="store_true",
+        help="run combinational scripts step by step instead of all vectors at once",
+    )
+    parser.add_argument(
+        "--gate-level",
+        action="store_true",
+        help="simulate Register, PC and the RAMs up to RAM4K from their HDL, not their models",
+    )
+    parser.add_argument(
+        "--keys",
+        default="K,Y",
+        help="comma separated keys to hold down for the scripts' while loops",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help="-v: info, -vv: debug",
+    )
+    parser.add_argument(
+        "--timing",
+        action="store_true",
+        help="print the slowest scripts to stderr",
+    )
+    args = parser.parse_args()
+    hdl.set_verbosity(args.verbose)
+
+    paths = args.paths or [hdl.CPU_DIR]
+    tests = []
+    for path in paths:
+        if os.path.isdir(path):
+            tests.extend(discover(path))
+        else:
+            tests.append(path)
+    tests = [os.path.relpath(test) for test in tests]
+    state_dir = next((path for path in paths if os.path.isdir(path)), ".")
+    state_file = args.state or os.path.join(state_dir, STATE_FILE)
+    state_dir = os.path.dirname(state_file) or "."
+
+    # every run records its results, so that --changed can follow any run
+    state = load_state(state_file)
+    unchanged = 0
+    if args.changed:
+        run = [test for test in tests if changed(test, state, state_dir)]
+        unchanged = len(tests) - len(run)
+        tests = run
+
+    keys = [hdl.parse_key(key) for key in args.keys.split(",") if key]
+    counts = {PASS: 0, FAIL: 0, ERROR: 0, SKIP: 0}
+    times = []
+    begin = time.perf_counter()
+    # the summary and the state are written however the run ends, also when
+    # it is interrupted
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = [
+                pool.submit(run_test, test, args.include, not args.no_slice, not args.gate_level, keys)
+                for test in tests
+            ]
+            for test, future in zip(tests, futures):
+                try:
+                    tst_file, status, detail, elapsed, deps = future.result()
+                except concurrent.futures.process.BrokenProcessPool as e:
+                    # a worker died, e.g. killed out of memory. that breaks
+                    # the pool, so this and every script still queued fail
+                    tst_file, status, detail, elapsed, deps = test, ERROR, f"worker died: {e}", 0.0, {}
+                except Exception as e:
+                    tst_file, status, detail, elapsed, deps = test, ERROR, f"{type(e).__name__}: {e}", 0.0, {}
+                counts[status] += 1
+                times.append((elapsed, tst_file))
+                print(f"{tst_file}: {status} {elapsed:7.3f}s, {detail}")
+                deps = {os.path.relpath(dep, state_dir): value for dep, value in deps.items()}
+                state[os.path.relpath(tst_file, state_dir)] = {"status": status, "deps": deps}
+    finally:
+        elapsed = time.perf_counter() - begin
+        summary = ", ".join(f"{counts[status]} {name}" for status, name in (
+            (PASS, "passed"), (FAIL, "failed"), (ERROR, "errors"), (SKIP, "skipped")))
+        if args.changed:
+            summary += f", {unchanged} unchanged"
+        save_state(state_file, state)
+        print(f"{summary} in {elapsed:.2f}s")
+
+    if args.timing:
+        cpu_time = sum(t for t, _ in times)
+        for t, tst_file in sorted(times, reverse=True)[:10]:
+            print(f"{t:8.3f}s  {tst_file}", file=sys.stderr)
+        print(f"{cpu_time:8.3f}s  in the workers, {elapsed:.3f}s wall", file=sys.stderr)
+    if counts[FAIL] + counts[ERROR] > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
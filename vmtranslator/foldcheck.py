@@ -0,0 +1,88 @@
+import argparse
+import itertools
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "emulator"))
+
+import emulator
+import vminterp
+import vmtranslator
+
+# the results go to THAT[0..], out of the way of the stack and the statics
+RESULTS = 8000
+
+# operands around the edges of the 15-bit constants and of the signed words
+# they fold to: 0x8000, 0xFFFF and the other negative results
+OPERANDS = (0, 1, 2, 16384, 32767)
+BINARY = ("add", "sub", "and", "or", "eq", "gt", "lt")
+UNARY = ("neg", "not")
+
+
+# one vm program computing every case, and the number of cases. each case
+# leaves one word at RESULTS + case
+def generate():
+    lines = [f"push constant {RESULTS}", "pop pointer 1"]
+    case = 0
+
+    def result():
+        nonlocal case
+        lines.append(f"pop that {case}")
+        case += 1
+
+    for x, y in itertools.product(OPERANDS, repeat=2):
+        for op in BINARY:
+            lines += [f"push constant {x}", f"push constant {y}", op]
+            result()
+            # the folded word as the operand of a further fold
+            for unary in UNARY:
+                lines += [f"push constant {x}", f"push constant {y}", op, unary]
+                result()
+    for x in OPERANDS:
+        for ops in itertools.product(UNARY, repeat=3):
+            lines += [f"push constant {x}", *ops]
+            result()
+    lines += ["label END", "goto END"]
+
+    return "\n".join(lines) + "\n", case
+
+
+def run(vm_source, cases, options):
+    cpu = emulator.CPU(vminterp.translate_rom(vm_source, options))
+    cpu.ram[vminterp.SP] = vminterp.STACK
+    cpu.run()
+
+    return list(cpu.ram[RESULTS : RESULTS + cases])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="checks that --fold output assembles and computes what the unfolded code does"
+    )
+    parser.parse_args()
+
+    input, cases = generate()
+    with tempfile.TemporaryDirectory() as tmp:
+        vm_file = os.path.join(tmp, "Fold.vm")
+        outf = open(vm_file, "w")
+        outf.write(input)
+        outf.close()
+        expected = run([vm_file], cases, {})
+        try:
+            folded = run([vm_file], cases, {"fold": True})
+        except vmtranslator.assembler.LexerError as e:
+            print(f"folded code does not assemble: {e}", file=sys.stderr)
+            sys.exit(1)
+
+    _, before, after, saved = vmtranslator.fold_reports[-1]
+    print(f"{cases} cases, {before} -> {after} commands, -{saved} instructions")
+    differences = [(case, x, y) for case, (x, y) in enumerate(zip(expected, folded)) if x != y]
+    for case, x, y in differences:
+        print(f"case {case}: {x} unfolded, {y} folded", file=sys.stderr)
+    if differences or after >= before:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
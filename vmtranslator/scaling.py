@@ -0,0 +1,123 @@
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "assembly"))
+
+import assembler
+import bench
+import vmtranslator
+
+# a slice of compiler output: every command under a comment, as the jack
+# compiler and the translator's own output do
+_BLOCK = """\
+// {n}: let x = x + 1
+push local 0
+push constant 1
+add
+pop local 0 // x
+// {n}: if (x < 10)
+push local 0
+push constant 10
+lt
+if-goto LOOP.{n}
+label LOOP.{n}
+push static 3
+call Math.multiply 2
+pop this 1
+function Bench.f{n} 2
+return
+"""
+
+
+def generate(lines):
+    chunks = []
+    n = 0
+    count = 0
+    block_lines = _BLOCK.count("\n")
+    while count < lines:
+        chunks.append(_BLOCK.format(n=n))
+        count += block_lines
+        n += 1
+
+    return "".join(chunks), count
+
+
+def translate(input):
+    l = vmtranslator.Lexer(input, vmtranslator.lex_line)
+    l.run()
+    buf = io.StringIO()
+    vmtranslator.Generator("Bench.vm", l.cmds).run(buf)
+
+    return buf
+
+
+# lexing and symbol resolution, the phases that see every line. encoding
+# is left out since a million line program does not fit the 32K ROM
+def assembler_job(lexer):
+    def assemble(input):
+        l = assembler.Lexer(input, assembler.LEXERS[lexer], assembler.SymbolTable())
+        l.run()
+        l.relocate()
+
+        return l
+
+    return assemble
+
+
+def best(fn, input, repeat):
+    elapsed = None
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        fn(input)
+        t = time.perf_counter() - begin
+        if elapsed == None or t < elapsed:
+            elapsed = t
+
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="lexer scaling benchmark, fails when time per line grows with the input"
+    )
+    parser.add_argument(
+        "--sizes",
+        default="10000,100000,1000000",
+        help="comma separated input sizes in lines",
+    )
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=2.0,
+        help="largest allowed ratio of the time per line of the biggest input to the smallest",
+    )
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    failed = False
+    jobs = [("vmtranslator", generate, translate)]
+    for lexer in assembler.LEXERS:
+        jobs.append((f"asm {lexer}", bench.generate, assembler_job(lexer)))
+    for name, generator, fn in jobs:
+        per_line = []
+        for size in sizes:
+            input, lines = generator(size)
+            elapsed = best(fn, input, args.repeat)
+            per_line.append(elapsed / lines)
+            print(f"{name:>12}: {lines:8} lines {elapsed:8.3f}s {elapsed / lines * 1e6:8.2f} us/line")
+        ratio = per_line[-1] / per_line[0]
+        verdict = "ok" if ratio <= args.tolerance else "SUPERLINEAR"
+        print(f"{name:>12}: time per line x{ratio:.2f} from {sizes[0]} to {sizes[-1]} lines, {verdict}")
+        if ratio > args.tolerance:
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
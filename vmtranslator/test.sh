@@ -0,0 +1,43 @@
+# usage: vmtranslator/test.sh
+# runs the programs of samples/ with vminterp.py --check, plain and with
+# every translator option, so the translated code computes what the vm
+# code does, and checks that --hack builds the rom that translating and
+# assembling in two steps does. foldcheck.py then runs the constant
+# folding over its own cases
+set -e
+
+dir=$(dirname "$0")
+# the segment pointers of a program without a bootstrap
+SEGMENTS="--set 0=256 --set 1=300 --set 2=400 --set 3=3000 --set 4=3010"
+
+tmp=$(mktemp -d)
+trap 'rm -rf "$tmp"' EXIT
+
+status=0
+for options in "" --shared-routines --peephole --fold "--shared-routines --peephole --fold"; do
+    if ! python3 "$dir/vminterp.py" "$dir/samples/Arith.vm" --check $SEGMENTS $options \
+        --dump 300:3 --dump 400:2 --dump 5:8 --dump 3032 --dump 3045 > /dev/null; then
+        echo "samples/Arith.vm: --check $options failed" >&2
+        status=1
+    fi
+    if ! python3 "$dir/vminterp.py" "$dir/samples/Fib" --check $options --dump 5 > /dev/null; then
+        echo "samples/Fib: --check $options failed" >&2
+        status=1
+    fi
+    for sample in Arith.vm Fib; do
+        python3 "$dir/vmtranslator.py" "$dir/samples/$sample" $options -o "$tmp/two.asm"
+        python3 "$dir/../assembly/assembler.py" "$tmp/two.asm" -o "$tmp/two.hack"
+        python3 "$dir/vmtranslator.py" "$dir/samples/$sample" $options --hack "$tmp/one.hack"
+        if ! cmp -s "$tmp/two.hack" "$tmp/one.hack"; then
+            echo "samples/$sample: --hack $options differs from assembling the .asm" >&2
+            status=1
+        fi
+    done
+done
+
+if ! python3 "$dir/foldcheck.py"; then
+    echo "foldcheck.py failed" >&2
+    status=1
+fi
+
+exit $status
@@ -0,0 +1,471 @@
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "emulator"))
+
+import emulator
+import vmtranslator
+
+assembler = vmtranslator.assembler
+
+# the Hack memory layout the translator compiles to
+MEM_SIZE = emulator.MEM_SIZE
+ADDR_MASK = emulator.ADDR_MASK
+SP = 0
+LCL = 1
+ARG = 2
+THIS = 3
+THAT = 4
+TEMP = 5
+STATIC = 16
+STACK = 256
+
+# push constant x, push segment x, ... are compiled to (op, x, y) tuples:
+# labels disappear and jumps and calls hold the index of their target
+OP_PUSH_CONSTANT = 0
+# x base register, y offset
+OP_PUSH_SEGMENT = 1
+# x address: static, pointer and temp
+OP_PUSH_ADDRESS = 2
+OP_POP_SEGMENT = 3
+OP_POP_ADDRESS = 4
+OP_ADD = 5
+OP_SUB = 6
+OP_NEG = 7
+OP_AND = 8
+OP_OR = 9
+OP_NOT = 10
+OP_EQ = 11
+OP_GT = 12
+OP_LT = 13
+# x target
+OP_GOTO = 14
+OP_IF_GOTO = 15
+# x locals
+OP_FUNCTION = 16
+# x target, y arguments
+OP_CALL = 17
+OP_RETURN = 18
+
+ARITHMETIC_OPS = {
+    "add": OP_ADD,
+    "sub": OP_SUB,
+    "neg": OP_NEG,
+    "and": OP_AND,
+    "or": OP_OR,
+    "not": OP_NOT,
+    "eq": OP_EQ,
+    "gt": OP_GT,
+    "lt": OP_LT,
+}
+
+SEGMENT_BASES = {"local": LCL, "argument": ARG, "this": THIS, "that": THAT}
+
+
+class VMError(Exception):
+    def __init__(self, message, where=None):
+        if where != None:
+            message = f"{where[0]}:{where[1]}: {message}"
+        super().__init__(message)
+
+
+# the commands of all files, in the order the translator writes them, as
+# op tuples. where[i] is the (file, line, command) of code[i]
+class Program:
+    __slots__ = ("code", "where", "functions", "statics", "bootstrap")
+
+    def __init__(self, vm_source):
+        self.code = []
+        self.where = []
+        self.functions = {}
+        # static symbol -> address, given out from 16 in the order of first
+        # use like the assembler's variables
+        self.statics = {}
+        self.bootstrap = vmtranslator.has_sys(vm_source)
+
+        # (index, label, where) of the jumps and the calls, resolved once
+        # every file is read. labels and function names share one global
+        # table, as they become the same assembly labels: a label used in
+        # two functions is a duplicate and a goto may leave its function,
+        # exactly as in the translated program
+        jumps = []
+        labels = {}
+        for vm_file in vm_source:
+            inf = open(vm_file, "r")
+            l = vmtranslator.Lexer(inf.read(), vmtranslator.lex_line)
+            inf.close()
+            l.run()
+            file_name = os.path.basename(vm_file).replace(".vm", "")
+            for cmd in l.cmds:
+                where = (vm_file, cmd.line, " ".join(tok.value for tok in cmd.tokens))
+                words = [tok.value for tok in cmd.tokens]
+                if cmd.type == vmtranslator.C_LABEL or cmd.type == vmtranslator.C_FUNCTION:
+                    if words[1] in labels:
+                        raise VMError(f"duplicate label {words[1]}", where)
+                    labels[words[1]] = len(self.code)
+                if cmd.type == vmtranslator.C_LABEL:
+                    continue
+                if cmd.type == vmtranslator.C_FUNCTION:
+                    self.functions[words[1]] = len(self.code)
+                    op = (OP_FUNCTION, int(words[2]), 0)
+                elif cmd.type == vmtranslator.C_ARITHMETIC:
+                    op = (ARITHMETIC_OPS[words[0]], 0, 0)
+                elif cmd.type == vmtranslator.C_PUSH or cmd.type == vmtranslator.C_POP:
+                    op = self.memory_op(cmd.type == vmtranslator.C_PUSH, file_name, words[1], words[2], where)
+                elif cmd.type == vmtranslator.C_GOTO or cmd.type == vmtranslator.C_IF:
+                    jumps.append((len(self.code), words[1], where))
+                    op = (OP_GOTO if cmd.type == vmtranslator.C_GOTO else OP_IF_GOTO, None, 0)
+                elif cmd.type == vmtranslator.C_CALL:
+                    jumps.append((len(self.code), words[1], where))
+                    op = (OP_CALL, None, int(words[2]))
+                else:
+                    op = (OP_RETURN, 0, 0)
+                self.code.append(op)
+                self.where.append(where)
+
+        for index, label, where in jumps:
+            target = labels.get(label)
+            if target == None:
+                raise VMError(f"unknown label {label}", where)
+            op, _, y = self.code[index]
+            self.code[index] = (op, target, y)
+        # return addresses are code indexes stored in 16-bit words
+        if len(self.code) > 0xFFFF:
+            raise VMError(f"{len(self.code)} commands, more than a return address can hold")
+
+    def memory_op(self, push, file_name, segment, i, where):
+        if segment == "constant":
+            if not push:
+                raise VMError("pop constant", where)
+            return (OP_PUSH_CONSTANT, int(i) & 0xFFFF, 0)
+        if segment in SEGMENT_BASES:
+            return (OP_PUSH_SEGMENT if push else OP_POP_SEGMENT, SEGMENT_BASES[segment], int(i))
+        if segment == "static":
+            symbol = f"{file_name}.{i}"
+            address = self.statics.get(symbol)
+            if address == None:
+                address = self.statics[symbol] = STATIC + len(self.statics)
+        elif segment == "pointer":
+            address = THIS if i == "0" else THAT
+        elif segment == "temp":
+            address = TEMP + int(i)
+        else:
+            raise VMError(f"unknown memory segment '{segment}'", where)
+        return (OP_PUSH_ADDRESS if push else OP_POP_ADDRESS, address, 0)
+
+
+# runs a Program on a flat RAM. a call pushes the index of the command after
+# it as the return address where the Hack code pushes a ROM address, the
+# other words of the stack and the segments hold the same values as when
+# the translated program runs on the CPU. eq, gt and lt compare as signed
+# 16-bit numbers, as the VM spec says
+class Interpreter:
+    __slots__ = ("program", "ram", "pc", "steps", "halted")
+
+    def __init__(self, program, ram=None):
+        self.program = program
+        self.ram = [0] * MEM_SIZE if ram == None else ram
+        self.reset()
+
+    def reset(self):
+        self.pc = 0
+        self.steps = 0
+        self.halted = False
+        # the bootstrap: SP = 256, call Sys.init 0. a return from Sys.init
+        # goes on with the first command of the first file, as the Hack
+        # code falls through from the bootstrap into it
+        if self.program.bootstrap:
+            target = self.program.functions.get("Sys.init")
+            if target == None:
+                raise VMError("Sys.vm without a Sys.init function")
+            ram = self.ram
+            ram[SP] = STACK
+            self.pc = 0
+            self.call(target, 0)
+
+    def call(self, target, n_args):
+        ram = self.ram
+        sp = ram[SP]
+        ram[sp] = self.pc
+        ram[sp + 1] = ram[LCL]
+        ram[sp + 2] = ram[ARG]
+        ram[sp + 3] = ram[THIS]
+        ram[sp + 4] = ram[THAT]
+        sp += 5
+        ram[ARG] = sp - 5 - n_args
+        ram[LCL] = sp
+        ram[SP] = sp
+        self.pc = target
+
+    # runs at most max_steps commands (all of them when None), stops at a
+    # goto to itself, the VM's halt loop, or when the pc leaves the program.
+    # returns the number of commands executed
+    def run(self, max_steps=None) -> int:
+        code = self.program.code
+        ram = self.ram
+        size = len(code)
+        pc = self.pc
+        sp = ram[SP]
+        limit = max_steps if max_steps != None else -1
+
+        n = 0
+        try:
+            while n != limit and pc < size:
+                op, x, y = code[pc]
+                n += 1
+                pc += 1
+                if op == OP_PUSH_CONSTANT:
+                    ram[sp] = x
+                    sp += 1
+                elif op == OP_PUSH_SEGMENT:
+                    address = (ram[x] + y) & ADDR_MASK
+                    ram[sp] = sp if address == SP else ram[address]
+                    sp += 1
+                elif op == OP_PUSH_ADDRESS:
+                    ram[sp] = ram[x]
+                    sp += 1
+                elif op == OP_POP_SEGMENT:
+                    sp -= 1
+                    address = (ram[x] + y) & ADDR_MASK
+                    if address == SP:
+                        sp = ram[sp]
+                    else:
+                        ram[address] = ram[sp]
+                elif op == OP_POP_ADDRESS:
+                    sp -= 1
+                    ram[x] = ram[sp]
+                elif op == OP_ADD:
+                    sp -= 1
+                    ram[sp - 1] = (ram[sp - 1] + ram[sp]) & 0xFFFF
+                elif op == OP_SUB:
+                    sp -= 1
+                    ram[sp - 1] = (ram[sp - 1] - ram[sp]) & 0xFFFF
+                elif op == OP_IF_GOTO:
+                    sp -= 1
+                    if ram[sp] != 0:
+                        pc = x
+                elif op == OP_GOTO:
+                    if x == pc - 1:
+                        pc = x
+                        self.halted = True
+                        break
+                    pc = x
+                elif op == OP_EQ:
+                    sp -= 1
+                    ram[sp - 1] = 0xFFFF if ram[sp - 1] == ram[sp] else 0
+                elif op == OP_LT:
+                    sp -= 1
+                    # flipping the sign bits orders the words as signed numbers
+                    ram[sp - 1] = 0xFFFF if ram[sp - 1] ^ 0x8000 < ram[sp] ^ 0x8000 else 0
+                elif op == OP_GT:
+                    sp -= 1
+                    ram[sp - 1] = 0xFFFF if ram[sp - 1] ^ 0x8000 > ram[sp] ^ 0x8000 else 0
+                elif op == OP_NEG:
+                    ram[sp - 1] = -ram[sp - 1] & 0xFFFF
+                elif op == OP_NOT:
+                    ram[sp - 1] ^= 0xFFFF
+                elif op == OP_AND:
+                    sp -= 1
+                    ram[sp - 1] &= ram[sp]
+                elif op == OP_OR:
+                    sp -= 1
+                    ram[sp - 1] |= ram[sp]
+                elif op == OP_CALL:
+                    ram[sp] = pc
+                    ram[sp + 1] = ram[LCL]
+                    ram[sp + 2] = ram[ARG]
+                    ram[sp + 3] = ram[THIS]
+                    ram[sp + 4] = ram[THAT]
+                    sp += 5
+                    ram[ARG] = sp - 5 - y
+                    ram[LCL] = sp
+                    pc = x
+                elif op == OP_FUNCTION:
+                    ram[sp : sp + x] = [0] * x
+                    sp += x
+                else:
+                    frame = ram[LCL]
+                    # read before the return value lands on it when the
+                    # function has no arguments
+                    pc = ram[frame - 5]
+                    arg = ram[ARG]
+                    ram[arg] = ram[sp - 1]
+                    sp = arg + 1
+                    ram[THAT] = ram[frame - 1]
+                    ram[THIS] = ram[frame - 2]
+                    ram[ARG] = ram[frame - 3]
+                    ram[LCL] = ram[frame - 4]
+        except IndexError:
+            raise VMError(f"stack or segment address out of the RAM, SP={sp}", self.program.where[pc - 1])
+        finally:
+            ram[SP] = sp
+            self.pc = pc
+            self.steps += n
+
+        return n
+
+
+# the program translated and assembled in process, the way vmtranslator.py
+# --hack builds its rom. symbol_table, when given, is left holding the
+# program's labels and variables
+def translate_rom(vm_source, options=None, symbol_table=None) -> list:
+    options = options or {}
+    outf = vmtranslator.RecordWriter()
+    vmtranslator.write_bootstrap(outf, vm_source, options.get("shared_routines", False))
+    for vm_file in vm_source:
+        vmtranslator.translate(vm_file, outf, None, options)
+
+    if symbol_table == None:
+        symbol_table = assembler.SymbolTable()
+    return assembler.encode_records(outf.records, symbol_table)
+
+
+# runs the translated program on the CPU emulator from the same RAM and
+# returns the [(name, vm value, cpu value)] that differ. addresses are
+# compared as they are, the statics by their File.n symbol: the assembler
+# gives the variables their registers in order of first use in the code,
+# which --fold can change. a static the translated code no longer uses is
+# not compared
+def check(interpreter, initial_ram, vm_source, options, addresses, max_cycles=None) -> list:
+    symbol_table = assembler.SymbolTable()
+    cpu = emulator.CPU(translate_rom(vm_source, options, symbol_table))
+    for address, value in enumerate(initial_ram):
+        if value:
+            cpu.ram[address] = value
+    cpu.run(max_cycles)
+
+    ram = interpreter.ram
+    differences = [
+        (f"RAM[{address}]", ram[address], cpu.ram[address])
+        for address in addresses
+        if ram[address] != cpu.ram[address]
+    ]
+    for symbol, address in interpreter.program.statics.items():
+        if not symbol_table.defined(symbol):
+            continue
+        cpu_address = symbol_table.get(symbol)
+        if ram[address] != cpu.ram[cpu_address]:
+            name = f"{symbol} (RAM[{address}], RAM[{cpu_address}] on the cpu)"
+            differences.append((name, ram[address], cpu.ram[cpu_address]))
+
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description="runs .vm programs without translating them")
+    parser.add_argument("input_name", help=".vm file or directory of .vm files")
+    parser.add_argument(
+        "-n",
+        "--steps",
+        type=int,
+        help="stop after this many commands",
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="ADDR=VALUE",
+        help="set RAM[ADDR] before running, repeatable",
+    )
+    parser.add_argument(
+        "--dump",
+        action="append",
+        default=[],
+        metavar="ADDR[:COUNT]",
+        help="print RAM[ADDR..ADDR+COUNT) after running, repeatable",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="also translate the program, run it on the CPU emulator and compare SP to THAT, "
+        "the statics by name and the --dump ranges",
+    )
+    parser.add_argument(
+        "--cycles",
+        type=int,
+        help="stop the emulator of --check after this many instructions",
+    )
+    parser.add_argument(
+        "--shared-routines",
+        action="store_true",
+        help="translate for --check with the shared call, return and compare routines",
+    )
+    parser.add_argument(
+        "--peephole",
+        action="store_true",
+        help="translate for --check with the peephole optimizer",
+    )
+    parser.add_argument(
+        "--fold",
+        action="store_true",
+        help="translate for --check with the vm constant folding pass",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help="-v: info, -vv: debug",
+    )
+    parser.add_argument(
+        "--timing",
+        action="store_true",
+        help="print load and run time and commands per second to stderr",
+    )
+    args = parser.parse_args()
+    vmtranslator.set_verbosity(args.verbose)
+    timer = assembler.PhaseTimer()
+
+    vm_source = vmtranslator.source_files(args.input_name)
+    if not vm_source:
+        parser.error(f"no .vm files in {args.input_name}")
+    try:
+        with timer.phase("load"):
+            program = Program(vm_source)
+        ram = [0] * MEM_SIZE
+        for poke in args.set:
+            address, value = emulator.parse_poke(poke)
+            ram[address] = value
+        initial_ram = list(ram)
+        interpreter = Interpreter(program, ram)
+        with timer.phase("run"):
+            n = interpreter.run(args.steps)
+    except (VMError, vmtranslator.LexerError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    state = "halted" if interpreter.halted else "stopped"
+    vmtranslator.logger.info(f"{state} at command {interpreter.pc} after {n} commands, SP={ram[SP]}")
+    ranges = []
+    for dump in args.dump:
+        start, count = emulator.parse_range(dump)
+        ranges.append((start, count))
+        for address in range(start, start + count):
+            print(f"RAM[{address}] = {ram[address]}")
+
+    failed = False
+    if args.check:
+        addresses = list(range(SP, THAT + 1))
+        for start, count in ranges:
+            addresses.extend(range(start, start + count))
+        options = {"shared_routines": args.shared_routines, "peephole": args.peephole, "fold": args.fold}
+        with timer.phase("check"):
+            differences = check(interpreter, initial_ram, vm_source, options, addresses, args.cycles)
+        for name, vm_value, cpu_value in differences:
+            print(f"check: {name} = {vm_value} in the vm, {cpu_value} on the cpu", file=sys.stderr)
+        words = len(addresses) + len(program.statics)
+        print(f"check: {len(differences)} of {words} words differ", file=sys.stderr)
+        failed = len(differences) > 0
+
+    if args.timing:
+        print(timer.summary(), file=sys.stderr)
+        elapsed = timer.phases["run"]
+        if elapsed > 0:
+            print(f"{n / elapsed / 1e6:.2f} M commands/sec", file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,18 @@ import re
 import sys
 import os
 import glob
+import hashlib
+import io
+import json
+import tempfile
+import argparse
+import concurrent.futures
+import functools
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "assembly"))
+
+import assembler
 
 class LexerError(Exception):
     def __init__(self, message, line, pos):
@@ -29,7 +41,27 @@ TOK_ARG = 3
 
 EOF = None
 
+logger = logging.getLogger("vmtranslator")
+
+# per-token tracing, checked before any message is built so it costs
+# nothing but a global lookup when off. set by set_verbosity
+TRACE = False
+
+# 0: warnings only, 1: info, 2: trace every token. sets the TRACE and the
+# logger of this module, the assembler has its own
+def set_verbosity(verbosity):
+    global TRACE
+
+    logger.setLevel(assembler.logging_level(verbosity))
+    TRACE = verbosity >= 2
+
+timer = assembler.PhaseTimer()
+
+# token values are interned: "push", "constant", "0" ... are shared by
+# every command instead of each token holding its own copy
 class Token:
+    __slots__ = ("type", "value", "pos", "line")
+
     def __init__(self, type: int, value: str, pos: int, line: int):
         self.type = type
         self.value = value
@@ -37,7 +69,9 @@ class Token:
         self.line = line
 
 class Command:
-    def __init__(self, type: int, tokens: typing.List[Token], line: int):
+    __slots__ = ("type", "tokens", "line")
+
+    def __init__(self, type: int, tokens: typing.Sequence[Token], line: int):
         self.type = type
         self.tokens = tokens
         self.line = line
@@ -45,6 +79,15 @@ class Command:
     def __repr__(self) -> str:
         return f"{self.line}: {' '.join([tok.value for tok in self.tokens])}"
 
+_repeat_res = {}
+
+# regex repeated zero or more times, compiled once
+def _repeat_re(regex):
+    pattern = _repeat_res.get(regex)
+    if pattern == None:
+        pattern = _repeat_res[regex] = re.compile(f"(?:{regex})*")
+    return pattern
+
 class Lexer:
     def __init__(self, input: str, lex_start):
         self.input = input
@@ -95,37 +138,25 @@ class Lexer:
 
         return ret
 
-    # consumes next char if its match regex
+    # consumes the chars that match regex, a one char pattern, in a single
+    # match of the compiled repetition
     def accept_r(self, regex):
-        ch = self.next()
-        ret = False
-        while ch and re.match(regex, ch):
-            ch = self.next()
-            ret = True
-        self.back()
+        end = _repeat_re(regex).match(self.input, self.pos).end()
+        ret = end > self.pos
+        self.line += self.input.count('\n', self.pos, end)
+        self.pos = end
 
         return ret
 
-    def next_match(self, str: str):
-        end = self.pos + len(str)
-        if end > self.input_len:
-            return False
-        if str == self.input[self.pos:end]:
-            self.pos = end
-            return True
-        return False
-
-    def next_matchs(self, strs: typing.List[str]):
-        for str in strs:
-            if self.next_match(str):
-                return True
-        return False
-
-    # skip current line
+    # skip current line, a last line without '\n' ends the input
     def skip_line(self):
-        self.pos += self.input[self.pos:].index('\n') + 1
+        end = self.input.find('\n', self.pos)
+        if end < 0:
+            self.pos = self.input_len
+        else:
+            self.pos = end + 1
+            self.line += 1
         self.start = self.pos
-        self.line += 1
 
     def ignore(self, inc_line = False):
         if inc_line:
@@ -137,7 +168,7 @@ class Lexer:
             return self.tokens.pop(0)
 
     def _push_tok(self, type):
-        token = Token(type, self.input[self.start:self.pos], self.start, self.line)
+        token = Token(type, sys.intern(self.input[self.start:self.pos]), self.start, self.line)
         self.tokens.append(token)
         self.start = self.pos
 
@@ -147,7 +178,7 @@ class Lexer:
         self.tokens = []
 
     def _push_cmd(self, type):
-        self.cmds.append(Command(type, self.tokens, self.tokens[0].line))
+        self.cmds.append(Command(type, tuple(self.tokens), self.tokens[0].line))
         self._flush_tok()
 
     def _pop_cmd(self):
@@ -179,29 +210,17 @@ def lex_line(l: Lexer):
         l.skip_line()
         return lex_line
 
-    print(f"start with '{ch}' at {l.line}:{l.pos}")
+    if TRACE:
+        logger.debug(f"start with '{ch}' at {l.line}:{l.pos}")
 
-    # arithmetic / logical
-    if l.next_matchs(["add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not"]):
-        return lex_arithmetic
+    # the whole command word, then one dict lookup
+    end = _command_re.match(l.input, l.pos).end()
+    lex_fn = COMMAND_LEXERS.get(l.input[l.pos:end])
+    if lex_fn == None:
+        raise SyntaxError("unknown command", l.line, l.pos)
+    l.pos = end
 
-    # memory access
-    if l.next_matchs(["push", "pop"]):
-        return lex_memory_access
-
-    # branching
-    if l.next_matchs(["label", "goto", "if-goto"]):
-        return lex_branching
-
-    # function
-    if l.next_matchs(["function", "call"]):
-        return lex_function
-    
-    # function return
-    if l.next_match("return"):
-        return lex_function_return
-
-    raise SyntaxError("unknown command", l.line, l.pos)
+    return lex_fn
 
 def ignore_blank(l: Lexer):
     l.accept(" \t")
@@ -218,14 +237,16 @@ def lex_end_line(l: Lexer):
     return lex_line
 
 def lex_arithmetic(l: Lexer):
-    print("-> arithmetic")
+    if TRACE:
+        logger.debug("-> arithmetic")
 
     l._push_tok(TOK_CMD)
     l._push_cmd(C_ARITHMETIC)
     return lex_end_line
 
 def lex_memory_access(l: Lexer):
-    print("-> memory access")
+    if TRACE:
+        logger.debug("-> memory access")
 
     cmd_tok = l._push_tok(TOK_CMD)
     ignore_blank(l)
@@ -237,7 +258,7 @@ def lex_memory_access(l: Lexer):
 
     # "i"
     l.accept_r(r"\d")
-    l._push_tok(l)
+    l._push_tok(TOK_ARG)
 
     if cmd_tok.value == "push":
         l._push_cmd(C_PUSH)
@@ -247,7 +268,8 @@ def lex_memory_access(l: Lexer):
     return lex_end_line
 
 def lex_branching(l: Lexer):
-    print("-> branching")
+    if TRACE:
+        logger.debug("-> branching")
 
     cmd_str = l._push_tok(TOK_CMD).value
     cmd_type = C_LABEL
@@ -267,7 +289,8 @@ def lex_branching(l: Lexer):
     return lex_end_line
 
 def lex_function(l: Lexer):
-    print("-> function")
+    if TRACE:
+        logger.debug("-> function")
 
     cmd_str = l._push_tok(TOK_CMD).value
     cmd_type = C_FUNCTION
@@ -290,31 +313,88 @@ def lex_function(l: Lexer):
     return lex_end_line
 
 def lex_function_return(l: Lexer):
-    print("-> function return")
+    if TRACE:
+        logger.debug("-> function return")
 
     l._push_tok(TOK_CMD)
     l._push_cmd(C_RETURN)
     return lex_end_line
 
+_command_re = re.compile(r"[a-z-]*")
+
+# command word -> lexer of the rest of the command
+COMMAND_LEXERS = {
+    "add": lex_arithmetic,
+    "sub": lex_arithmetic,
+    "neg": lex_arithmetic,
+    "eq": lex_arithmetic,
+    "gt": lex_arithmetic,
+    "lt": lex_arithmetic,
+    "and": lex_arithmetic,
+    "or": lex_arithmetic,
+    "not": lex_arithmetic,
+    "push": lex_memory_access,
+    "pop": lex_memory_access,
+    "label": lex_branching,
+    "goto": lex_branching,
+    "if-goto": lex_branching,
+    "function": lex_function,
+    "call": lex_function,
+    "return": lex_function_return,
+}
+
 R_COPY_VAL = "R13"
 R_COPY_POINTER = "R14"
 R_RET_ADDRESS = "R15"
 
+# labels of the shared routines
+L_VM_PREFIX = "VM$"
+L_VM_START = "VM$START"
+L_VM_CALL = "VM$CALL"
+L_VM_RETURN = "VM$RETURN"
+
+# entries kept per template function, the least recently used go first
+TEMPLATE_CACHE_SIZE = 1024
+
+_templates = []
+# template cache counts of the worker processes of translate_parallel
+_worker_templates = {"hits": 0, "misses": 0}
+
+# the AsmTempl functions are pure, their text only depends on their
+# arguments: each one caches its results. push_d_to_sp and the other
+# building blocks hit on every command, the ones taking a label mostly miss.
+# fn.records(*args) is the same code as instruction records, see lower,
+# cached the same way: the text of a template is only parsed on its first
+# use with these arguments
+def template(fn):
+    cached = functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)(fn)
+
+    @functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+    def records(*args):
+        return tuple(lower(cached(*args)))
+
+    cached.records = records
+    _templates.append(cached)
+    _templates.append(records)
+    return cached
+
+# (hits, misses) of all template caches of this process and its workers
+def template_stats():
+    hits = _worker_templates["hits"]
+    misses = _worker_templates["misses"]
+    for cached in _templates:
+        info = cached.cache_info()
+        hits += info.hits
+        misses += info.misses
+    return hits, misses
+
+
 class AsmTempl:
     def __init__(self):
         pass
 
     @staticmethod
-    def repeat(func, times=1):
-        times = int(times)
-        __c = ""
-        while times > 0:
-            __c += func()
-            times -= 1
-
-        return __c
-
-    @staticmethod
+    @template
     def c__vm_begin_bootstrap():
         return f"""\
 // ---- VM Translator for Hack platform ----
@@ -325,26 +405,50 @@ class AsmTempl:
 """
 
     @staticmethod
-    def c__sys_bootstrap():
+    @template
+    def c__sys_bootstrap(shared=False):
+        call = AsmTempl.call_function("Sys.init", 0, 0)
+        if shared:
+            call = AsmTempl.call_function_shared("Sys.init", 0, "Sys.init$ret.0")
+
         return f"""// Bootstrap code
 {AsmTempl.load_constant("256", "D")}\
 {AsmTempl.write_to_register("SP", "D")}\
-{AsmTempl.call_function("Sys.init", 0, 0)}\
+{call}\
+"""
+
+    # global call, return and compare routines used by the shared code
+    # generation mode, jumped over when the program starts
+    @staticmethod
+    @template
+    def c__vm_shared_routines():
+        return f"""\
+// Shared routines
+{AsmTempl.goto_label(L_VM_START)}\
+{AsmTempl.g__call_routine()}\
+{AsmTempl.g__return_routine()}\
+{AsmTempl.g__compare_routine("eq")}\
+{AsmTempl.g__compare_routine("gt")}\
+{AsmTempl.g__compare_routine("lt")}\
+{AsmTempl.define_label(L_VM_START)}\
 """
     
     @staticmethod
+    @template
     def c__vm_end_bootstrap():
         return f"""\
 // === VM Initialize code _ END   ===
     """
 
     @staticmethod
+    @template
     def define_label(label):
         return f"""\
 ({label})
 """
     
     @staticmethod
+    @template
     def goto_label(label):
         return f"""\
 @{label}
@@ -352,6 +456,7 @@ class AsmTempl:
 """
 
     @staticmethod
+    @template
     def if_goto_label(label):
         return f"""\
 {AsmTempl.pop_sp_to_d()}\
@@ -360,6 +465,7 @@ D;JNE
 """
 
     @staticmethod
+    @template
     def jump_from_register(reg):
         return f"""\
 @{reg}
@@ -369,6 +475,7 @@ A=M
 
     # {dst} = {comp_bef}constant{comp_aft}
     @staticmethod
+    @template
     def load_constant(constant, dst="D", comp_bef="", comp_aft=""):
         return f"""\
 @{constant}
@@ -378,6 +485,7 @@ A=M
     # this function will compute and set "to" register to (mem value from base) + offset
     # "to" = M[base] + offset
     @staticmethod
+    @template
     def load_address(base, offset, dst="A"):
         offset = int(offset)
 
@@ -411,6 +519,7 @@ D=M
 """
 
     @staticmethod
+    @template
     def read_address(base, offset, dst="D"):
         return f"""\
 {AsmTempl.load_address(base, offset)}\
@@ -419,6 +528,7 @@ D=M
 
     # decrease pointer
     @staticmethod
+    @template
     def dec_address(base):
         return f"""\
 @{base}
@@ -428,11 +538,13 @@ A=M
 
     # decrease sp pointer
     @staticmethod
+    @template
     def dec_sp():
         return AsmTempl.dec_address("SP")    
 
     # increase pointer 
     @staticmethod
+    @template
     def inc_address(base):
         return f"""\
 @{base}
@@ -442,10 +554,12 @@ A=M
 
     # increase sp pointer 
     @staticmethod
+    @template
     def inc_sp():
         return AsmTempl.inc_address("SP")
 
     @staticmethod
+    @template
     def pop_sp_to_d():
         return f"""\
 {AsmTempl.dec_sp()}\
@@ -453,6 +567,7 @@ D=M
 """
 
     @staticmethod
+    @template
     def push_d_to_sp():
         return f"""\
 {AsmTempl.load_address("SP", "0")}\
@@ -462,6 +577,7 @@ M=D
 
     # *SP = constant; SP++
     @staticmethod
+    @template
     def push_constant_to_sp(constant):
         return f"""\
 {AsmTempl.load_constant(constant, "D")}\
@@ -469,13 +585,24 @@ M=D
 """
 
     @staticmethod
+    @template
     def push_register_to_sp(reg):
         return f"""\
 {AsmTempl.read_register(reg, "D")}\
 {AsmTempl.push_d_to_sp()}\
 """
 
+    # *SP = *(base + offset); SP++
     @staticmethod
+    @template
+    def push_segment_to_sp(base, offset):
+        return f"""\
+{AsmTempl.read_segment(base, offset, "D")}\
+{AsmTempl.push_d_to_sp()}\
+"""
+
+    @staticmethod
+    @template
     def stack_unary_op(op: str):
         # first load top of stack into D,
         # do arithmetic on D and write it back to top of stack.
@@ -488,6 +615,7 @@ M={op}M
         return asm_code
 
     @staticmethod
+    @template
     def stack_binary_op(op: str):
         # pop top of stack into D
         asm_code = AsmTempl.pop_sp_to_d()
@@ -501,6 +629,7 @@ M=M{op}D
         return asm_code
 
     @staticmethod
+    @template
     def stack_compare_op(op: str, label: str):
         op = op.upper()
         end_label = f"{op}_END.{label}"
@@ -520,6 +649,7 @@ M=0
     # {dst} = R
     # {dst} = {comp_bef}R{comp_aft} -> eg: {dst} = R + 1
     @staticmethod
+    @template
     def read_register(reg, dst="D", comp_bef="", comp_aft=""):
         return f"""\
 @{reg}
@@ -528,6 +658,7 @@ M=0
 
     # R = D
     @staticmethod
+    @template
     def write_to_register(reg, src="D"):
         return f"""\
 @{reg}
@@ -535,6 +666,7 @@ M={src}
 """
 
     @staticmethod
+    @template
     def pop_sp_to_register(reg):
         return f"""\
 {AsmTempl.pop_sp_to_d()}\
@@ -542,6 +674,7 @@ M={src}
 """
 
     @staticmethod
+    @template
     def pop_address_to_register(base, reg):
         return f"""\
 {AsmTempl.dec_address(base)}\
@@ -551,6 +684,7 @@ D=M
 
     # {dst} = *(base + offset)
     @staticmethod
+    @template
     def read_segment(base, offset, dst="D"):
         return f"""\
 {AsmTempl.load_address(base, offset)}\
@@ -559,6 +693,7 @@ D=M
     
     # *(base + offset) = {src}
     @staticmethod
+    @template
     def write_to_segment(base, offset, src="D"):
         return f"""\
 {AsmTempl.write_to_register(R_COPY_VAL, src)}\
@@ -571,6 +706,7 @@ M=D
 
     # *(base + offset) = pop()
     @staticmethod
+    @template
     def pop_sp_to_segment(base, offset):
         return f"""\
 {AsmTempl.load_address(base, offset, "D")}\
@@ -581,6 +717,7 @@ M=D
 """
 
     @staticmethod
+    @template
     def g__restore_function_frame():
         return f"""\
 {AsmTempl.read_register("LCL", "D")}\
@@ -598,16 +735,16 @@ M=D
 """
 
     @staticmethod
+    @template
     def define_function(func_name, n_lcl):
         return f"""\
 {AsmTempl.define_label(func_name)}\
 {AsmTempl.load_constant("0", "D")}\
-{AsmTempl.repeat(
-    lambda : AsmTempl.push_d_to_sp(), n_lcl
-)}\
+{AsmTempl.push_d_to_sp() * int(n_lcl)}\
 """
 
     @staticmethod
+    @template
     def call_function(func_name, n_args, at_line):
         ret_label = f"{func_name}$ret.{at_line}"
 
@@ -626,15 +763,386 @@ M=D
 """
 
     @staticmethod
+    @template
     def return_function():
         return f"""\
 {AsmTempl.g__restore_function_frame()}\
 """
 
+    # D = return address, R13 = 5 + nArgs, R14 = function address
+    @staticmethod
+    @template
+    def g__call_routine():
+        return f"""\
+{AsmTempl.define_label(L_VM_CALL)}\
+{AsmTempl.push_d_to_sp()}\
+{AsmTempl.push_register_to_sp("LCL")}\
+{AsmTempl.push_register_to_sp("ARG")}\
+{AsmTempl.push_register_to_sp("THIS")}\
+{AsmTempl.push_register_to_sp("THAT")}\
+{AsmTempl.read_register("SP", "D")}\
+{AsmTempl.write_to_register("LCL", "D")}\
+{AsmTempl.read_register(R_COPY_VAL, "D", "D-")}\
+{AsmTempl.write_to_register("ARG", "D")}\
+{AsmTempl.jump_from_register(R_COPY_POINTER)}\
+"""
+
+    @staticmethod
+    @template
+    def g__return_routine():
+        return f"""\
+{AsmTempl.define_label(L_VM_RETURN)}\
+{AsmTempl.g__restore_function_frame()}\
+"""
+
+    # D = return address
+    @staticmethod
+    @template
+    def g__compare_routine(op: str):
+        op = op.upper()
+        routine = f"{L_VM_PREFIX}{op}"
+        end_label = f"{routine}_END"
+
+        return f"""\
+{AsmTempl.define_label(routine)}\
+{AsmTempl.write_to_register(R_RET_ADDRESS, "D")}\
+{AsmTempl.pop_sp_to_d()}\
+{AsmTempl.load_address("SP", "-1")}\
+D=M-D
+M=-1
+@{end_label}
+D;J{op}
+{AsmTempl.load_address("SP", "-1")}\
+M=0
+{AsmTempl.define_label(end_label)}\
+{AsmTempl.jump_from_register(R_RET_ADDRESS)}\
+"""
+
+    @staticmethod
+    @template
+    def call_function_shared(func_name, n_args, ret_label):
+        return f"""\
+{AsmTempl.load_constant(5 + int(n_args), "D")}\
+{AsmTempl.write_to_register(R_COPY_VAL, "D")}\
+{AsmTempl.load_constant(func_name, "D")}\
+{AsmTempl.write_to_register(R_COPY_POINTER, "D")}\
+{AsmTempl.load_constant(ret_label, "D")}\
+{AsmTempl.goto_label(L_VM_CALL)}\
+{AsmTempl.define_label(ret_label)}\
+"""
+
+    @staticmethod
+    @template
+    def return_function_shared():
+        return AsmTempl.goto_label(L_VM_RETURN)
+
+    @staticmethod
+    @template
+    def stack_compare_op_shared(op: str, ret_label: str):
+        return f"""\
+{AsmTempl.load_constant(ret_label, "D")}\
+{AsmTempl.goto_label(f"{L_VM_PREFIX}{op.upper()}")}\
+{AsmTempl.define_label(ret_label)}\
+"""
+
+# dest, comp, jump of a C-instruction line, None for A-instructions
+def _split_c(ins: str):
+    if ins.startswith("@"):
+        return None
+    dest, _, rest = ins.rpartition("=")
+    comp, _, jump = rest.partition(";")
+    return dest, comp, jump
+
+# the instruction only sets the A register: no memory or D write, no jump
+def _only_writes_a(ins: str) -> bool:
+    if ins.startswith("@"):
+        return True
+    dest, comp, jump = _split_c(ins)
+    return dest == "A" and jump == ""
+
+# peephole rules look at the straight-line instructions ins (no labels in
+# between, comments already set aside) at position i. a match returns
+# (number of instructions replaced, replacement list), otherwise None.
+
+# SP++ directly undone by SP--:
+#   @SP, M=M+1, A=M, @SP, M=M-1, A=M  ->  @SP, A=M
+def peep_sp_inc_dec(ins, i):
+    if ins[i:i + 6] == ["@SP", "M=M+1", "A=M", "@SP", "M=M-1", "A=M"]:
+        return 6, ["@SP", "A=M"]
+    return None
+
+# a value stored then loaded back, or loaded then stored back, through the
+# same address: M=D, D=M -> M=D and D=M, M=D -> D=M
+def peep_store_load(ins, i):
+    pair = ins[i:i + 2]
+    if pair == ["M=D", "D=M"] or pair == ["D=M", "M=D"]:
+        return 2, [pair[0]]
+    return None
+
+# A is set again before it is ever used: A=M, @X -> @X
+def peep_dead_a(ins, i):
+    if i + 1 < len(ins) and ins[i + 1].startswith("@") and _only_writes_a(ins[i]):
+        return 2, [ins[i + 1]]
+    return None
+
+# the pointer just loaded is loaded again, with one instruction in between
+# that keeps A and does not jump: @X, A=M, ins, @X, A=M -> @X, A=M, ins.
+# a memory write in between may only change *X, not X itself, which holds
+# for the stack pointer, SP never points to itself.
+def peep_reload_pointer(ins, i):
+    if i + 5 > len(ins) or ins[i + 1] != "A=M" or not ins[i].startswith("@"):
+        return None
+    if ins[i + 3:i + 5] != [ins[i], "A=M"]:
+        return None
+
+    mid = _split_c(ins[i + 2])
+    if mid == None:
+        return None
+    dest, comp, jump = mid
+    if "A" in dest or jump != "":
+        return None
+    if "M" in dest and ins[i] != "@SP":
+        return None
+
+    return 5, ins[i:i + 3]
+
+# a push directly followed by an operation on the top of the stack: the
+# pushed value is still in D, the store to *SP lands above the new top of
+# the stack and is never read: @SP, A=M, M=D, @SP, A=M-1 -> @SP, A=M-1
+def peep_dead_stack_store(ins, i):
+    if ins[i:i + 5] == ["@SP", "A=M", "M=D", "@SP", "A=M-1"]:
+        return 5, ["@SP", "A=M-1"]
+    return None
+
+PEEPHOLE_RULES = {
+    "sp_inc_dec": peep_sp_inc_dec,
+    "store_load": peep_store_load,
+    "dead_a": peep_dead_a,
+    "reload_pointer": peep_reload_pointer,
+    "dead_stack_store": peep_dead_stack_store,
+}
+
+# peephole optimizer over the generated assembly of one file. rules only
+# rewrite straight-line code, labels end a run. comments stay in place,
+# the ones in front of removed instructions move to the next instruction.
+class Peephole:
+    def __init__(self, rules=None):
+        if rules == None:
+            rules = PEEPHOLE_RULES.keys()
+        self.rules = [PEEPHOLE_RULES[name] for name in rules]
+        self.before = 0
+        self.after = 0
+
+    def optimize(self, asm_code: str) -> str:
+        out = []
+        ins = []
+        notes = []
+        pending = []
+        for line in asm_code.split("\n"):
+            stripped = line.strip()
+            if stripped == "" or stripped.startswith("//"):
+                pending.append(line)
+            elif stripped.startswith("("):
+                self._flush(ins, notes, out)
+                ins = []
+                notes = []
+                out.extend(pending)
+                out.append(line)
+                pending = []
+            else:
+                ins.append(stripped)
+                notes.append(pending)
+                pending = []
+        self._flush(ins, notes, out)
+        out.extend(pending)
+
+        return "\n".join(out)
+
+    def _flush(self, ins, notes, out):
+        self.before += len(ins)
+
+        tail = []
+        i = 0
+        while i < len(ins):
+            for rule in self.rules:
+                match = rule(ins, i)
+                if match != None:
+                    break
+            else:
+                i += 1
+                continue
+
+            length, replacement = match
+            moved = [line for note in notes[i:i + length] for line in note]
+            ins[i:i + length] = replacement
+            notes[i:i + length] = [[] for _ in replacement]
+            if i < len(notes):
+                notes[i] = moved + notes[i]
+            else:
+                tail.extend(moved)
+            # a rewrite can complete a pattern that started a bit earlier
+            i = max(0, i - 4)
+
+        self.after += len(ins)
+        for k, line in enumerate(ins):
+            out.extend(notes[k])
+            out.append(line)
+        out.extend(tail)
+
+_UNARY_OPS = {"neg": "-", "not": "!"}
+_BINARY_OPS = {"add": "+", "sub": "-", "and": "&", "or": "|"}
+_COMPARE_OPS = ("eq", "gt", "lt")
+# segments addressed through a base pointer
+_SEGMENT_BASES = {"local": "LCL", "argument": "ARG", "this": "THIS", "that": "THAT"}
+# segments mapped to a fixed register or symbol, see segment_register
+_REGISTER_SEGMENTS = ("static", "pointer", "temp")
+
+# the largest value push constant takes, the assembler's A-instruction limit
+MAX_CONSTANT = 0x7FFF
+
+# arithmetic on 16-bit words, as the generated code computes it. the
+# comparisons test the sign of x - y like stack_compare_op's D;JGT, so a
+# fold gives the same result as the code it replaces even on overflow.
+# gt and lt follow that on purpose: vminterp compares signed words as the
+# vm spec does, so the two disagree when x - y overflows (32767 gt -1 is
+# false here and true in vminterp)
+FOLD_OPS = {
+    "add": lambda x, y: (x + y) & 0xFFFF,
+    "sub": lambda x, y: (x - y) & 0xFFFF,
+    "and": lambda x, y: x & y,
+    "or": lambda x, y: x | y,
+    "eq": lambda x, y: 0xFFFF if (x - y) & 0xFFFF == 0 else 0,
+    "gt": lambda x, y: 0xFFFF if 0 < (x - y) & 0xFFFF < 0x8000 else 0,
+    "lt": lambda x, y: 0xFFFF if (x - y) & 0x8000 else 0,
+    "neg": lambda x: -x & 0xFFFF,
+    "not": lambda x: x ^ 0xFFFF,
+}
+
+# constant folding over the commands of one file, before they are
+# generated. each command is looked at against the end of the commands
+# kept so far:
+#   push constant 3, push constant 4, add  ->  push constant 7
+#   push constant 0, not, if-goto L        ->  goto L
+#   push constant 0, if-goto L             ->  (nothing)
+#   push local 2, pop local 2              ->  (nothing)
+# a constant is push constant n, or push constant n followed by neg or not.
+# the folds write the words above 32767 as push constant ~n, not. labels
+# and functions end a run, so no jump lands inside a folded sequence
+class VMOptimizer:
+    def __init__(self):
+        self.before = 0
+        self.after = 0
+        self.instructions = 0
+
+    # cost(cmd) is the number of instructions generated for cmd, it counts
+    # the instructions saved
+    def optimize(self, cmds, cost):
+        self.before += len(cmds)
+        out = []
+        for cmd in cmds:
+            out.append(cmd)
+            replacement = self._fold(out)
+            if replacement != None:
+                length, new = replacement
+                self.instructions += sum(cost(old) for old in out[-length:]) - sum(cost(c) for c in new)
+                out[-length:] = new
+        self.after += len(out)
+
+        return out
+
+    # (commands replaced at the end of out, new commands) or None
+    def _fold(self, out):
+        cmd = out[-1]
+        op = cmd.tokens[0].value
+        if cmd.type == C_ARITHMETIC and op in _UNARY_OPS:
+            x = _constant_at(out, len(out) - 1)
+            if x != None:
+                new = self._constant(FOLD_OPS[op](x[0]), cmd)
+                if len(new) < x[1] + 1:
+                    return x[1] + 1, new
+        elif cmd.type == C_ARITHMETIC:
+            y = _constant_at(out, len(out) - 1)
+            if y != None:
+                x = _constant_at(out, len(out) - 1 - y[1])
+                if x != None:
+                    return x[1] + y[1] + 1, self._constant(FOLD_OPS[op](x[0], y[0]), cmd)
+        elif cmd.type == C_IF:
+            x = _constant_at(out, len(out) - 1)
+            if x != None:
+                if x[0] == 0:
+                    return x[1] + 1, []
+                return x[1] + 1, [_command(C_GOTO, ["goto", cmd.tokens[1].value], cmd)]
+        elif cmd.type == C_POP and len(out) > 1:
+            prev = out[-2]
+            if (
+                prev.type == C_PUSH
+                and prev.tokens[1].value != "constant"
+                and prev.tokens[1].value == cmd.tokens[1].value
+                and prev.tokens[2].value == cmd.tokens[2].value
+            ):
+                return 2, []
+        return None
+
+    # the shortest commands pushing the 16-bit word value. above 32767 the
+    # complement always fits, where the negation of 0x8000 is 0x8000 again
+    def _constant(self, value, at):
+        if value <= MAX_CONSTANT:
+            return [_command(C_PUSH, ["push", "constant", str(value)], at)]
+        return [
+            _command(C_PUSH, ["push", "constant", str(value ^ 0xFFFF)], at),
+            _command(C_ARITHMETIC, ["not"], at),
+        ]
+
+# (value, commands) of the constant ending before out[end], or None
+def _constant_at(out, end):
+    if end < 1:
+        return None
+    cmd = out[end - 1]
+    if cmd.type == C_PUSH and cmd.tokens[1].value == "constant":
+        return int(cmd.tokens[2].value), 1
+    if cmd.type == C_ARITHMETIC and cmd.tokens[0].value in _UNARY_OPS and end >= 2:
+        prev = out[end - 2]
+        if prev.type == C_PUSH and prev.tokens[1].value == "constant":
+            return FOLD_OPS[cmd.tokens[0].value](int(prev.tokens[2].value)), 2
+    return None
+
+# a command built by a pass, at the line of the command it replaces
+def _command(type, words, at):
+    pos = at.tokens[0].pos
+    tokens = [Token(TOK_CMD, words[0], pos, at.line)]
+    tokens.extend(Token(TOK_ARG, word, pos, at.line) for word in words[1:])
+    return Command(type, tokens, at.line)
+
 class Generator:
-    def __init__(self, file_name, cmds):
+    def __init__(self, file_name, cmds, options=None):
         self.file_name = file_name.replace(".vm", "")
         self.cmds = cmds
+        self.options = options or {}
+        # jump to the global call/return/compare routines instead of
+        # inlining them at every command
+        self.shared = self.options.get("shared_routines", False)
+        self.peephole = None
+        if self.options.get("peephole"):
+            self.peephole = Peephole(self.options.get("peephole_rules"))
+        self.folder = None
+        if self.options.get("fold"):
+            self.folder = VMOptimizer()
+        # command type -> decoder, one lookup per command. a decoder returns
+        # the template of the command and its arguments, which give the
+        # command's text and its instruction records
+        self.decoders = {
+            C_ARITHMETIC: self.dec_arithmetic,
+            C_PUSH: self.dec_push,
+            C_POP: self.dec_pop,
+            C_LABEL: self.dec_label,
+            C_GOTO: self.dec_goto,
+            C_IF: self.dec_if_goto,
+            C_FUNCTION: self.dec_function,
+            C_CALL: self.dec_call,
+            C_RETURN: self.dec_return,
+        }
+        if self.folder != None:
+            self.cmds = self.folder.optimize(self.cmds, self.instructions)
 
     def get_label(self, prefix: str, cmd):
         return f"{prefix or 'GENERATOR'}__{cmd.line}"
@@ -645,104 +1153,70 @@ class Generator:
     def dec_arithmetic(self, cmd):
         op = cmd.tokens[0].value
 
-        asm_code = ""
-
-        if op == "neg":
-            asm_code += AsmTempl.stack_unary_op("-")
-        elif op == "not":
-            asm_code += AsmTempl.stack_unary_op("!")
-        elif op == "add":
-            asm_code += AsmTempl.stack_binary_op("+")
-        elif op == "sub":
-            asm_code += AsmTempl.stack_binary_op("-")
-        elif op == "and":
-            asm_code += AsmTempl.stack_binary_op("&")
-        elif op == "or":
-            asm_code += AsmTempl.stack_binary_op("|")
-        elif op == "eq":
-            asm_code += AsmTempl.stack_compare_op(op, self.get_label("CMP", cmd))
-        elif op == "gt":
-            asm_code += AsmTempl.stack_compare_op(op, self.get_label("CMP", cmd))
-        elif op == "lt":
-            asm_code += AsmTempl.stack_compare_op(op, self.get_label("CMP", cmd))
-        else:
-            raise Exception(f"generator error. unknown arithmetic operation '{op}'")
-
-        return asm_code
+        if op in _UNARY_OPS:
+            return AsmTempl.stack_unary_op, (_UNARY_OPS[op],)
+        if op in _BINARY_OPS:
+            return AsmTempl.stack_binary_op, (_BINARY_OPS[op],)
+        if op in _COMPARE_OPS:
+            return self.compare_op(op, cmd)
+        raise Exception(f"generator error. unknown arithmetic operation '{op}'")
+
+    def compare_op(self, op, cmd):
+        if self.shared:
+            # return labels are per file, the routine is shared by all files
+            ret_label = f"{self.file_name}$CMP.{cmd.line}"
+            return AsmTempl.stack_compare_op_shared, (op, ret_label)
+
+        return AsmTempl.stack_compare_op, (op, self.get_label("CMP", cmd))
     
+    def segment_register(self, segment, i):
+        if segment == "static":
+            return self.get_static_name(i)
+        if segment == "pointer":
+            return "THIS" if i == "0" else "THAT"
+        return f"R{int(i)+5}"
+
     def dec_push(self, cmd):
         # push segment i
         segment = cmd.tokens[1].value
         i = cmd.tokens[2].value
 
-        asm_code = ""
-
         if segment == "constant":
-            asm_code += AsmTempl.load_constant(i)
-        elif segment == "local":
-            asm_code += AsmTempl.read_segment("LCL", i)
-        elif segment == "argument":
-            asm_code += AsmTempl.read_segment("ARG", i)
-        elif segment == "this":
-            asm_code += AsmTempl.read_segment("THIS", i)
-        elif segment == "that":
-            asm_code += AsmTempl.read_segment("THAT", i)
-        elif segment == "static":
-            asm_code += AsmTempl.read_register(self.get_static_name(i))
-        elif segment == "pointer":
-            asm_code += AsmTempl.read_register("THIS" if i == "0" else "THAT")
-        elif segment == "temp":
-            asm_code += AsmTempl.read_register(f"R{int(i)+5}")
-        else:
-            raise Exception(f"generator error. unknown memory access segment '{segment}'")
-
-        asm_code += AsmTempl.push_d_to_sp()
-
-        return asm_code
+            return AsmTempl.push_constant_to_sp, (i,)
+        if segment in _SEGMENT_BASES:
+            return AsmTempl.push_segment_to_sp, (_SEGMENT_BASES[segment], i)
+        if segment in _REGISTER_SEGMENTS:
+            return AsmTempl.push_register_to_sp, (self.segment_register(segment, i),)
+        raise Exception(f"generator error. unknown memory access segment '{segment}'")
 
     def dec_pop(self, cmd):
         # pop segment i
         segment = cmd.tokens[1].value
         i = cmd.tokens[2].value
 
-        asm_code = ""
-
-        if segment == "local":
-            asm_code += AsmTempl.pop_sp_to_segment("LCL", i)
-        elif segment == "argument":
-            asm_code += AsmTempl.pop_sp_to_segment("ARG", i)
-        elif segment == "this":
-            asm_code += AsmTempl.pop_sp_to_segment("THIS", i)
-        elif segment == "that":
-            asm_code += AsmTempl.pop_sp_to_segment("THAT", i)
-        elif segment == "static":
-            asm_code += AsmTempl.pop_sp_to_register(self.get_static_name(i))
-        elif segment == "pointer":
-            asm_code += AsmTempl.pop_sp_to_register("THIS" if i == "0" else "THAT")
-        elif segment == "temp":
-            asm_code += AsmTempl.pop_sp_to_register(f"R{int(i)+5}")
-        else:
-            raise Exception(f"generator error. unknown memory segment '{segment}'")
-
-        return asm_code
+        if segment in _SEGMENT_BASES:
+            return AsmTempl.pop_sp_to_segment, (_SEGMENT_BASES[segment], i)
+        if segment in _REGISTER_SEGMENTS:
+            return AsmTempl.pop_sp_to_register, (self.segment_register(segment, i),)
+        raise Exception(f"generator error. unknown memory segment '{segment}'")
 
     def dec_label(self, cmd):
         # label label
         label = cmd.tokens[1].value
 
-        return AsmTempl.define_label(label)
+        return AsmTempl.define_label, (label,)
 
     def dec_goto(self, cmd):
         # goto label
         label = cmd.tokens[1].value
 
-        return AsmTempl.goto_label(label)
+        return AsmTempl.goto_label, (label,)
 
     def dec_if_goto(self, cmd):
         # if-goto label
         label = cmd.tokens[1].value
 
-        return AsmTempl.if_goto_label(label)
+        return AsmTempl.if_goto_label, (label,)
 
     def dec_function(self, cmd):
         # function functionName nArgs
@@ -750,7 +1224,7 @@ class Generator:
         # nArgs = number of local variables (LCL)
         n_lcl = cmd.tokens[2].value
 
-        return AsmTempl.define_function(func_name, n_lcl)
+        return AsmTempl.define_function, (func_name, n_lcl)
 
     def dec_call(self, cmd):
         # called at
@@ -760,98 +1234,449 @@ class Generator:
         # nArgs = number of argument (ARG)
         n_args = cmd.tokens[2].value
 
-        return AsmTempl.call_function(func_name, n_args, at_line)
+        if self.shared:
+            ret_label = f"{self.file_name}$ret.{at_line}"
+            return AsmTempl.call_function_shared, (func_name, n_args, ret_label)
+
+        return AsmTempl.call_function, (func_name, n_args, at_line)
 
     def dec_return(self, cmd):
+        if self.shared:
+            return AsmTempl.return_function_shared, ()
 
-        return AsmTempl.return_function()
+        return AsmTempl.return_function, ()
 
     def decode_cmd(self, pos):
         cmd = self.cmds[pos]
         if cmd == None:
             raise Exception("generator error. null command")
 
-        asm_code = f"//{cmd}\n"
-        
-        if cmd.type == C_ARITHMETIC:
-            pass
-            asm_code += self.dec_arithmetic(cmd)
-        elif cmd.type == C_PUSH:
-            pass
-            asm_code += self.dec_push(cmd)
-        elif cmd.type == C_POP:
-            pass
-            asm_code += self.dec_pop(cmd)
-        elif cmd.type == C_LABEL:
-            pass
-            asm_code += self.dec_label(cmd)
-        elif cmd.type == C_GOTO:
-            pass
-            asm_code += self.dec_goto(cmd)
-        elif cmd.type == C_IF:
-            pass
-            asm_code += self.dec_if_goto(cmd)
-        elif cmd.type == C_FUNCTION:
-            pass
-            asm_code += self.dec_function(cmd)
-        elif cmd.type == C_CALL:
-            pass
-            asm_code += self.dec_call(cmd)
-        elif cmd.type == C_RETURN:
-            pass
-            asm_code += self.dec_return(cmd)
-        else:
+        decode = self.decoders.get(cmd.type)
+        if decode == None:
             raise Exception("generator error. unknown command")
 
-        return asm_code
+        fn, args = decode(cmd)
+        return f"//{cmd}\n" + fn(*args)
+
+    # instructions generated for cmd, labels left out
+    def instructions(self, cmd) -> int:
+        fn, args = self.decoders[cmd.type](cmd)
+        return sum(1 for record in fn.records(*args) if record[0] != assembler.INS_L)
+
+    # the instruction records of the file for assembler.encode_records,
+    # straight from the templates' records without writing the text. the
+    # peephole optimizer works on the text, with it the text is lowered
+    def records(self) -> list:
+        if self.peephole != None:
+            buf = io.StringIO()
+            self.run(buf)
+            return lower(buf.getvalue())
+
+        records = []
+        decoders = self.decoders
+        for cmd in self.cmds:
+            fn, args = decoders[cmd.type](cmd)
+            records.extend(fn.records(*args))
+
+        return records
 
     def run(self, outf):
+        # names the file of the //line: command comments that follow, for
+        # the assembler's source map
+        outf.write(f"//file: {self.file_name}.vm\n")
+        if self.peephole != None:
+            chunks = [self.decode_cmd(i) + "\n" for i in range(len(self.cmds))]
+            outf.write(self.peephole.optimize("".join(chunks)))
+            return
+
         i = 0
         while i < len(self.cmds):
             asm_code = self.decode_cmd(i)
             outf.write(asm_code + "\n")
             i+=1
 
-def translate(vm_file, writer):
-    print(f"=> Start translating {vm_file}")
+# bump whenever the generated code changes, it invalidates every cached file
+TRANSLATOR_VERSION = "4"
+
+# on-disk cache of the assembly generated for one .vm file. entries are keyed
+# by a hash of the file name and content, the translator version and the
+# options, and the least recently used ones are evicted past max_bytes.
+# an entry starts with a //stats: line holding the optimizer counts of its
+# file, so a cached file reports the same figures as a generated one
+CACHE_STATS = "//stats: "
+
+class TranslationCache:
+    def __init__(self, cache_dir, max_bytes=64 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, vm_file, input: str, options=None) -> str:
+        h = hashlib.sha256()
+        h.update(TRANSLATOR_VERSION.encode())
+        h.update(b"\0")
+        # static symbols are named after the file
+        h.update(os.path.basename(vm_file).encode())
+        h.update(b"\0")
+        h.update(repr(sorted((options or {}).items())).encode())
+        h.update(b"\0")
+        h.update(input.encode())
+
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".asm")
+
+    # (asm_code, stats) or None
+    def get(self, key):
+        path = self._path(key)
+        try:
+            inf = open(path, 'r')
+        except FileNotFoundError:
+            return None
+        header = inf.readline()
+        asm_code = inf.read()
+        inf.close()
+        # mtime is the last use, for eviction
+        os.utime(path)
+        if not header.startswith(CACHE_STATS):
+            return None
+
+        return asm_code, json.loads(header[len(CACHE_STATS):])
+
+    def put(self, key, asm_code: str, stats=None):
+        # written under a temporary name so readers never see half a file,
+        # also when several processes fill the cache at once
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, 'w') as outf:
+            outf.write(f"{CACHE_STATS}{json.dumps(stats or {})}\n")
+            outf.write(asm_code)
+        os.replace(tmp_path, self._path(key))
+
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".asm"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+# lex and generate one .vm file, returns its assembly, or its instruction
+# records when lowered is set. files are independent of each other (statics
+# are named after the file) so this also runs in worker processes
+def translate_file(vm_file, cache: typing.Optional[TranslationCache] = None, options=None,
+                   lowered=False):
     inf = open(vm_file, 'r')
     input = inf.read()
     inf.close()
-    l = Lexer(input, lex_line)
-    l.run()
-    # for cmd in l.cmds:
-    #     print(cmd)
-    g = Generator(os.path.basename(vm_file), l.cmds)
-    g.run(writer)
+
+    if cache != None:
+        key = cache.key(vm_file, input, options)
+        entry = cache.get(key)
+        if entry != None:
+            logger.info(f"=> Cached {vm_file}")
+            asm_code, stats = entry
+            add_stats(vm_file, stats)
+            return lower(asm_code) if lowered else asm_code
+
+    logger.info(f"=> Start translating {vm_file}")
+    with timer.phase("lex"):
+        l = Lexer(input, lex_line)
+        l.run()
+    if TRACE:
+        for cmd in l.cmds:
+            logger.debug(cmd)
+
+    # the cache keeps the text, a cached file is lowered from it
+    records = None
+    with timer.phase("generate"):
+        g = Generator(os.path.basename(vm_file), l.cmds, options)
+        if lowered and cache == None:
+            records = g.records()
+        else:
+            buf = io.StringIO()
+            g.run(buf)
+            asm_code = buf.getvalue()
+
+    stats = {}
+    if g.peephole != None:
+        stats["peephole"] = [g.peephole.before, g.peephole.after]
+    if g.folder != None:
+        stats["fold"] = [g.folder.before, g.folder.after, g.folder.instructions]
+    if cache != None:
+        cache.put(key, asm_code, stats)
+    add_stats(vm_file, stats)
+
+    if lowered:
+        return records if records != None else lower(asm_code)
+    return asm_code
+
+# instruction counts before and after the peephole optimizer, of the files
+# generated by this process
+peephole_stats = {"before": 0, "after": 0}
+
+# (vm_file, commands before, commands after, instructions saved) of every
+# file folded by this process
+fold_reports = []
+
+# adds the optimizer counts of one file, generated or cached
+def add_stats(vm_file, stats):
+    if "peephole" in stats:
+        before, after = stats["peephole"]
+        peephole_stats["before"] += before
+        peephole_stats["after"] += after
+        logger.info(f"=> Peephole {vm_file}: {before} -> {after} instructions")
+    if "fold" in stats:
+        fold_reports.append((vm_file, *stats["fold"]))
+
+# translate_file in a worker process, also returns the worker's peephole,
+# template cache and fold counts for that file
+def _translate_job(vm_file, cache, options, lowered):
+    before = peephole_stats["before"]
+    after = peephole_stats["after"]
+    hits, misses = template_stats()
+    folded = len(fold_reports)
+    code = translate_file(vm_file, cache, options, lowered)
+    templates = template_stats()
+
+    return (
+        code,
+        peephole_stats["before"] - before,
+        peephole_stats["after"] - after,
+        templates[0] - hits,
+        templates[1] - misses,
+        fold_reports[folded:],
+    )
+
+def translate(vm_file, writer, cache=None, options=None):
+    lowered = _lowered_writer(writer)
+    code = translate_file(vm_file, cache, options, lowered)
+    with timer.phase("write"):
+        if lowered:
+            writer.records.extend(code)
+        else:
+            writer.write(code)
+
+# a RecordWriter without an .asm copy takes the records of translate_file
+def _lowered_writer(writer) -> bool:
+    return isinstance(writer, RecordWriter) and writer.asm_outf == None
+
+# same output as calling translate on every file in order, the files are
+# translated by a pool of jobs processes and written back in vm_source order
+def translate_parallel(vm_source, writer, jobs, cache=None, options=None):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        with timer.phase("translate"):
+            lowered = _lowered_writer(writer)
+            caches = [cache] * len(vm_source)
+            options = [options] * len(vm_source)
+            lowereds = [lowered] * len(vm_source)
+            results = pool.map(_translate_job, vm_source, caches, options, lowereds)
+            for code, before, after, hits, misses, folded in results:
+                if lowered:
+                    writer.records.extend(code)
+                else:
+                    writer.write(code)
+                fold_reports.extend(folded)
+                peephole_stats["before"] += before
+                peephole_stats["after"] += after
+                _worker_templates["hits"] += hits
+                _worker_templates["misses"] += misses
+
+# the .vm files of a program, input_name is a file or a directory
+def source_files(input_name) -> list:
+    if input_name.endswith(".vm"):
+        return [input_name]
+    # sorted, so the output does not depend on directory order
+    return sorted(glob.glob(f"{input_name}/*.vm"))
+
+# programs with a Sys.vm start by calling Sys.init, the others run from the
+# top of their first file
+def has_sys(vm_source) -> bool:
+    return "Sys.vm" in [file_path.split("/")[-1] for file_path in vm_source]
+
+# the code written before the first file
+def write_bootstrap(outf, vm_source, shared=False):
+    # writing vm bootstrap begin section
+    outf.write(AsmTempl.c__vm_begin_bootstrap() + '\n')
+    if shared:
+        outf.write(AsmTempl.c__vm_shared_routines() + '\n')
+    # check exists Sys.vm file and write bootstrap code
+    if has_sys(vm_source):
+        logger.info("Writing bootstrap code")
+        outf.write(AsmTempl.c__sys_bootstrap(shared) + '\n')
+
+    # writing vm bootstrap end section
+    outf.write(AsmTempl.c__vm_end_bootstrap() + '\n')
+
+# records of the lines lowered so far, most lines ("@SP", "M=M+1") repeat
+# throughout a program. cleared when full, unique label lines would grow it
+# without bound
+_lowered = {}
+LOWER_CACHE_SIZE = 1 << 16
+
+# the instruction records (kind, dest, comp, jump, symbol) of generated
+# assembly, see assembler.encode_records. comments and blank lines are
+# dropped
+def lower(asm_code) -> list:
+    records = []
+    cache = _lowered
+    for line in asm_code.split('\n'):
+        record = cache.get(line)
+        if record == None:
+            stripped = line.lstrip()
+            if stripped == "" or stripped.startswith("//"):
+                continue
+            record = assembler.line_record(line)
+            if record == None:
+                continue
+            if len(cache) >= LOWER_CACHE_SIZE:
+                cache.clear()
+            cache[line] = record
+        records.append(record)
+
+    return records
+
+# a writer for translate and translate_parallel that keeps the instruction
+# records of the generated code instead of its text. the files come as
+# records straight from the templates, unless the text also goes to
+# asm_outf, for debugging: then it is written and lowered
+class RecordWriter:
+    def __init__(self, asm_outf=None):
+        self.asm_outf = asm_outf
+        self.records = []
+
+    def write(self, asm_code):
+        if self.asm_outf != None:
+            self.asm_outf.write(asm_code)
+        self.records.extend(lower(asm_code))
 
 def main():
-    input_name = sys.argv[1]
-    vm_source = [input_name]
+    parser = argparse.ArgumentParser(description="VM translator for Hack platform")
+    parser.add_argument("input_name", help="a .vm file or a directory of .vm files")
+    parser.add_argument("-o", "--output", dest="asm_file")
+    parser.add_argument("-v", "--verbose", action="count", default=0,
+                        help="-v: info, -vv: trace every token and command")
+    parser.add_argument("--timing", action="store_true",
+                        help="print time spent per phase to stderr")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="translate files in N processes, 0: one per cpu")
+    parser.add_argument("--cache-dir",
+                        help="reuse the assembly of unchanged files from this directory")
+    parser.add_argument("--cache-size", type=int, default=64,
+                        help="cache size limit in MB (default 64)")
+    parser.add_argument("--shared-routines", action="store_true",
+                        help="emit call, return and eq/gt/lt once and jump to them, smaller rom")
+    parser.add_argument("--peephole", action="store_true",
+                        help="run the peephole optimizer over the generated code")
+    parser.add_argument("--fold", action="store_true",
+                        help="fold constant arithmetic, push/pop pairs and constant if-gotos "
+                        "in the vm code before generating it")
+    parser.add_argument("--hack", nargs="?", const="", metavar="HACK_FILE", dest="hack_file",
+                        help="assemble in process straight to a rom, by default next to the input as .hack. "
+                        "the .asm is then only written with -o")
+    parser.add_argument("--format", choices=["text", "binary"], default="text",
+                        help="rom format of --hack: '0'/'1' lines (default) or packed 16-bit words")
+    parser.add_argument("--byteorder", choices=["little", "big"], default="little",
+                        help="word byte order of the binary format")
+    parser.add_argument("--peephole-rules",
+                        help=f"comma separated rules to apply, default all: {','.join(PEEPHOLE_RULES)}")
+    args = parser.parse_args()
+    set_verbosity(args.verbose)
+
+    input_name = args.input_name
+    vm_source = source_files(input_name)
 
     asm_file = input_name.replace(".vm", ".asm")
     if not input_name.endswith(".vm"):
         asm_file = input_name + ".asm"
-        vm_source = glob.glob(f"{input_name}/*.vm")
-
-    if len(sys.argv) > 2:
-        asm_file = sys.argv[3]
 
-    outf = open(asm_file, 'w')
+    if args.asm_file:
+        asm_file = args.asm_file
+
+    options = {
+        "shared_routines": args.shared_routines,
+        "peephole": args.peephole,
+        "fold": args.fold,
+    }
+    if args.peephole_rules:
+        rules = args.peephole_rules.split(",")
+        for rule in rules:
+            if rule not in PEEPHOLE_RULES:
+                parser.error(f"unknown peephole rule '{rule}'")
+        options["peephole_rules"] = rules
+
+    if args.hack_file != None:
+        hack_file = args.hack_file or os.path.splitext(asm_file)[0] + ".hack"
+        outf = RecordWriter(open(args.asm_file, 'w') if args.asm_file else None)
+    else:
+        outf = open(asm_file, 'w')
 
-    # writing vm bootstrap begin section
-    outf.write(AsmTempl.c__vm_begin_bootstrap() + '\n')
-    # check exists Sys.vm file and write bootstrap code
-    if "Sys.vm" in [file_path.split("/")[-1] for file_path in vm_source]:
-        print("Writing bootstrap code")
-        outf.write(AsmTempl.c__sys_bootstrap() + '\n')
+    write_bootstrap(outf, vm_source, args.shared_routines)
 
-    # writing vm bootstrap end section
-    outf.write(AsmTempl.c__vm_end_bootstrap() + '\n')
+    cache = None
+    if args.cache_dir:
+        cache = TranslationCache(args.cache_dir, args.cache_size * 1024 * 1024)
 
     # translating file by file
-    for vm_file in vm_source:
-        translate(vm_file, outf)
-    outf.close()
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    if jobs > 1 and len(vm_source) > 1:
+        translate_parallel(vm_source, outf, jobs, cache, options)
+    else:
+        for vm_file in vm_source:
+            translate(vm_file, outf, cache, options)
+    if args.hack_file != None:
+        if outf.asm_outf != None:
+            outf.asm_outf.close()
+        with timer.phase("encode"):
+            words = assembler.encode_records(outf.records, assembler.SymbolTable())
+        with timer.phase("write"):
+            if args.format == "binary":
+                hackf = open(hack_file, 'wb')
+                assembler.write_rom(hackf, words, args.byteorder)
+            else:
+                hackf = open(hack_file, 'w')
+                assembler.write_hack(hackf, words)
+            hackf.close()
+        logger.info(f"{len(words)} instructions -> {hack_file}")
+    else:
+        outf.close()
+
+    if cache != None:
+        cache.evict()
+
+    if args.peephole:
+        before, after = peephole_stats["before"], peephole_stats["after"]
+        saved = (before - after) / before * 100 if before > 0 else 0
+        print(f"peephole: {before} -> {after} instructions (-{saved:.1f}%)", file=sys.stderr)
+
+    if args.fold:
+        for vm_file, before, after, saved in fold_reports:
+            print(f"fold {vm_file}: {before} -> {after} commands (-{before - after}), -{saved} instructions",
+                  file=sys.stderr)
+
+    if args.timing:
+        print(timer.summary(), file=sys.stderr)
+        hits, misses = template_stats()
+        if hits + misses > 0:
+            print(
+                f"templates: {hits} hits, {misses} misses ({hits / (hits + misses) * 100:.1f}% hit rate)",
+                file=sys.stderr,
+            )
 
 if __name__ == "__main__":
     main()